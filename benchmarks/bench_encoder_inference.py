@@ -0,0 +1,137 @@
+"""Benchmark CPU inference of autoencoder encodings for hexes, comparing
+the keras path (autoencoder_features.get_encoded_features) against the
+encoder exported to ONNX, float32 and quantized
+(autoencoder_features.get_encoded_features_onnx), and check encodings
+match within tolerance.
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from time import time
+
+import h3.api.numpy_int as h3
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import stc_unicef_cpi.features.autoencoder_features as af
+
+# max abs difference in encodings allowed, relative to their scale
+TOLERANCES = {None: 1e-4, "fp16": 1e-2, "int8": 1e-1}
+
+
+def write_raster(path, height, width, n_bands, seed=42):
+    rng = np.random.default_rng(seed)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=n_bands,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(0.0, 10.0, 0.005, 0.005),
+        tiled=True,
+    ) as dst:
+        dst.write(rng.normal(size=(n_bands, height, width)).astype(np.float32))
+    return -0.005 * height + 10.0, 0.005 * width
+
+
+def main(n_hexes, n_bands, dim, epochs, n_threads=None, seed=42):
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        tiff_dir = tmp_dir / "tiffs"
+        tiff_dir.mkdir()
+        min_lat, max_long = write_raster(tiff_dir / "bench.tif", 2000, 2000, n_bands)
+        lats = rng.uniform(min_lat, 10.0, n_hexes)
+        longs = rng.uniform(0.0, max_long, n_hexes)
+        hex_codes = np.array(
+            [h3.geo_to_h3(lat, long, 7) for lat, long in zip(lats, longs)]
+        )
+
+        train_data, band_stats = af.get_train_data(
+            str(tiff_dir), hex_codes[:2048], dim=dim, return_stats=True
+        )
+        af.get_trained_autoencoder(
+            train_data,
+            epochs=epochs,
+            save_dir=tmp_dir,
+            model_name="bench",
+            band_stats=band_stats,
+        )
+        kwargs = dict(
+            trained_autoencoder_dir=tmp_dir,
+            model_name="bench",
+            hex_codes=hex_codes,
+            tiff_files_dir=str(tiff_dir),
+            dim=dim,
+        )
+
+        ts = time()
+        keras_encodings = af.get_encoded_features(gpu=False, **kwargs)
+        t_keras = time() - ts
+        scale = np.abs(keras_encodings).max()
+        print(f"{n_hexes} hexes, {n_bands} bands of {dim}x{dim}:")
+        print(f" -- keras: {t_keras:.4f} sec")
+
+        for quantize, tolerance in TOLERANCES.items():
+            af.export_encoder_onnx(tmp_dir, "bench", quantize=quantize)
+            ts = time()
+            onnx_encodings = af.get_encoded_features_onnx(
+                quantize=quantize, n_threads=n_threads, **kwargs
+            )
+            t_onnx = time() - ts
+            max_diff = np.abs(onnx_encodings - keras_encodings).max() / scale
+            assert max_diff <= tolerance, (
+                f"ONNX ({quantize or 'fp32'}) encodings differ by {max_diff:.3g}"
+                f" of scale, above tolerance {tolerance}"
+            )
+            print(
+                f" -- onnx {quantize or 'fp32'}: {t_onnx:.4f} sec,"
+                f" speedup: {t_keras / max(t_onnx, 1e-9):.1f}x,"
+                f" max rel diff {max_diff:.2g} (tolerance {tolerance})"
+            )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Benchmark CPU inference of encoder")
+    parser.add_argument(
+        "-n",
+        "--n-hexes",
+        type=int,
+        help="Number of hexes to encode, default is 20000",
+        default=20000,
+    )
+    parser.add_argument(
+        "-b",
+        "--n-bands",
+        type=int,
+        help="Number of bands, default is 8",
+        default=8,
+    )
+    parser.add_argument(
+        "-d",
+        "--dim",
+        type=int,
+        help="Patch height and width in pixels, default is 16",
+        default=16,
+    )
+    parser.add_argument(
+        "-e",
+        "--epochs",
+        type=int,
+        help="Epochs to train benchmark autoencoder for, default is 1",
+        default=1,
+    )
+    parser.add_argument(
+        "-t",
+        "--n-threads",
+        type=int,
+        help="Inference threads for ONNX, default is number of cores",
+        default=None,
+    )
+    args = parser.parse_args()
+    main(args.n_hexes, args.n_bands, args.dim, args.epochs, args.n_threads)
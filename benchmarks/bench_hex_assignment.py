@@ -0,0 +1,78 @@
+"""Benchmark per-row h3 hex assignment (as previously used in
+process_geotiff.agg_tif_to_df) against the batched
+geospatial.geo_to_h3_array engine, and check results match exactly.
+"""
+import argparse
+from time import time
+
+import h3.api.numpy_int as h3
+import numpy as np
+import pandas as pd
+
+import stc_unicef_cpi.utils.geospatial as geo
+
+# rough bounding box of Nigeria (min lat, max lat, min long, max long)
+NGA_BBOX = (4.0, 14.0, 2.5, 14.5)
+
+
+def per_row_hex_codes(df, res):
+    """Previous approach: one python call to h3 per pixel"""
+    return df[["latitude", "longitude"]].apply(
+        lambda row: h3.geo_to_h3(row["latitude"], row["longitude"], res), axis=1
+    )
+
+
+def batched_hex_codes(df, res):
+    """Batched approach: whole arrays passed to h3 at once"""
+    return pd.Series(
+        geo.geo_to_h3_array(df["latitude"].values, df["longitude"].values, res).astype(
+            np.int64
+        ),
+        index=df.index,
+    )
+
+
+def main(n_points, res, seed=42):
+    rng = np.random.default_rng(seed)
+    min_lat, max_lat, min_long, max_long = NGA_BBOX
+    df = pd.DataFrame(
+        {
+            "latitude": rng.uniform(min_lat, max_lat, n_points),
+            "longitude": rng.uniform(min_long, max_long, n_points),
+        }
+    )
+
+    ts = time()
+    per_row = per_row_hex_codes(df, res)
+    t_row = time() - ts
+
+    ts = time()
+    batched = batched_hex_codes(df, res)
+    t_batch = time() - ts
+
+    assert (per_row.values == batched.values).all(), "Hex codes do not match"
+    print(f"{n_points} points at resolution {res}:")
+    print(f" -- per-row: {t_row:.4f} sec")
+    print(f" -- batched: {t_batch:.4f} sec")
+    print(f" -- speedup: {t_row / max(t_batch, 1e-9):.1f}x, results identical")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Benchmark h3 hex assignment of pixels")
+    parser.add_argument(
+        "-n",
+        "--n-points",
+        type=int,
+        help="Number of pixels to assign, default is 1e6",
+        default=int(1e6),
+    )
+    parser.add_argument(
+        "-r",
+        "--resolution",
+        type=int,
+        help="H3 resolution level, default is 7",
+        default=7,
+    )
+    args = parser.parse_args()
+    main(args.n_points, args.resolution)
@@ -0,0 +1,112 @@
+"""Benchmark extraction of image patches about hex centres, comparing
+a windowed read per hex (process_geotiff.extract_image_at_coords, as
+previously used by extract_ims_from_hex_codes) against the batched,
+block-grouped process_geotiff.extract_patches_at_coords, and check
+results match.
+"""
+import argparse
+import tempfile
+from pathlib import Path
+from time import time
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+import stc_unicef_cpi.data.process_geotiff as pg
+
+
+def write_raster(path, height, width, n_bands, seed=42):
+    rng = np.random.default_rng(seed)
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=n_bands,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(0.0, 10.0, 0.005, 0.005),
+        tiled=True,
+    ) as dst:
+        dst.write(rng.normal(size=(n_bands, height, width)).astype(np.float32))
+    return -0.005 * height + 10.0, 0.005 * width
+
+
+def per_hex(dataset, lats, longs, dim):
+    """Previous approach: one windowed read per hex, padding centred"""
+    ims = np.zeros((len(lats), dataset.count, dim, dim))
+    for idx, (lat, long) in enumerate(zip(lats, longs)):
+        im = pg.extract_image_at_coords(dataset, lat, long, dim, dim)
+        y_diff, x_diff = dim - im.shape[1], dim - im.shape[2]
+        ims[
+            idx,
+            :,
+            y_diff // 2 : y_diff // 2 + im.shape[1],
+            x_diff // 2 : x_diff // 2 + im.shape[2],
+        ] = im
+    return ims
+
+
+def main(n_hexes, height, width, n_bands, dim, seed=42):
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "bench.tif"
+        min_lat, max_long = write_raster(path, height, width, n_bands, seed)
+        lats = rng.uniform(min_lat, 10.0, n_hexes)
+        longs = rng.uniform(0.0, max_long, n_hexes)
+        with rasterio.open(path) as dataset:
+            ts = time()
+            slow = per_hex(dataset, lats, longs, dim)
+            t_slow = time() - ts
+
+            ts = time()
+            fast = pg.extract_patches_at_coords(dataset, lats, longs, dim, dim)
+            t_fast = time() - ts
+
+    assert np.array_equal(slow, fast), "Extracted patches do not match"
+    print(f"{n_hexes} patches of {dim}x{dim} from {n_bands} band {height}x{width}:")
+    print(f" -- per hex: {t_slow:.4f} sec")
+    print(f" -- batched: {t_fast:.4f} sec")
+    print(f" -- speedup: {t_slow / max(t_fast, 1e-9):.1f}x, results match")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser("Benchmark extraction of patches at hexes")
+    parser.add_argument(
+        "-n",
+        "--n-hexes",
+        type=int,
+        help="Number of patches to extract, default is 10000",
+        default=10000,
+    )
+    parser.add_argument(
+        "--height",
+        type=int,
+        help="Raster height in pixels, default is 2000",
+        default=2000,
+    )
+    parser.add_argument(
+        "--width",
+        type=int,
+        help="Raster width in pixels, default is 2000",
+        default=2000,
+    )
+    parser.add_argument(
+        "-b",
+        "--n-bands",
+        type=int,
+        help="Number of bands, default is 4",
+        default=4,
+    )
+    parser.add_argument(
+        "-d",
+        "--dim",
+        type=int,
+        help="Patch height and width in pixels, default is 16",
+        default=16,
+    )
+    args = parser.parse_args()
+    main(args.n_hexes, args.height, args.width, args.n_bands, args.dim)
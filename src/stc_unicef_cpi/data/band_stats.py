@@ -0,0 +1,208 @@
+"""Per-band normalisation statistics for image datasets, computed in a
+single streaming pass over all hexes (from tiffs or a patch store), so
+images can be standardised consistently and cheaply batch by batch,
+rather than fitting a scaler per batch or on the full dataset at once.
+
+Statistics are taken over all pixels of all (extracted) images, so
+include zero padding outside rasters, as seen by models."""
+from os import PathLike
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+
+import stc_unicef_cpi.data.process_geotiff as pg
+from stc_unicef_cpi.data.patch_store import PatchStore
+
+
+class BandStats:
+    """Mean and standard deviation of each band, and the constant
+    used to fill NaNs after standardising - twice the minimum
+    standardised value, negated if positive, so NaNs sit clearly
+    below all valid values.
+
+    :param mean: Mean of each band
+    :type mean: npt.NDArray
+    :param std: Standard deviation of each band (1 where constant)
+    :type std: npt.NDArray
+    :param fill_value: Value to replace NaNs with after standardising
+    :type fill_value: float
+    """
+
+    def __init__(self, mean: npt.NDArray, std: npt.NDArray, fill_value: float):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.fill_value = float(fill_value)
+
+    @property
+    def n_bands(self) -> int:
+        return len(self.mean)
+
+    def transform(
+        self, images: npt.NDArray, channels_last: bool = True, copy: bool = True
+    ) -> npt.NDArray:
+        """Standardise each band of images, and fill NaNs
+
+        :param images: Images, shape (n, i, j, band) or (n, band, i, j)
+        :type images: npt.NDArray
+        :param channels_last: Whether bands are last axis, defaults to True
+        :type channels_last: bool, optional
+        :param copy: Return new array, else transform (float) images in
+                     place, defaults to True
+        :type copy: bool, optional
+        :return: Standardised images
+        :rtype: npt.NDArray
+        """
+        if copy or not np.issubdtype(images.dtype, np.floating):
+            dtype = np.promote_types(images.dtype, np.float32)
+            images = images.astype(dtype)
+        shape = (-1,) if channels_last else (-1, 1, 1)
+        images -= self.mean.astype(images.dtype).reshape(shape)
+        images /= self.std.astype(images.dtype).reshape(shape)
+        return np.nan_to_num(images, copy=False, nan=self.fill_value)
+
+    def save(self, path: Union[str, PathLike]) -> None:
+        """Save stats to .npz file
+
+        :param path: Path to save to
+        :type path: Union[str, PathLike]
+        """
+        np.savez(path, mean=self.mean, std=self.std, fill_value=self.fill_value)
+
+    @classmethod
+    def load(cls, path: Union[str, PathLike]) -> "BandStats":
+        """Load stats saved with save
+
+        :param path: Path to .npz file
+        :type path: Union[str, PathLike]
+        :return: Band stats
+        :rtype: BandStats
+        """
+        with np.load(path) as stats:
+            return cls(stats["mean"], stats["std"], stats["fill_value"])
+
+    def __repr__(self) -> str:
+        return f"BandStats(n_bands={self.n_bands}, fill_value={self.fill_value:.3g})"
+
+
+def compute_band_stats(
+    batches: Iterable[npt.NDArray], channels_last: bool = True
+) -> BandStats:
+    """Compute per-band stats over batches of images in one pass,
+    merging per-batch means and sums of squared deviations (Chan et
+    al.) for numerical stability. NaNs are ignored.
+
+    :param batches: Batches of images, shape (n, i, j, band), or
+                    (n, band, i, j) if not channels_last
+    :type batches: Iterable[npt.NDArray]
+    :param channels_last: Whether bands are last axis, defaults to True
+    :type channels_last: bool, optional
+    :return: Band stats
+    :rtype: BandStats
+    """
+    count = mean = m2 = minimum = None
+    for batch in batches:
+        if not channels_last:
+            batch = np.moveaxis(batch, 1, -1)
+        values = np.asarray(batch, dtype=np.float64).reshape(-1, batch.shape[-1])
+        valid = ~np.isnan(values)
+        b_count = valid.sum(axis=0)
+        b_sum = np.where(valid, values, 0).sum(axis=0)
+        b_mean = np.divide(b_sum, b_count, out=np.zeros_like(b_sum), where=b_count > 0)
+        b_m2 = np.where(valid, (values - b_mean) ** 2, 0).sum(axis=0)
+        b_min = np.fmin.reduce(values, axis=0)
+        if count is None:
+            count, mean, m2 = b_count, b_mean, b_m2
+            minimum = b_min
+            continue
+        total = count + b_count
+        delta = b_mean - mean
+        frac = np.divide(b_count, total, out=np.zeros_like(delta), where=total > 0)
+        mean = mean + delta * frac
+        m2 = m2 + b_m2 + delta**2 * count * frac
+        count = total
+        minimum = np.fmin(minimum, b_min)
+    if count is None:
+        raise ValueError("No images to compute band stats from")
+
+    var = np.divide(m2, count, out=np.zeros_like(m2), where=count > 0)
+    std = np.sqrt(var)
+    # as StandardScaler, leave constant bands unscaled
+    std[std == 0] = 1.0
+    with np.errstate(invalid="ignore"):
+        lower_bound = np.fmin.reduce((minimum - mean) / std)
+    if np.isnan(lower_bound):
+        fill_value = 0.0
+    elif lower_bound < 0:
+        fill_value = 2 * lower_bound
+    else:
+        fill_value = -2 * lower_bound
+    return BandStats(mean, std, fill_value)
+
+
+def band_stats_from_store(store: PatchStore, batch_size: int = 4096) -> BandStats:
+    """Compute per-band stats over all images in a patch store
+
+    :param store: Patch store
+    :type store: PatchStore
+    :param batch_size: Number of images read at a time, defaults to 4096
+    :type batch_size: int, optional
+    :return: Band stats
+    :rtype: BandStats
+    """
+    patches = store.get()
+    return compute_band_stats(
+        patches[start : start + batch_size]
+        for start in range(0, len(patches), batch_size)
+    )
+
+
+def band_stats_from_tiffs(
+    tif_files: Union[List[str], List[PathLike]],
+    hex_codes: Union[List[int], npt.NDArray[np.int64]],
+    width: int = 16,
+    height: int = 16,
+    batch_size: int = 4096,
+) -> BandStats:
+    """Compute per-band stats over images about each hex extracted from
+    tiff files, a batch of hexes at a time
+
+    :param tif_files: Tiff files to extract (and stack) bands from
+    :type tif_files: Union[List[str], List[PathLike]]
+    :param hex_codes: Hex codes to extract images about
+    :type hex_codes: Union[List[int], npt.NDArray[np.int64]]
+    :param width: Image width in pixels, defaults to 16
+    :type width: int, optional
+    :param height: Image height in pixels, defaults to 16
+    :type height: int, optional
+    :param batch_size: Number of hexes per batch, defaults to 4096
+    :type batch_size: int, optional
+    :return: Band stats
+    :rtype: BandStats
+    """
+    with pg.reusing_open_datasets():
+        datasets = [pg.get_open_dataset(tif_file) for tif_file in tif_files]
+        return compute_band_stats(
+            pg.extract_ims_from_hex_codes(
+                datasets,
+                hex_codes[start : start + batch_size],
+                width=width,
+                height=height,
+                channels_last=True,
+            )
+            for start in range(0, len(hex_codes), batch_size)
+        )
+
+
+def load_band_stats(path: Union[str, PathLike]) -> Optional[BandStats]:
+    """Load band stats if saved at path
+
+    :param path: Path to .npz file
+    :type path: Union[str, PathLike]
+    :return: Band stats, or None if no file at path
+    :rtype: Optional[BandStats]
+    """
+    try:
+        return BandStats.load(path)
+    except FileNotFoundError:
+        return None
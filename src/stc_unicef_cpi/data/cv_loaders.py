@@ -1,7 +1,7 @@
 import warnings
 from math import asin, cos, radians, sin, sqrt
 from pathlib import Path
-from typing import Iterator, List, Tuple, Union
+from typing import Iterator, List, Optional, Tuple, Union
 
 import h3.api.numpy_int as h3
 import numpy as np
@@ -18,6 +18,8 @@ from sklearn.utils.validation import column_or_1d
 from tensorflow import keras
 
 import stc_unicef_cpi.data.process_geotiff as pg
+from stc_unicef_cpi.data.band_stats import BandStats
+from stc_unicef_cpi.data.patch_store import PatchStore
 
 
 class KerasDataGenerator(keras.utils.Sequence):
@@ -32,8 +34,37 @@ class KerasDataGenerator(keras.utils.Sequence):
         data_files: Union[List[str], List[Path]] = None,
         # n_classes=10,
         shuffle=True,
+        patch_store: Optional[PatchStore] = None,
+        band_stats: Optional[BandStats] = None,
     ):
-        "Initialization"
+        """Initialization - images are read from patch_store if given,
+        else extracted from the GeoTIFF (or raster stack) data_files,
+        with bands of any npy data_files appended. Bands are
+        standardised by band_stats if given (as in training), else
+        per batch.
+
+        :param hex_idxs: Hex codes to generate images for
+        :type hex_idxs: np.ndarray
+        :param batch_size: Number of images per batch, defaults to 32
+        :type batch_size: int, optional
+        :param dim: Height and width of images, defaults to (16, 16)
+        :type dim: tuple, optional
+        :param data_files: GeoTIFF (.tif), raster stack (.vrt, see
+                           raster_stack) and npy files, the latter of
+                           shape (len(hex_idxs), *dim, bands) in the
+                           order of hex_idxs, defaults to None
+        :type data_files: Union[List[str], List[Path]], optional
+        :param shuffle: Shuffle hexes each epoch, defaults to True
+        :type shuffle: bool, optional
+        :param patch_store: Store containing images of all hex_idxs, read
+                            in place of tiff data_files, defaults to None
+        :type patch_store: Optional[PatchStore], optional
+        :param band_stats: Stats to standardise bands with, defaults to
+                           None (standardise per batch)
+        :type band_stats: Optional[BandStats], optional
+        :raises ValueError: If dim, data_files, patch_store or band_stats
+                            do not match
+        """
         try:
             assert len(dim) == 2
             self.dim = dim
@@ -45,9 +76,13 @@ class KerasDataGenerator(keras.utils.Sequence):
         # self.labels = labels
         self.hex_idxs = hex_idxs
         # self.idxs = np.arange(len(self.hex_idxs))
-        data_files = list(map(Path, data_files))  # type: ignore
-        # assume GeoTIFF files listed, and end in '.tif'
-        self.tif_files = [file for file in data_files if file.suffix == ".tif"]
+        self.patch_store = patch_store
+        data_files = list(map(Path, data_files or []))  # type: ignore
+        # assume GeoTIFF files listed, and end in '.tif', or raster
+        # stacks, ending in '.vrt', read in the same way
+        self.tif_files = [
+            file for file in data_files if file.suffix in (".tif", ".vrt")
+        ]
         # assume npy files are only other type of data, and the order
         # matches the order of hex_idxs - this allows memory mapped
         # reading from disk
@@ -57,19 +92,35 @@ class KerasDataGenerator(keras.utils.Sequence):
             assert set(self.tif_files).union(set(self.np_files)) == set(data_files)
         except AssertionError:
             raise ValueError(
-                "data_files must be a list of GeoTIFF (.tif) and npy files only"
-            )
-        if len(self.np_files) > 0:
-            raise NotImplementedError(
-                "npy files not yet implemented - currently just loader for tif files for DL pipeline"
+                "data_files must be a list of GeoTIFF (.tif), raster stack (.vrt) and npy files only"
             )
-        # np.load(file,mmap_mode='r')
+        self.np_arrays = [np.load(file, mmap_mode="r") for file in self.np_files]
+        for np_arr in self.np_arrays:
+            if np_arr.shape[:3] != (len(hex_idxs), *dim):
+                raise ValueError(
+                    f"npy files must have shape {(len(hex_idxs), *dim)} + (bands,)"
+                )
 
-        nbands = 0
-        for tif_file in self.tif_files:
-            with rasterio.open(tif_file) as open_file:
-                nbands += len(open_file.indexes)
+        if patch_store is not None:
+            if patch_store.shape[1:3] != tuple(dim):
+                raise ValueError("patch_store must contain images of shape dim")
+            # check all hexes present up front
+            patch_store.indices(hex_idxs)
+            nbands = patch_store.n_channels
+        else:
+            nbands = 0
+            for tif_file in self.tif_files:
+                with rasterio.open(tif_file) as open_file:
+                    nbands += len(open_file.indexes)
+        # bands of npy files are appended to those of the store or tiffs
+        for np_arr in self.np_arrays:
+            nbands += np_arr.shape[-1]
         self.n_channels = nbands
+        if band_stats is not None and band_stats.n_bands != self.n_channels:
+            raise ValueError(
+                f"band_stats for {band_stats.n_bands} bands, but {self.n_channels} found"
+            )
+        self.band_stats = band_stats
         # self.n_classes = n_classes
         self.shuffle = shuffle
 
@@ -94,6 +145,9 @@ class KerasDataGenerator(keras.utils.Sequence):
 
     def on_epoch_end(self):
         "Updates indexes after each epoch"
+        # all batches of the epoch are read, so close datasets opened
+        # by workers, releasing handles (and any rewritten files)
+        pg.close_open_datasets(all_threads=True)
         self.idxs = np.arange(len(self.hex_idxs))
         if self.shuffle == True:
             np.random.shuffle(self.idxs)
@@ -106,12 +160,27 @@ class KerasDataGenerator(keras.utils.Sequence):
         # y = np.empty((self.batch_size), dtype=self.labels.dtype)
 
         # Generate data
-        # by default in shape (image_idx,band,i,j), so permute to (idx,i,j,band)
-        X = pg.extract_ims_from_hex_codes(
-            self.tif_files, hex_idxs, width=self.dim[1], height=self.dim[0]
-        ).transpose((0, 2, 3, 1))
+        if self.patch_store is not None:
+            X = self.patch_store.get(hex_idxs)
+        else:
+            # extract directly in shape (idx,i,j,band), reusing datasets
+            # already open in this worker
+            X = pg.extract_ims_from_hex_codes(
+                [pg.get_open_dataset(tif_file) for tif_file in self.tif_files],
+                hex_idxs,
+                width=self.dim[1],
+                height=self.dim[0],
+                channels_last=True,
+            )
+        if len(self.np_arrays) > 0:
+            X = np.concatenate(
+                [X] + [np_arr[idxs] for np_arr in self.np_arrays], axis=-1
+            )
         # y = self.labels[idxs]
 
+        if self.band_stats is not None:
+            return self.band_stats.transform(X, copy=False)
+
         shape = X.shape
         X = StandardScaler().fit_transform(X.reshape(X.shape[0], -1))
         X = X.reshape(shape)
@@ -0,0 +1,537 @@
+"""Pixel to h3 hex assignment for raster grids, with a cache of
+per-pixel hex labels so that all rasters sharing a grid (CRS,
+transform, shape) only need hex codes computed once per resolution.
+
+Also provides the fractional coverage of hexes by pixels, as a
+sparse pixel-hex matrix, for when pixels are too coarse relative
+to hexes for assignment by pixel centre to be sensible."""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from os import PathLike
+from pathlib import Path
+from typing import Any, Iterator, Optional, Tuple, Union
+
+import h3.api.numpy_int as h3
+import numpy as np
+import numpy.typing as npt
+import rasterio
+from affine import Affine
+from pyproj import Transformer
+from rasterio.windows import Window
+from scipy import sparse
+from tqdm.auto import tqdm
+
+import stc_unicef_cpi.utils.geospatial as geo
+
+
+class _LRUCache:
+    """Small process-wide cache, dropping the least recently used
+    entries beyond maxsize, so memory does not grow with the number
+    of grids seen (e.g. over a multi-country run)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key: str, item: Any) -> None:
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+# label rasters, keyed by grid_key - those loaded from cache_dir are
+# memory-mapped, so cheap to hold, but computed ones are in memory
+_LABEL_CACHE = _LRUCache(maxsize=8)
+# coverage matrices, keyed by grid_key and n_sub
+_COVERAGE_CACHE = _LRUCache(maxsize=4)
+
+
+def iter_row_strips(
+    raster: rasterio.io.DatasetReader, strip_height: int = 512
+) -> Iterator[Window]:
+    """Iterate over full-width strips of rows of a raster,
+    with heights rounded to a multiple of the internal block
+    height so that each block is read only once.
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param strip_height: Approximate number of rows per strip, defaults to 512
+    :type strip_height: int, optional
+    :yield: Window for each strip
+    :rtype: Iterator[Window]
+    """
+    block_height = raster.block_shapes[0][0]
+    strip_height = max(block_height, (strip_height // block_height) * block_height)
+    for row_off in range(0, raster.height, strip_height):
+        yield Window(
+            0, row_off, raster.width, min(strip_height, raster.height - row_off)
+        )
+
+
+def strip_height_for_memory(
+    raster: rasterio.io.DatasetReader,
+    memory_limit: int,
+    bytes_per_value: int = 32,
+) -> int:
+    """Number of rows per strip such that processing a full-width
+    strip of all bands of a raster should fit within memory_limit
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param memory_limit: Memory available for each strip, in bytes
+    :type memory_limit: int
+    :param bytes_per_value: Working memory used per pixel value, allowing
+                            for float64 copies, masks and temporaries,
+                            defaults to 32
+    :type bytes_per_value: int, optional
+    :return: Rows per strip, at least one block in height
+    :rtype: int
+    """
+    bytes_per_row = raster.width * raster.count * bytes_per_value
+    return max(raster.block_shapes[0][0], int(memory_limit // bytes_per_row))
+
+
+def pixel_coords(
+    transform: Affine,
+    rows: npt.NDArray,
+    cols: npt.NDArray,
+    offset: Union[float, npt.NDArray] = 0.5,
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """Find coordinates (in raster CRS) of points in pixels, as a single
+    array operation on the affine transform
+
+    :param transform: Affine transform of raster (to upper left pixel corners)
+    :type transform: Affine
+    :param rows: Pixel row indices (broadcastable with cols)
+    :type rows: npt.NDArray
+    :param cols: Pixel column indices
+    :type cols: npt.NDArray
+    :param offset: Position of points within pixels, as fraction of
+                   pixel size from upper left corner, either a scalar
+                   or array of shape (2,) for (row, col), defaults to
+                   0.5 (pixel centres)
+    :type offset: Union[float, npt.NDArray], optional
+    :return: Eastings and northings of points
+    :rtype: Tuple[npt.NDArray, npt.NDArray]
+    """
+    row_offset, col_offset = np.broadcast_to(offset, (2,))
+    # Affine transform for points at offset in each pixel (centres by default)
+    T1 = transform * Affine.translation(col_offset, row_offset)
+    eastings = cols * T1.a + rows * T1.b + T1.c
+    northings = cols * T1.d + rows * T1.e + T1.f
+    return eastings, northings
+
+
+def window_hex_codes(
+    raster: rasterio.io.DatasetReader,
+    window: Window,
+    resolution: int,
+    transformer: Optional[Transformer] = None,
+    offset: Union[float, npt.NDArray] = 0.5,
+) -> npt.NDArray:
+    """Find h3 hex code of the centre of each pixel in a
+    window of a raster (or of other points within each pixel)
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param window: Window of raster
+    :type window: Window
+    :param resolution: Resolution of H3 grid
+    :type resolution: int
+    :param transformer: Transformer from raster CRS to EPSG:4326,
+                        defaults to None (shared transformer for raster CRS)
+    :type transformer: Optional[Transformer], optional
+    :param offset: Position of points within pixels, as fraction of
+                   pixel size from upper left corner, either a scalar
+                   or array of shape (2,) for (row, col), defaults to
+                   0.5 (pixel centres)
+    :type offset: Union[float, npt.NDArray], optional
+    :return: Hex codes in shape (window height, window width)
+    :rtype: npt.NDArray
+    """
+    if transformer is None:
+        transformer = geo.get_transformer(raster.crs)
+    rows = np.arange(window.row_off, window.row_off + window.height)[:, np.newaxis]
+    cols = np.arange(window.col_off, window.col_off + window.width)[np.newaxis, :]
+    eastings, northings = pixel_coords(raster.transform, rows, cols, offset)
+    longs, lats = transformer.transform(eastings, northings)
+    return geo.geo_to_h3_array(lats, longs, resolution).astype(np.int64)
+
+
+def _save_atomic(path: Path, array: npt.NDArray) -> None:
+    """Save array to .npy file via a temporary file, so that other
+    processes never read a partially written file
+
+    :param path: Path to save to
+    :type path: Path
+    :param array: Array to save
+    :type array: npt.NDArray
+    """
+    tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def grid_key(raster: rasterio.io.DatasetReader, resolution: int) -> str:
+    """Unique key for the grid of a raster (CRS, transform and shape)
+    at a given h3 resolution
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param resolution: Resolution of H3 grid
+    :type resolution: int
+    :return: Hash of grid specification
+    :rtype: str
+    """
+    crs = raster.crs.to_wkt() if raster.crs is not None else "EPSG:4326"
+    spec = repr(
+        (crs, tuple(raster.transform)[:6], (raster.height, raster.width), resolution)
+    )
+    return hashlib.sha1(spec.encode()).hexdigest()[:16]
+
+
+def check_same_grid(
+    raster: rasterio.io.DatasetReader, other: rasterio.io.DatasetReader
+) -> None:
+    """Check two rasters share the same grid (CRS, transform and
+    shape), so that pixels in matching windows coincide
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param other: Open rasterio dataset to compare
+    :type other: rasterio.io.DatasetReader
+    :raises ValueError: If grids differ
+    """
+    if grid_key(raster, 0) != grid_key(other, 0):
+        raise ValueError(
+            f"Grid of {other.name} does not match that of {raster.name} - "
+            "reproject to matching grid first, e.g. with rxr_reproject_tiff_to_target"
+        )
+
+
+class HexLabelRaster:
+    """Hex assignment of every pixel of a raster grid, stored as
+    an int32 index into a sorted table of hex codes (-1 where
+    pixel centre has no valid hex).
+
+    :param labels: Label of each pixel, shape (height, width)
+    :type labels: npt.NDArray
+    :param hex_codes: Sorted unique hex codes (numpy_int form)
+    :type hex_codes: npt.NDArray
+    """
+
+    def __init__(self, labels: npt.NDArray, hex_codes: npt.NDArray):
+        self.labels = labels
+        self.hex_codes = hex_codes
+
+    @property
+    def n_hexes(self) -> int:
+        return len(self.hex_codes)
+
+    def window(self, window: Window) -> npt.NDArray:
+        """Labels of pixels within window
+
+        :param window: Window of raster grid
+        :type window: Window
+        :return: Labels in shape (window height, window width)
+        :rtype: npt.NDArray
+        """
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        return self.labels[row_start:row_stop, col_start:col_stop]
+
+
+def get_hex_labels(
+    raster: rasterio.io.DatasetReader,
+    resolution: int,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    strip_height: int = 512,
+    verbose: bool = False,
+) -> HexLabelRaster:
+    """Get hex labels for every pixel of a raster, reusing
+    those already computed for the same grid where possible:
+    first from the in-process cache, then from memory-mapped
+    files in cache_dir, else computing (and saving) them.
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param resolution: Resolution of H3 grid
+    :type resolution: int
+    :param cache_dir: Directory for persistent label files, defaults to
+                      None (only cache in memory for this process)
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param strip_height: Approximate number of rows per strip when
+                         computing labels, defaults to 512
+    :type strip_height: int, optional
+    :param verbose: Verbose, defaults to False
+    :type verbose: bool, optional
+    :return: Label raster for grid of given raster
+    :rtype: HexLabelRaster
+    """
+    key = grid_key(raster, resolution)
+    label_rast = _LABEL_CACHE.get(key)
+    if label_rast is not None:
+        return label_rast
+
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        labels_path = cache_dir / f"{key}_labels.npy"
+        hexes_path = cache_dir / f"{key}_hexes.npy"
+        if labels_path.exists() and hexes_path.exists():
+            if verbose:
+                print(f"Loading cached hex labels for grid {key}...")
+            label_rast = HexLabelRaster(
+                np.load(labels_path, mmap_mode="r"), np.load(hexes_path)
+            )
+            _LABEL_CACHE.put(key, label_rast)
+            return label_rast
+
+    if verbose:
+        print(f"Computing hex labels for grid {key}...")
+    shape = (raster.height, raster.width)
+    transformer = geo.get_transformer(raster.crs)
+    windows = list(iter_row_strips(raster, strip_height))
+    # first pass: hex code of every pixel, and set of unique hexes
+    if cache_dir is not None:
+        # temporary files are per process, as may run in parallel
+        codes_path = cache_dir / f"{key}_codes.{os.getpid()}.tmp.npy"
+        codes = np.lib.format.open_memmap(
+            codes_path, mode="w+", dtype=np.int64, shape=shape
+        )
+    else:
+        codes = np.empty(shape, dtype=np.int64)
+    strip_hexes = []
+    for window in tqdm(windows, desc="Hex label progress:", disable=not verbose):
+        (row_start, row_stop), _ = window.toranges()
+        strip_codes = window_hex_codes(raster, window, resolution, transformer)
+        codes[row_start:row_stop] = strip_codes
+        strip_hexes.append(np.unique(strip_codes))
+    hex_codes = np.unique(np.concatenate(strip_hexes))
+    # code 0 corresponds to invalid coords
+    hex_codes = hex_codes[hex_codes != 0]
+
+    # second pass: convert codes to dense labels
+    if cache_dir is not None:
+        tmp_labels_path = cache_dir / f"{key}_labels.{os.getpid()}.tmp.npy"
+        labels = np.lib.format.open_memmap(
+            tmp_labels_path, mode="w+", dtype=np.int32, shape=shape
+        )
+    else:
+        labels = np.empty(shape, dtype=np.int32)
+    for window in windows:
+        (row_start, row_stop), _ = window.toranges()
+        strip_codes = codes[row_start:row_stop]
+        strip_labels = np.searchsorted(hex_codes, strip_codes).astype(np.int32)
+        strip_labels[strip_codes == 0] = -1
+        labels[row_start:row_stop] = strip_labels
+    del codes
+
+    if cache_dir is not None:
+        labels.flush()
+        del labels
+        _save_atomic(hexes_path, hex_codes)
+        # write labels last, under final name, so partial runs are never reused
+        os.replace(tmp_labels_path, labels_path)
+        os.remove(codes_path)
+        labels = np.load(labels_path, mmap_mode="r")
+
+    label_rast = HexLabelRaster(labels, hex_codes)
+    _LABEL_CACHE.put(key, label_rast)
+    return label_rast
+
+
+class HexCoverage:
+    """Fractional coverage of every pixel of a raster grid by
+    h3 hexes, stored as a sparse CSR matrix of shape (n_pixels,
+    n_hexes), with pixels in row-major order and each entry the
+    (approximate) fraction of the pixel's area within the hex.
+
+    :param matrix: Sparse pixel-hex coverage matrix
+    :type matrix: sparse.csr_matrix
+    :param hex_codes: Sorted unique hex codes (numpy_int form)
+    :type hex_codes: npt.NDArray
+    :param width: Width of raster grid, in pixels
+    :type width: int
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, hex_codes: npt.NDArray, width: int):
+        self.matrix = matrix
+        self.hex_codes = hex_codes
+        self.width = width
+
+    @property
+    def n_hexes(self) -> int:
+        return len(self.hex_codes)
+
+    def window(self, window: Window) -> sparse.csr_matrix:
+        """Coverage of pixels within a full-width window of rows
+
+        :param window: Window of raster grid, spanning all columns
+        :type window: Window
+        :return: Sparse coverage matrix of shape (window pixels, n_hexes)
+        :rtype: sparse.csr_matrix
+        """
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        assert col_start == 0 and col_stop == self.width
+        return self.matrix[row_start * self.width : row_stop * self.width]
+
+
+def auto_n_sub(raster: rasterio.io.DatasetReader, resolution: int) -> int:
+    """Choose number of sample points per pixel side so that hexes
+    at given resolution are each sampled several times per side,
+    based on the size of the central pixel of the raster
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param resolution: Resolution of H3 grid
+    :type resolution: int
+    :return: Number of samples per pixel side, between 1 and 32
+    :rtype: int
+    """
+    transformer = geo.get_transformer(raster.crs)
+    row, col = raster.height // 2, raster.width // 2
+    corners = np.array(
+        [raster.transform * (col, row), raster.transform * (col + 1, row + 1)]
+    )
+    longs, lats = transformer.transform(corners[:, 0], corners[:, 1])
+    # diagonal of pixel, in km
+    pixel_km = h3.point_dist((lats[0], longs[0]), (lats[1], longs[1]), unit="km")
+    edge_km = h3.edge_length(resolution, unit="km")
+    return int(np.clip(np.ceil(2 * pixel_km / edge_km), 1, 32))
+
+
+def get_hex_coverage(
+    raster: rasterio.io.DatasetReader,
+    resolution: int,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    n_sub: Optional[int] = None,
+    strip_height: int = 512,
+    verbose: bool = False,
+) -> HexCoverage:
+    """Get fractional coverage of every pixel of a raster by hexes,
+    reusing that already computed for the same grid where possible:
+    first from the in-process cache, then from files in cache_dir,
+    else computing (and saving) it.
+
+    Coverage is estimated by sampling an n_sub x n_sub grid of points
+    within each pixel, and finding the hex of each point, so that
+    hexes smaller than pixels still receive (a share of) their values.
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param resolution: Resolution of H3 grid
+    :type resolution: int
+    :param cache_dir: Directory for persistent coverage files, defaults to
+                      None (only cache in memory for this process)
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param n_sub: Number of sample points per pixel side, defaults to None
+                  (choose from relative size of pixels and hexes)
+    :type n_sub: Optional[int], optional
+    :param strip_height: Number of rows per strip when computing coverage
+                         with one sample per pixel, divided by n_sub**2
+                         for more samples, defaults to 512
+    :type strip_height: int, optional
+    :param verbose: Verbose, defaults to False
+    :type verbose: bool, optional
+    :return: Coverage for grid of given raster
+    :rtype: HexCoverage
+    """
+    if n_sub is None:
+        n_sub = auto_n_sub(raster, resolution)
+    key = f"{grid_key(raster, resolution)}_cov{n_sub}"
+    coverage = _COVERAGE_CACHE.get(key)
+    if coverage is not None:
+        return coverage
+
+    if cache_dir is not None:
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        matrix_path = cache_dir / f"{key}.npz"
+        hexes_path = cache_dir / f"{key}_hexes.npy"
+        if matrix_path.exists() and hexes_path.exists():
+            if verbose:
+                print(f"Loading cached hex coverage for grid {key}...")
+            coverage = HexCoverage(
+                sparse.load_npz(matrix_path).tocsr(),
+                np.load(hexes_path),
+                raster.width,
+            )
+            _COVERAGE_CACHE.put(key, coverage)
+            return coverage
+
+    if verbose:
+        print(f"Computing hex coverage for grid {key} with {n_sub}x{n_sub} samples...")
+    transformer = geo.get_transformer(raster.crs)
+    offsets = (np.arange(n_sub) + 0.5) / n_sub
+    # memory scales with samples rather than pixels per strip, and no
+    # pixels are read, so strips need not align with blocks
+    strip_rows = max(1, strip_height // n_sub**2)
+    strip_entries = []
+    for row_start in tqdm(
+        range(0, raster.height, strip_rows),
+        desc="Hex coverage progress:",
+        disable=not verbose,
+    ):
+        row_stop = min(row_start + strip_rows, raster.height)
+        window = Window(0, row_start, raster.width, row_stop - row_start)
+        strip_pix = np.arange(row_start * raster.width, row_stop * raster.width)
+        pix_idxs, sample_codes = [], []
+        for row_offset in offsets:
+            for col_offset in offsets:
+                codes = window_hex_codes(
+                    raster,
+                    window,
+                    resolution,
+                    transformer,
+                    offset=np.array([row_offset, col_offset]),
+                ).reshape(-1)
+                valid = codes != 0
+                pix_idxs.append(strip_pix[valid])
+                sample_codes.append(codes[valid])
+        # count samples of each (pixel, hex) pair within strip
+        pairs, n_samples = np.unique(
+            np.stack([np.concatenate(pix_idxs), np.concatenate(sample_codes)]),
+            axis=1,
+            return_counts=True,
+        )
+        strip_entries.append((pairs[0], pairs[1], n_samples))
+    pix_idxs, sample_codes, n_samples = (
+        np.concatenate(entries) for entries in zip(*strip_entries)
+    )
+    del strip_entries
+    hex_codes = np.unique(sample_codes)
+    matrix = sparse.csr_matrix(
+        (
+            (n_samples / n_sub**2).astype(np.float32),
+            (pix_idxs, np.searchsorted(hex_codes, sample_codes)),
+        ),
+        shape=(raster.height * raster.width, len(hex_codes)),
+    )
+    del pix_idxs, sample_codes, n_samples
+
+    if cache_dir is not None:
+        _save_atomic(hexes_path, hex_codes)
+        # write matrix last, under final name, so partial runs are never reused
+        tmp_matrix_path = cache_dir / f"{key}.{os.getpid()}.tmp.npz"
+        sparse.save_npz(tmp_matrix_path, matrix)
+        os.replace(tmp_matrix_path, matrix_path)
+
+    coverage = HexCoverage(matrix, hex_codes, raster.width)
+    _COVERAGE_CACHE.put(key, coverage)
+    return coverage
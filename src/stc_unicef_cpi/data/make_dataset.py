@@ -7,14 +7,12 @@ import warnings
 from functools import partial, reduce
 from pathlib import Path
 
-import cartopy.io.shapereader as shpreader
 import geopandas as gpd
 import h3.api.numpy_int as h3
 import numpy as np
 import pandas as pd
 import pycountry
 import rasterio
-import rioxarray as rxr
 import shapely.wkt
 import tensorflow as tf
 from art import tprint
@@ -23,10 +21,12 @@ from rich import print
 import stc_unicef_cpi.data.get_osm_data as osm
 import stc_unicef_cpi.data.process_geotiff as pg
 import stc_unicef_cpi.data.process_netcdf as net
+import stc_unicef_cpi.data.raster_stack as rs
 import stc_unicef_cpi.utils.constants as c
 import stc_unicef_cpi.utils.general as g
 import stc_unicef_cpi.utils.geospatial as geo
 from stc_unicef_cpi.data.stream_data import RunStreamer
+from stc_unicef_cpi.utils.backends import get_backend
 
 try:
     from stc_unicef_cpi.features import get_autoencoder_features as gaf
@@ -171,9 +171,10 @@ def create_target_variable(
 
 
 def change_name_reproject_tiff(
-    tiff, attribute, country, read_dir=c.ext_data, out_dir=c.int_data
+    tiff, attribute, country, read_dir=c.ext_data, out_dir=c.int_data, fname=None
 ) -> None:
-    """Rename attributes and reprojection of Tiff file
+    """Clip tiff file to country, reproject to population grid and
+    rename attributes, in a single pass
     :param tiff: path to tiff file
     :type tiff: str
     :param attributes: attributes names
@@ -182,25 +183,32 @@ def change_name_reproject_tiff(
     :type country: str
     :param read_dir: path to read external data from, defaults to c.ext_data
     :type read_dir: str, optional
+    :param out_dir: path to save data, defaults to c.int_data
+    :type out_dir: str, optional
+    :param fname: name of output file, defaults to None (name of tiff)
+    :type fname: str, optional
     """
-    with rxr.open_rasterio(tiff) as data:
+    gee_dir = Path(read_dir) / "gee"
+    if not gee_dir.exists():
+        raise FileNotFoundError(
+            f"Must have GEE data available in {gee_dir} - currently must manually download there from Google Drive."
+        )
+    if fname is None:
         fname = Path(tiff).name
-        data.attrs["long_name"] = attribute
-        data.rio.to_raster(tiff)
-        try:
-            gee_dir = Path(read_dir) / "gee"
-            assert gee_dir.exists()
-        except AssertionError:
-            raise FileNotFoundError(
-                f"Must have GEE data available in {gee_dir} - currently must manually download there from Google Drive."
-            )
-    p_r = Path(read_dir) / "gee" / f"cpi_poptotal_{country.lower()}_500.tif"
-    pg.rxr_reproject_tiff_to_target(tiff, p_r, Path(out_dir) / fname, verbose=True)
+    p_r = gee_dir / f"cpi_poptotal_{country.lower()}_500.tif"
+    pg.clip_reproject_to_target(
+        tiff,
+        p_r,
+        Path(out_dir) / fname,
+        ctry_name=country,
+        band_names=attribute,
+        verbose=True,
+    )
 
 
 @g.timing
 def preprocessed_tiff_files(
-    country, read_dir=c.ext_data, out_dir=c.int_data, force=False
+    country, read_dir=c.ext_data, out_dir=c.int_data, force=False, backend=None
 ) -> None:
     """Preprocess tiff files
 
@@ -212,7 +220,10 @@ def preprocessed_tiff_files(
     :type out_dir: str, optional
     :param force: force clipping, defaults to False
     :type force: bool, optional
+    :param backend: execution backend to process files on, defaults to None (serial)
+    :type backend: ExecutionBackend, optional
     """
+    backend = get_backend(backend)
     g.create_folder(out_dir)
     # clip gdp ppp 30 arc sec
     print(" -- Clipping gdp pp 30 arc sec")
@@ -221,40 +232,30 @@ def preprocessed_tiff_files(
             Path(read_dir) / "gdp_ppp_30.nc", ctry_name=country, save_dir=read_dir
         )
 
-    # clip ec and gdp
-    print(" -- Clipping ec and gdp")
+    # clip ec and gdp, reproject resolution + crs, in a single pass
+    print(" -- Clipping and reprojecting resolution & crs of ec and gdp")
     tifs = glob.glob(str(Path(read_dir) / "*" / "*" / "2019" / "*.tif"))
-    if (
-        not all(
-            [
-                (
-                    Path(read_dir) / (country.lower() + "_" + str(Path(tif).name))
-                ).exists()
-                for tif in tifs
-            ]
-        )
-        or force
-    ):
-        partial_func = partial(
-            pg.clip_tif_to_ctry, ctry_name=country, save_dir=read_dir
-        )
-        list(map(partial_func, tifs))
-
-    # reproject resolution + crs
-    print(" -- Reprojecting resolution & determining crs")
-    econ_tiffs = sorted(glob.glob(str(Path(read_dir) / f"{country.lower()}_*.tif")))
-    econ_tiffs = [ele for ele in econ_tiffs if "africa" not in ele]
-    if (
-        not all([(Path(out_dir) / Path(fname).name).exists() for fname in econ_tiffs])
-        or force
-    ):
+    econ_tiffs = {(country + "_" + Path(tif).name).lower(): tif for tif in tifs}
+    gdp_ppp_30 = Path(read_dir) / (country.lower() + "_gdp_ppp_30.tif")
+    econ_tiffs[gdp_ppp_30.name] = gdp_ppp_30
+    # attributes in order of (country prefixed) file names
+    econ_fnames = sorted(econ_tiffs)
+    if not all([(Path(out_dir) / fname).exists() for fname in econ_fnames]) or force:
         attributes = [
             ["gdp_2019"],
             ["ec_2019"],
             ["gdp_ppp_1990", "gdp_ppp_2000", "gdp_ppp_2015"],
         ]
-        mapfunc = partial(change_name_reproject_tiff, country=country)
-        list(map(mapfunc, econ_tiffs, attributes))
+        n_tiffs = len(econ_fnames)
+        backend.map(
+            change_name_reproject_tiff,
+            [econ_tiffs[fname] for fname in econ_fnames],
+            attributes,
+            [country] * n_tiffs,
+            [read_dir] * n_tiffs,
+            [out_dir] * n_tiffs,
+            econ_fnames,
+        )
 
     # critical infrastructure data
     print(" -- Reprojecting critical infrastructure data")
@@ -264,10 +265,9 @@ def preprocessed_tiff_files(
         cisi = glob.glob(str(Path(read_dir) / "*" / "*" / "010_degree" / "africa.tif"))[
             0
         ]
-        pg.clip_tif_to_ctry(cisi, ctry_name=country, save_dir=read_dir)
         p_r = Path(read_dir) / "gee" / f"cpi_poptotal_{country.lower()}_500.tif"
-        pg.rxr_reproject_tiff_to_target(
-            cisi_ctry, p_r, Path(out_dir) / fname, verbose=True
+        pg.clip_reproject_to_target(
+            cisi, p_r, Path(out_dir) / fname, ctry_name=country, verbose=True
         )
 
 
@@ -284,23 +284,14 @@ def preprocessed_speed_test(speed, res, country) -> pd.DataFrame:
     :rtype: dataframe
     """
     logging.info("Clipping speed data to country - can take a couple of mins...")
-    shpfilename = shpreader.natural_earth(
-        resolution="10m", category="cultural", name="admin_0_countries"
-    )
-    reader = shpreader.Reader(shpfilename)
-    world = reader.records()
     country = pycountry.countries.search_fuzzy(args.country)[0]
     ctry_name = country.name
-    ctry_geom = next(
-        filter(lambda x: x.attributes["NAME"] == ctry_name, world)
-    ).geometry
-    # now use low res to roughly clip
-    world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
-    ctry = world[world.name == ctry_name]
+    ctry_index = geo.get_country_index()
+    ctry_geom = ctry_index.geometry(ctry_name)
     bd_series = speed.geometry.str.replace(r"POLYGON\s\(+|\)", "").str.split(r"\s|,\s")
     speed["min_x"] = bd_series.str[0].astype("float")
     speed["max_y"] = bd_series.str[-1].astype("float")
-    minx, miny, maxx, maxy = ctry.bounds.values.T.squeeze()
+    minx, miny, maxx, maxy = ctry_index.bounds(ctry_name)
     # use rough bounds to restrict more or less to country
     speed = speed[
         speed.min_x.between(minx - 1e-1, maxx + 1e-1)
@@ -367,6 +358,9 @@ def append_features_to_hexes(
     model_dir=c.base_dir_model,
     tiff_dir=c.tiff_data,
     hyper_tuning=False,
+    backend=None,
+    stream_auto=False,
+    auto_cache_dir=None,
 ) -> pd.DataFrame:
     """Append features to hexagons withing a country
     :param country: country of interest
@@ -393,6 +387,16 @@ def append_features_to_hexes(
     :type tiff_dir: str, optional
     :param hyper_tuning: whether or not to perform hyperparameter tuning, defaults to False
     :type hyper_tuning: bool, optional
+    :param backend: execution backend shared by heavy processing stages,
+                    defaults to None (serial)
+    :type backend: ExecutionBackend, optional
+    :param stream_auto: stream autoencoder training images through a
+                        tf.data pipeline, rather than loading all into
+                        memory, defaults to False
+    :type stream_auto: bool, optional
+    :param auto_cache_dir: directory to cache streamed autoencoder
+                           training images in, defaults to None
+    :type auto_cache_dir: str, optional
     :return: hexes with corresponding features
     :rtype: dataframe
     """
@@ -444,7 +448,8 @@ def append_features_to_hexes(
 
     # Preprocessed tiff files
     logger.info(f"Preprocessing tiff files from {read_dir} and saving to {save_dir}..")
-    preprocessed_tiff_files(country, read_dir, save_dir, force=force)
+    backend = get_backend(backend)
+    preprocessed_tiff_files(country, read_dir, save_dir, force=force, backend=backend)
 
     # Conflict Zones
     logger.info("Reading and computing conflict zone estimates...")
@@ -460,15 +465,42 @@ def append_features_to_hexes(
 
     # Economic data
     logger.info("Retrieving features from economic tif files...")
-    econ_files = glob.glob(str(Path(save_dir) / f"{country.lower()}*.tif"))
-
+    econ_files = sorted(glob.glob(str(Path(save_dir) / f"{country.lower()}*.tif")))
+    # econ files are all reprojected to the population grid, as are
+    # most GEE files, so share the hex labels of pixels across files
+    hex_label_dir = Path(save_dir) / "hex_labels"
+
+    # also take population-weighted means of econ data, using the
+    # population grid they are reprojected to as weights
+    pop_file = Path(read_dir) / "gee" / f"cpi_poptotal_{country.lower()}_500.tif"
+    # stack econ files on the population grid, so all bands are read
+    # together, strip by strip, in a single pass
+    econ_stack = rs.build_stack(
+        econ_files,
+        pop_file,
+        rs.stack_path(save_dir, country),
+        rm_prefix=rf"cpi|_|{country.lower()}|500",
+        force=force,
+        verbose=True,
+    )
     econ = pg.agg_tif_to_df(
         ctry,
-        econ_files,
+        [econ_stack],
         resolution=res,
         rm_prefix=rf"cpi|_|{country.lower()}|500",
+        cache_dir=hex_label_dir,
+        stats=["mean", "wmean"],
+        weight_file=pop_file,
+        backend=backend,
         verbose=True,
     )
+    # keep unweighted means under original names
+    econ.rename(
+        columns={
+            col: col[: -len("_mean")] for col in econ.columns if col.endswith("_mean")
+        },
+        inplace=True,
+    )
 
     # Google Earth Engine
     logger.info("Retrieving features from google earth engine tif files...")
@@ -485,13 +517,22 @@ def append_features_to_hexes(
         list(small_gee),
         resolution=res,
         rm_prefix=rf"cpi|_|{country.lower()}|500",
+        cache_dir=hex_label_dir,
+        backend=backend,
         verbose=True,
     )
 
-    for large_file in large_gee:
-        large_gee_df = pg.rast_to_agg_df(
-            large_file, resolution=res, max_bands=max_bands, verbose=True
-        )
+    large_gee_dfs = backend.map(
+        partial(
+            pg.rast_to_agg_df,
+            resolution=res,
+            max_bands=max_bands,
+            cache_dir=hex_label_dir,
+            verbose=True,
+        ),
+        large_gee,
+    )
+    for large_gee_df in large_gee_dfs:
         gee = gee.join(
             large_gee_df,
             on="hex_code",
@@ -561,32 +602,25 @@ def append_features_to_hexes(
         else:
             print("--- Training auto encoder...")
             gaf.train_auto_encoder(
-                list(ctry.hex_code), tiffs, hyper_tuning, model_dir, country, res
+                list(ctry.hex_code),
+                tiffs,
+                hyper_tuning,
+                model_dir,
+                country,
+                res,
+                stream=stream_auto,
+                cache_dir=auto_cache_dir,
             )
         # check if autoencoder features have been saved
-        filename = f"encodings_{country.lower()}_res{res}.csv"
-        if os.path.exists(Path(save_dir) / filename):
+        save_path = gaf.encodings_path(save_dir, country, res)
+        if (save_path / "_SUCCESS").exists():
             print("--- Autoencoding features have already been saved.")
-            auto_features = pd.read_csv(Path(save_dir) / filename)
         else:
-            print("--- Retrieving autoencoding features...")
-            auto_features = gaf.retrieve_autoencoder_features(
-                list(ctry.hex_code), model_dir, country, res, tiffs, gpu
-            )
-            auto_features = (
-                pd.DataFrame(
-                    data=auto_features,
-                    columns=["f_" + str(i) for i in range(auto_features.shape[1])],
-                    index=list(ctry.hex_code),
-                )
-                .reset_index()
-                .rename({"index": "hex_code"}, axis=1)
-            )
-            print(f"--- Saving autoencoding features to {save_dir}...")
-            auto_features.to_csv(
-                Path(save_dir) / filename,
-                index=False,
+            print(f"--- Retrieving autoencoding features, saving to {save_path}...")
+            gaf.save_autoencoder_features(
+                ctry.hex_code, model_dir, country, res, tiffs, gpu, save_path
             )
+        auto_features = gaf.read_autoencoder_features(save_path)
         hexes = hexes.merge(auto_features, on="hex_code", how="left")
 
     zero_fill_cols = [
@@ -622,6 +656,9 @@ def create_dataset(
     read_dir_target=c.raw_data,
     read_dir=c.ext_data,
     tiff_dir=c.tiff_data,
+    backend=None,
+    stream_auto=False,
+    auto_cache_dir=None,
 ) -> pd.DataFrame:
     """Create dataset
     :param country_code: country code
@@ -660,6 +697,16 @@ def create_dataset(
     :type threshold: int, optional
     :param read_dir_target: path to directory of target data, defaults to c.raw_data
     :type read_dir_target: str, optional
+    :param backend: execution backend shared by heavy processing stages,
+                    defaults to None (serial)
+    :type backend: ExecutionBackend, optional
+    :param stream_auto: stream autoencoder training images through a
+                        tf.data pipeline, rather than loading all into
+                        memory, defaults to False
+    :type stream_auto: bool, optional
+    :param auto_cache_dir: directory to cache streamed autoencoder
+                           training images in, defaults to None
+    :type auto_cache_dir: str, optional
     :return: dataset with features and target variable
     :rtype: dataframe
     """
@@ -690,6 +737,9 @@ def create_dataset(
         model_dir=model_dir,
         tiff_dir=tiff_dir,
         hyper_tuning=hyper_tuning,
+        backend=backend,
+        stream_auto=stream_auto,
+        auto_cache_dir=auto_cache_dir,
     )
     print(f"Merging target variable to hexagons in {country}")
     complete = complete.merge(train, on="hex_code", how="left")
@@ -741,6 +791,36 @@ if __name__ == "__main__":
     parser.add_argument(
         "--add-auto", action="store_true", help="Generate autoencoder features also"
     )
+    parser.add_argument(
+        "--stream-auto",
+        action="store_true",
+        help="Stream autoencoder training images from disk, bounding memory use",
+    )
+    parser.add_argument(
+        "--auto-cache-dir",
+        type=str,
+        help="Directory to cache streamed autoencoder training images in",
+        default=None,
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="Execution backend for heavy processing stages: serial, threads, "
+        + f"processes, dask (local cluster) or address of dask scheduler, default is {c.backend}",
+        default=c.backend,
+    )
+    parser.add_argument(
+        "--n-workers",
+        type=int,
+        help="Number of workers for backend, default is all CPUs",
+        default=None,
+    )
+    parser.add_argument(
+        "--worker-memory",
+        type=str,
+        help="Approximate memory cap per worker, e.g. 4GB",
+        default=None,
+    )
 
     try:
         args = parser.parse_args()
@@ -763,12 +843,16 @@ if __name__ == "__main__":
     else:
         gpu = False
 
-    create_dataset(
-        country_code=country_code,
-        country=country_name,
-        gpu=gpu,
-        res=args.resolution,
-        force=args.force,
-        force_download=args.force_download,
-        encoders=args.add_auto,
-    )
+    with get_backend(args.backend, args.n_workers, args.worker_memory) as backend:
+        create_dataset(
+            country_code=country_code,
+            country=country_name,
+            gpu=gpu,
+            res=args.resolution,
+            force=args.force,
+            force_download=args.force_download,
+            encoders=args.add_auto,
+            backend=backend,
+            stream_auto=args.stream_auto,
+            auto_cache_dir=args.auto_cache_dir,
+        )
@@ -0,0 +1,230 @@
+"""Persistent store of image patches about hexes, extracted from a set
+of GeoTIFFs, so that rasters need only be read once per (tif set, hex
+set, patch size) rather than on every epoch or experiment.
+
+Patches are held in a single .npy file in shape (hex, i, j, band),
+opened memory-mapped by consumers, with hexes (sorted) alongside for
+random access by hex code."""
+import hashlib
+import os
+from functools import partial
+from os import PathLike
+from pathlib import Path
+from typing import List, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import rasterio
+
+import stc_unicef_cpi.data.hex_labels as hl
+import stc_unicef_cpi.data.process_geotiff as pg
+from stc_unicef_cpi.utils.backends import ExecutionBackend, get_backend
+
+
+class PatchStore:
+    """Memory-mapped patches for a set of hexes, in shape
+    (hex, i, j, band)
+
+    :param patches: Patches, shape (n hexes, height, width, bands)
+    :type patches: npt.NDArray
+    :param hex_codes: Sorted hex code of each patch
+    :type hex_codes: npt.NDArray
+    """
+
+    def __init__(self, patches: npt.NDArray, hex_codes: npt.NDArray):
+        self.patches = patches
+        self.hex_codes = hex_codes
+
+    def __len__(self) -> int:
+        return len(self.hex_codes)
+
+    @property
+    def shape(self):
+        return self.patches.shape
+
+    @property
+    def n_channels(self) -> int:
+        return self.patches.shape[-1]
+
+    def indices(
+        self, hex_codes: Union[List[int], npt.NDArray[np.int64]]
+    ) -> npt.NDArray[np.int64]:
+        """Positions of given hexes in store
+
+        :param hex_codes: Hex codes to find
+        :type hex_codes: Union[List[int], npt.NDArray[np.int64]]
+        :raises KeyError: If any hexes not in store
+        :return: Index of each hex in store
+        :rtype: npt.NDArray[np.int64]
+        """
+        hex_codes = np.asarray(hex_codes, dtype=np.int64)
+        idxs = np.searchsorted(self.hex_codes, hex_codes)
+        idxs = np.minimum(idxs, len(self.hex_codes) - 1)
+        missing = self.hex_codes[idxs] != hex_codes
+        if missing.any():
+            raise KeyError(f"{missing.sum()} hexes not in patch store")
+        return idxs
+
+    def get(
+        self,
+        hex_codes: Optional[Union[List[int], npt.NDArray[np.int64]]] = None,
+        channels_last: bool = True,
+    ) -> npt.NDArray:
+        """Get patches for given hexes, in the order given
+
+        :param hex_codes: Hex codes to get, defaults to None (all hexes,
+                          as a memory-mapped view rather than a copy)
+        :type hex_codes: Optional[Union[List[int], npt.NDArray[np.int64]]], optional
+        :param channels_last: Return in shape (hex, i, j, band), else
+                              (hex, band, i, j), defaults to True
+        :type channels_last: bool, optional
+        :return: Patches
+        :rtype: npt.NDArray
+        """
+        if hex_codes is None:
+            patches = self.patches
+        else:
+            idxs = self.indices(hex_codes)
+            # read in sorted order, for sequential access on disk
+            order = np.argsort(idxs, kind="stable")
+            patches = np.empty(
+                (len(idxs), *self.patches.shape[1:]), dtype=self.patches.dtype
+            )
+            patches[order] = self.patches[idxs[order]]
+        if not channels_last:
+            patches = patches.transpose((0, 3, 1, 2))
+        return patches
+
+
+def store_key(
+    tif_files: Union[List[str], List[PathLike]],
+    hex_codes: npt.NDArray[np.int64],
+    width: int,
+    height: int,
+    dtype: npt.DTypeLike,
+) -> str:
+    """Unique key for patches of given size from a set of tiff files
+    (in order, and as last modified) for a set of hexes
+
+    :param tif_files: Tiff files patches are extracted from
+    :type tif_files: Union[List[str], List[PathLike]]
+    :param hex_codes: Sorted, unique hex codes
+    :type hex_codes: npt.NDArray[np.int64]
+    :param width: Patch width in pixels
+    :type width: int
+    :param height: Patch height in pixels
+    :type height: int
+    :param dtype: Data type of patches
+    :type dtype: npt.DTypeLike
+    :return: Hash of store specification
+    :rtype: str
+    """
+    files = []
+    for tif_file in tif_files:
+        stat = os.stat(tif_file)
+        files.append((str(Path(tif_file).resolve()), stat.st_size, stat.st_mtime_ns))
+    hexes = hashlib.sha1(np.ascontiguousarray(hex_codes).tobytes()).hexdigest()
+    spec = repr((tuple(files), hexes, width, height, np.dtype(dtype).str))
+    return hashlib.sha1(spec.encode()).hexdigest()[:16]
+
+
+def _extract_chunk(
+    patches_path: Union[str, PathLike],
+    tif_files: Union[List[str], List[PathLike]],
+    width: int,
+    height: int,
+    hex_codes: npt.NDArray[np.int64],
+    start: int,
+) -> None:
+    """Extract patches for a chunk of hexes, writing to rows from start
+    of the (memory-mapped) patches file - module level so may run in
+    separate processes
+    """
+    patches = np.load(patches_path, mmap_mode="r+")
+    pg.extract_ims_from_hex_codes(
+        tif_files,
+        hex_codes,
+        width=width,
+        height=height,
+        dtype=patches.dtype,
+        out=patches[start : start + len(hex_codes)],
+        channels_last=True,
+    )
+    patches.flush()
+
+
+def get_patch_store(
+    tif_files: Union[List[str], List[PathLike]],
+    hex_codes: Union[List[int], npt.NDArray[np.int64]],
+    store_dir: Union[str, PathLike],
+    width: int = 16,
+    height: int = 16,
+    dtype: npt.DTypeLike = np.float32,
+    chunk_size: int = 4096,
+    backend: Optional[ExecutionBackend] = None,
+    verbose: bool = False,
+) -> PatchStore:
+    """Get store of patches about each of a set of hexes from a set of
+    tiff files, opening that already saved in store_dir if present,
+    else extracting patches (in chunks of hexes, in parallel if the
+    backend allows) and saving them first.
+
+    :param tif_files: Tiff files to extract (and stack) bands from
+    :type tif_files: Union[List[str], List[PathLike]]
+    :param hex_codes: Hex codes to extract patches for - duplicates are
+                      stored once
+    :type hex_codes: Union[List[int], npt.NDArray[np.int64]]
+    :param store_dir: Directory for patch store files
+    :type store_dir: Union[str, PathLike]
+    :param width: Patch width in pixels, defaults to 16
+    :type width: int, optional
+    :param height: Patch height in pixels, defaults to 16
+    :type height: int, optional
+    :param dtype: Data type of patches, defaults to np.float32
+    :type dtype: npt.DTypeLike, optional
+    :param chunk_size: Number of hexes per extraction task, defaults to 4096
+    :type chunk_size: int, optional
+    :param backend: Execution backend to extract chunks on, which must share
+                    the filesystem of store_dir, defaults to None (serial)
+    :type backend: Optional[ExecutionBackend], optional
+    :param verbose: Verbose, defaults to False
+    :type verbose: bool, optional
+    :return: Patch store
+    :rtype: PatchStore
+    """
+    hex_codes = np.unique(np.asarray(hex_codes, dtype=np.int64))
+    key = store_key(tif_files, hex_codes, width, height, dtype)
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    patches_path = store_dir / f"{key}_patches.npy"
+    hexes_path = store_dir / f"{key}_hexes.npy"
+    if patches_path.exists() and hexes_path.exists():
+        if verbose:
+            print(f"Loading patch store {key}...")
+        return PatchStore(np.load(patches_path, mmap_mode="r"), np.load(hexes_path))
+
+    nbands = 0
+    for tif_file in tif_files:
+        with rasterio.open(tif_file) as open_file:
+            nbands += open_file.count
+    if verbose:
+        print(f"Building patch store {key} for {len(hex_codes)} hexes...")
+    # temporary file is per process, as may be built concurrently
+    tmp_path = store_dir / f"{key}_patches.{os.getpid()}.tmp.npy"
+    patches = np.lib.format.open_memmap(
+        tmp_path, mode="w+", dtype=dtype, shape=(len(hex_codes), height, width, nbands)
+    )
+    del patches
+    starts = list(range(0, len(hex_codes), chunk_size))
+    chunks = [hex_codes[start : start + chunk_size] for start in starts]
+    if backend is None:
+        backend = get_backend("serial")
+    if backend.parallel and verbose:
+        print(f"Extracting {len(chunks)} chunks on {backend}...")
+    backend.map(
+        partial(_extract_chunk, tmp_path, tif_files, width, height), chunks, starts
+    )
+    hl._save_atomic(hexes_path, hex_codes)
+    # write patches last, under final name, so partial builds are never reused
+    os.replace(tmp_path, patches_path)
+    return PatchStore(np.load(patches_path, mmap_mode="r"), hex_codes)
@@ -1,12 +1,27 @@
+import ast
 import glob
 import os
 import re
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
 from os import PathLike
 from pathlib import Path
-from typing import Callable, List, Optional, Pattern, Type, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Tuple,
+    Type,
+    Union,
+)
 
-import cartopy.io.shapereader as shpreader
-import dask.dataframe as dd
 import geopandas as gpd
 import h3.api.numpy_int as h3
 import matplotlib.pyplot as plt
@@ -14,16 +29,109 @@ import numpy as np
 import numpy.typing as npt
 import pandas as pd
 import rasterio
+import rasterio.mask
 import rioxarray as rxr
-import swifter
-from affine import Affine
-from dask.distributed import Client, LocalCluster
-from pyproj import Transformer
 from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.transform import rowcol
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_geom
 from rasterio.windows import Window
+from shapely.geometry import mapping
 from tqdm.auto import tqdm
 from xarray import DataArray, Dataset
 
+import stc_unicef_cpi.data.hex_labels as hl
+import stc_unicef_cpi.data.zonal_stats as zs
+import stc_unicef_cpi.utils.geospatial as geo
+from stc_unicef_cpi.utils.backends import ExecutionBackend, get_backend, parse_memory
+
+# open datasets for reuse by data loaders, per thread (as handles may not
+# be shared between threads), each mapping path to the (mtime, size) of
+# the file when opened and the dataset, least recently used first
+_OPEN_DATASETS: Dict[
+    int, "OrderedDict[str, Tuple[Tuple[int, int], rasterio.io.DatasetReader]]"
+] = {}
+_OPEN_DATASETS_LOCK = threading.Lock()
+# datasets kept open per thread - must be more than are read at once
+MAX_OPEN_DATASETS = 64
+
+
+def _reset_open_datasets() -> None:
+    # handles inherited over fork are not safe to use (or close), so
+    # start afresh in the child
+    global _OPEN_DATASETS, _OPEN_DATASETS_LOCK
+    _OPEN_DATASETS = {}
+    _OPEN_DATASETS_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_open_datasets)
+
+
+def get_open_dataset(
+    tif_file: Union[str, PathLike],
+) -> rasterio.io.DatasetReader:
+    """Get an open rasterio dataset for a file, reusing that already
+    opened by this thread if possible - for repeated reads by e.g.
+    data loaders, to avoid reopening files per batch. The file is
+    reopened if modified since (e.g. rewritten at the same path),
+    and at most MAX_OPEN_DATASETS are kept open per thread, closing
+    the least recently used. Datasets otherwise stay open until
+    close_open_datasets is called, or the reusing_open_datasets
+    context is exited.
+
+    :param tif_file: Path to (tiff) file
+    :type tif_file: Union[str, PathLike]
+    :return: Open dataset
+    :rtype: rasterio.io.DatasetReader
+    """
+    path = os.fspath(tif_file)
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with _OPEN_DATASETS_LOCK:
+        datasets = _OPEN_DATASETS.setdefault(threading.get_ident(), OrderedDict())
+    entry = datasets.pop(path, None)
+    if entry is not None and (entry[0] != stamp or entry[1].closed):
+        entry[1].close()
+        entry = None
+    if entry is None:
+        entry = (stamp, rasterio.open(path))
+    datasets[path] = entry
+    while len(datasets) > MAX_OPEN_DATASETS:
+        _, (_, dataset) = datasets.popitem(last=False)
+        dataset.close()
+    return entry[1]
+
+
+def close_open_datasets(all_threads: bool = False) -> None:
+    """Close datasets opened by get_open_dataset in this thread, or in
+    all threads - only when no other thread is reading from them, e.g.
+    at the end of an epoch
+
+    :param all_threads: Close datasets of all threads, defaults to False
+    :type all_threads: bool, optional
+    """
+    with _OPEN_DATASETS_LOCK:
+        if all_threads:
+            thread_datasets = list(_OPEN_DATASETS.values())
+            _OPEN_DATASETS.clear()
+        else:
+            thread_datasets = [_OPEN_DATASETS.pop(threading.get_ident(), {})]
+    for datasets in thread_datasets:
+        for _, dataset in datasets.values():
+            dataset.close()
+
+
+@contextmanager
+def reusing_open_datasets() -> Iterator[None]:
+    """Context within which datasets from get_open_dataset are reused,
+    closing those of all threads on exit"""
+    try:
+        yield
+    finally:
+        close_open_datasets(all_threads=True)
+
 
 def print_tif_metadata(
     rioxarray_rio_obj: Union[Dataset, DataArray, List[Dataset]],
@@ -66,15 +174,8 @@ def clip_tif_to_ctry(
     """
     fname = Path(file_path).name
     # world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
-    shpfilename = shpreader.natural_earth(
-        resolution="10m", category="cultural", name="admin_0_countries"
-    )
-    reader = shpreader.Reader(shpfilename)
-    world = reader.records()
     with rasterio.open(file_path, "r", masked=True) as tif_file:
-        ctry_shp = next(
-            filter(lambda x: x.attributes["NAME"] == ctry_name, world)
-        ).geometry
+        ctry_shp = geo.get_shape_for_ctry(ctry_name)
         if tif_file.crs is not None and tif_file.crs != "EPSG:4326":
             # NB assumes that no CRS corresponds to EPSG:4326 (as standard)
             ctry_shp = gpd.GeoSeries(ctry_shp)
@@ -168,16 +269,186 @@ def rxr_reproject_tiff_to_target(
             return rxr_match
 
 
+def clip_reproject_to_target(
+    src_tiff_file: Union[str, PathLike],
+    target_tiff_file: Union[str, PathLike],
+    dest_path: Union[str, PathLike],
+    ctry_name: Optional[str] = None,
+    band_names: Optional[List[str]] = None,
+    resampling: Resampling = Resampling.bilinear,
+    verbose: bool = False,
+) -> None:
+    """Clip a GeoTIFF to a country and reproject it to the CRS,
+    resolution and extent of an example (target) tiff in a single
+    pass, writing one tiled, compressed file - replacing
+    clip_tif_to_ctry then rxr_reproject_tiff_to_target, with no
+    intermediate files.
+
+    The source is warped on the fly onto the target grid (a WarpedVRT),
+    so only source blocks within the target extent are read, one output
+    block at a time. Pixels whose centres lie outside the country are
+    then set to nodata (NaN), as the clipping mask is applied on the
+    target rather than the source grid.
+
+    :param src_tiff_file: Path to tiff file to clip and reproject
+    :type src_tiff_file: Union[str, PathLike]
+    :param target_tiff_file: Path to tiff file that is example of desired projection and resolution
+    :type target_tiff_file: Union[str, PathLike]
+    :param dest_path: Path to write reprojected tiff to
+    :type dest_path: Union[str, PathLike]
+    :param ctry_name: Name of country to clip to, defaults to None (no clipping)
+    :type ctry_name: Optional[str], optional
+    :param band_names: Names to set for bands (as descriptions and long_name
+                       tag), defaults to None (keep those of source)
+    :type band_names: Optional[List[str]], optional
+    :param resampling: Resampling method, defaults to Resampling.bilinear (as GEE)
+    :type resampling: Resampling, optional
+    :param verbose: Verbosity, defaults to False
+    :type verbose: bool, optional
+    :raises ValueError: If number of band names does not match number of bands
+    """
+    with rasterio.open(target_tiff_file) as target:
+        profile = {
+            "driver": "GTiff",
+            "crs": target.crs,
+            "transform": target.transform,
+            "width": target.width,
+            "height": target.height,
+        }
+    with rasterio.open(src_tiff_file) as src:
+        src_crs = src.crs
+        if src_crs is None:
+            print("Warning, no CRS present in src, assuming EPSG:4326")
+            src_crs = "EPSG:4326"
+        if band_names is None:
+            band_names = list(src.descriptions)
+        elif len(band_names) != src.count:
+            raise ValueError(
+                f"{len(band_names)} band names given for {src.count} bands"
+            )
+        ctry_shp = None
+        if ctry_name is not None:
+            ctry_shp = transform_geom(
+                "EPSG:4326", profile["crs"], mapping(geo.get_shape_for_ctry(ctry_name))
+            )
+        profile.update(
+            count=src.count,
+            dtype="float32",
+            nodata=np.nan,
+            tiled=True,
+            blockxsize=256,
+            blockysize=256,
+            compress="deflate",
+            predictor=3,
+        )
+        with WarpedVRT(
+            src,
+            src_crs=src_crs,
+            crs=profile["crs"],
+            transform=profile["transform"],
+            width=profile["width"],
+            height=profile["height"],
+            resampling=resampling,
+            src_nodata=src.nodata,
+            nodata=np.nan,
+            dtype="float32",
+        ) as vrt, rasterio.open(dest_path, "w", **profile) as dest:
+            for _, window in dest.block_windows(1):
+                data = vrt.read(window=window)
+                if ctry_shp is not None:
+                    outside = geometry_mask(
+                        [ctry_shp],
+                        out_shape=(window.height, window.width),
+                        transform=dest.window_transform(window),
+                    )
+                    data[:, outside] = np.nan
+                dest.write(data, window=window)
+            for band_idx, band_name in enumerate(band_names, start=1):
+                if band_name is not None:
+                    dest.set_band_description(band_idx, band_name)
+            if any(band_names):
+                long_name = band_names[0] if len(band_names) == 1 else band_names
+                dest.update_tags(long_name=str(long_name))
+    if verbose:
+        with rasterio.open(dest_path) as dest:
+            print(f"Written {Path(dest_path).name}:")
+            print(f" -- crs: {dest.crs}, shape: {(dest.count, *dest.shape)}")
+            print(f" -- resolution: {dest.res}, bands: {dest.descriptions}")
+
+
+def geotiff_to_arrays(
+    geotiff_filepath: Union[str, PathLike],
+    spec_band_names: Optional[List[str]] = None,
+    rm_prefix: Union[str, Pattern[str]] = "",
+    verbose: bool = False,
+) -> Dict[str, npt.NDArray]:
+    """Read a geotiff file into columnar arrays of pixel centre
+    coordinates and band values, for pixels with data in all bands.
+
+    Bands are read one at a time straight into NumPy arrays, with
+    coordinates computed from the affine transform, so that memory
+    use stays close to the size of the raster itself. Coordinates
+    are those of the raster CRS, with the northing in "latitude" and
+    easting in "longitude".
+
+    :param geotiff_filepath: path to a geotiff file
+    :type geotiff_filepath: Union[str, PathLike]
+    :param spec_band_names: Specified band names - only used
+                            if these are not specified in
+                            the GeoTIFF itself, at which
+                            point they are mandatory, defaults to None
+    :type spec_band_names: Optional[List[str]], optional
+    :param rm_prefix: Prefix (or regex pattern) to replace in file name, defaults to ""
+    :type rm_prefix: Union[str, Pattern[str]], optional
+    :param verbose: verbose output, defaults to False
+    :type verbose: bool, optional
+    :return: Dict of column name to array, with latitude, longitude then
+             one column per band
+    :rtype: Dict[str, npt.NDArray]
+    """
+    band_names = get_band_names(geotiff_filepath, spec_band_names, rm_prefix)
+    with rasterio.open(geotiff_filepath) as raster:
+        if verbose:
+            name = Path(geotiff_filepath).name
+            print(f"The crs of {name} is:", raster.crs)
+            print(f"The nodatavalue of {name} is:", raster.nodata)
+            print(f"The shape of {name} is:", (raster.count, *raster.shape))
+            print(f"The spatial resolution for {name} is:", raster.res)
+            print(f"The metadata for {name} is:", raster.tags())
+        if raster.count == 1:
+            print("Single band found only")
+        dtype = np.promote_types(raster.dtypes[0], np.float32)
+        bands = []
+        valid = np.ones(raster.shape, dtype=bool)
+        for band_idx in raster.indexes:
+            band = raster.read(band_idx, masked=True)
+            band = band.astype(dtype, copy=False).filled(np.nan)
+            valid &= ~np.isnan(band)
+            bands.append(band)
+        # pixel centre coordinates of valid pixels only
+        rows, cols = np.nonzero(valid)
+        eastings, northings = hl.pixel_coords(raster.transform, rows, cols)
+    columns = {"latitude": northings, "longitude": eastings}
+    while len(bands) > 0:
+        # free each full band as soon as valid pixels extracted
+        columns[band_names[len(columns) - 2]] = bands.pop(0)[valid]
+    return columns
+
+
 def geotiff_to_df(
     geotiff_filepath: Union[str, PathLike],
     spec_band_names: Optional[List[str]] = None,
-    max_bands: int = 5,
+    max_bands: Optional[int] = None,
     rm_prefix: Union[str, Pattern[str]] = "",
     verbose: bool = False,
 ) -> pd.DataFrame:
     """Convert a geotiff file to a pandas dataframe,
     and print some additional info.
 
+    Reads bands directly to arrays (see geotiff_to_arrays), then
+    builds the dataframe once, so there is no longer a limit on
+    the number of bands that can be handled.
+
     :param geotiff_filepath: path to a geotiff file
     :type geotiff_filepath: Union[str, PathLike]
     :param spec_band_names: Specified band names - only used
@@ -185,7 +456,7 @@ def geotiff_to_df(
                             the GeoTIFF itself, at which
                             point they are mandatory, defaults to None
     :type spec_band_names: Optional[List[str]], optional
-    :param max_bands: Max allowable bands before requires use of rast_to_agg_df, defaults to 5
+    :param max_bands: Deprecated and unused, defaults to None
     :type max_bands: Optional[int], optional
     :param rm_prefix: Prefix (or regex pattern) to replace in file name, defaults to None
     :type rm_prefix: Union[str, Pattern[str]], optional
@@ -193,147 +464,46 @@ def geotiff_to_df(
     :type verbose: bool, optional
     :raises ValueError: No band names provided but none found either
     :raises ValueError: Number of band names provided when none found does not match number of bands
-    :raises ValueError: Too many bands to handle without excessive memory - use rast_to_agg_df instead
-    :raises ValueError: Problem with index resulting from conversion to df
-    :raises ValueError: Problem converting bands
     :return: pandas dataframe of lat, long, val for each band
     :rtype: pd.DataFrame
     """
-    # # NB quadkeys are defined on Mercator projection, so must reproject
-    # world = world.to_crs("EPSG:3395")  # world.to_crs(epsg=3395) would also work
-    reproj = False
-    with rxr.open_rasterio(geotiff_filepath, masked=True) as open_file:
-        name = Path(geotiff_filepath).name
-        if verbose:
-            print_tif_metadata(open_file, name)
-        if open_file.rio.crs != "EPSG:4326":
-            og_proj = open_file.rio.crs
-            if og_proj is None:
-                print("Warning: no CRS found in geotiff file:")
-                print("assuming EPSG:4326")
-                open_file.rio.write_crs(4326, inplace=True)
-            else:
-                print("Reprojection to lat/lon required: completing...")
-                reproj = True
-                try:
-                    if not open_file.crs.epsg_treats_as_latlong():
-                        print("Warning")
-                except:
-                    print("Rasterio version available does not include epsg check:")
-                    print("Warning: change of flipped crs")
-        open_file = open_file.squeeze()
-        open_file.name = "data"
-        try:
-            band_names = open_file.attrs["long_name"]
-            if type(band_names) == str:
-                # not really multiband but below still works
-                band_names = [band_names]
-            multi_bands = True
-        except KeyError:
-            try:
-                assert len(open_file.shape) == 2
-                print("Single band found only")
-                multi_bands = False
-                band_names = [
-                    re.sub(rm_prefix, "", name)
-                    .replace(".tif", "", 1)
-                    .replace("Data", "", 1)
-                ]
-            except AssertionError:
-                # Multi-Band but with different
-                # naming convention
-                with rasterio.open(geotiff_filepath) as rast_file:
-                    if verbose:
-                        print("rioxarray struggling...")
-                        print("rasterio finds following metadata:")
-                        print(rast_file.meta)
-                    if rast_file.meta["count"] == 1:
-                        print("Single band found only")
-                        multi_bands = False
-                        band_names = [
-                            re.sub(rm_prefix, "", name)
-                            .replace(".tif", "", 1)
-                            .replace("Data", "", 1)
-                        ]
-                    else:
-                        multi_bands = True
-                        band_names = rast_file.descriptions
-                        if set(band_names) == {None}:
-                            try:
-                                assert spec_band_names is not None
-                            except AssertionError:
-                                raise ValueError("Must specify band names")
-                            try:
-                                assert len(spec_band_names) == len(band_names)
-                            except AssertionError:
-                                raise ValueError(
-                                    "Band names specified do not match number of bands"
-                                )
-                            band_names = spec_band_names
-                        if verbose:
-                            print("Found bands", band_names)
-                            # print(rast_file.tags())
-                            # print(rast_file.tags(1))
-        # restrict to tifs of fewer than max bands
-        # else can cause memory issues
-        if len(band_names) > max_bands:
-            raise ValueError(
-                "Too many bands, will require a lot of RAM: instead advisable to use rast_to_agg_df"
-            )
-        else:
-            df = open_file.to_dataframe()
-
-    # print(df.reset_index().describe())
-    df.drop(columns=["spatial_ref"], inplace=True)
-    df.dropna(subset=["data"], inplace=True)
-    if multi_bands:
-        df.rename(
-            index=dict(zip(range(1, len(band_names) + 1), band_names)), inplace=True
+    if max_bands is not None:
+        warnings.warn(
+            "max_bands is deprecated and unused, as bands are read directly to arrays",
+            DeprecationWarning,
         )
+    columns = geotiff_to_arrays(geotiff_filepath, spec_band_names, rm_prefix, verbose)
+    df = pd.DataFrame(columns, copy=False)
+    del columns
+    title = re.sub(rm_prefix, "", Path(geotiff_filepath).name).replace(".tif", "", 1)
+    print(f"{len(df.columns) - 2} bands found in {title}")
 
-    if len(df.index.names) == 3:
-        # TO SORT FOR OTHER ORDERING
-        assert df.index.names == ["band", "y", "x"]
-        df.index.set_names(["band", "latitude", "longitude"], inplace=True)
-    elif len(df.index.names) == 2:
-        assert df.index.names == ["y", "x"]
-        df.index.set_names(["latitude", "longitude"], inplace=True)
-    else:
-        raise ValueError("Unexpected number of index levels")
-    # Now converted to csv with band/lat/lon index
-    # So unstack band index into separate columns if multband,
-    # and drop unhelpful column multiindex
-    if len(df.index.names) == 3:
-        df = df.unstack(level=0).droplevel(0, axis=1).reset_index()
-    else:
-        # Single band, but check to make sure, then rename data
-        # suitably
-        nbands = df.band.nunique()
-        if nbands == 0:
-            # undefined band names
-            with rasterio.open(geotiff_filepath) as rast_file:
-                nbands = len(rast_file.indexes)
-        title = re.sub(rm_prefix, "", name).replace(".tif", "", 1)
-        print(f"{nbands} bands found in {title}")
-        if nbands > 1:
-            raise ValueError("More than one band, need to handle")
-        else:
-            df.drop(columns=["band"], inplace=True)
-        df.rename(columns={"data": title.replace("Data", "")}, inplace=True)
-        df = df.reset_index()
-
-    if reproj:
+    with rasterio.open(geotiff_filepath) as raster:
+        og_proj = raster.crs
+    # # NB quadkeys are defined on Mercator projection, so must reproject
+    # world = world.to_crs("EPSG:3395")  # world.to_crs(epsg=3395) would also work
+    if og_proj is None:
+        print("Warning: no CRS found in geotiff file:")
+        print("assuming EPSG:4326")
+    elif og_proj != "EPSG:4326":
         # do reprojection of coords to lat/lon
+        print("Reprojection to lat/lon required: completing...")
+        try:
+            if not og_proj.epsg_treats_as_latlong():
+                print("Warning")
+        except:
+            print("Rasterio version available does not include epsg check:")
+            print("Warning: change of flipped crs")
         if verbose:
             print("REPROJECTING")
-        transformer = Transformer.from_crs(og_proj, "EPSG:4326")
-        coords = [
-            transformer.transform(x, y) for x, y in df[["latitude", "longitude"]].values
-        ]
-        df[["latitude", "longitude"]] = coords
-
-    df.dropna(inplace=True)
-    # print(df.head())
+        transformer = geo.get_transformer(og_proj)
+        # northings are held in latitude, eastings in longitude
+        longs, lats = transformer.transform(
+            df["longitude"].values, df["latitude"].values
+        )
+        df["latitude"] = lats
+        df["longitude"] = longs
+
     return df
 
 
@@ -342,6 +512,13 @@ def rast_to_agg_df(
     agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
     resolution: int = 7,
     max_bands: int = 3,
+    stream: bool = True,
+    strip_height: int = 512,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    stats: Optional[List[str]] = None,
+    weight_file: Optional[Union[str, PathLike]] = None,
+    coverage: str = "centroid",
+    n_sub: Optional[int] = None,
     verbose: bool = False,
 ) -> pd.DataFrame:
     """Likely slower than using rioxarray fns, but
@@ -349,88 +526,552 @@ def rast_to_agg_df(
     than all at once (v memory expensive) - only to be
     used for tiffs with many bands.
 
+    If streaming, instead walk the raster in strips of rows,
+    folding all bands into running per-hex accumulators, so
+    peak memory depends on strip size rather than raster size.
+    Only possible for aggregation functions that can be
+    accumulated (count, sum, mean, var, std, min, max), else
+    falls back to processing groups of bands over the full raster.
+    Lists of such statistics may also be given as stats, which are
+    then all accumulated in the same (streaming) pass, in columns
+    named <band>_<stat>, including weighted means ("wmean") if a
+    weight_file on the same grid is given.
+
+    With coverage="fractional", pixels are instead weighted by the
+    fraction of their area within each hex (see agg_tif_to_df),
+    again streaming strips of the raster.
+
     :param tiff_file: Path to (many banded, large) tiff file
     :type tiff_file: Union[str, PathLike]
     :param agg_fn: Aggregation function, defaults to np.mean
     :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
     :param resolution: Resolution of H3 grid to aggregate to, defaults to 7
     :type resolution: int, optional
-    :param max_bands: Max number of bands to process at one time, defaults to 3
+    :param max_bands: Max number of bands to process at one time if not
+                      streaming, defaults to 3
     :type max_bands: int, optional
+    :param stream: Stream raster in strips of rows, defaults to True
+    :type stream: bool, optional
+    :param strip_height: Approximate number of rows per strip when
+                         streaming, defaults to 512
+    :type strip_height: int, optional
+    :param cache_dir: Directory of cached hex label rasters - if given,
+                      reuse (or create) the label raster for this grid
+                      when streaming rather than computing hex codes per
+                      strip, defaults to None
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param stats: List of statistics to compute instead of agg_fn (always
+                  streamed), defaults to None
+    :type stats: Optional[List[str]], optional
+    :param weight_file: Tiff of pixel weights on same grid, defaults to None.
+                        If given without stats, stats defaults to ["wmean"]
+    :type weight_file: Optional[Union[str, PathLike]], optional
+    :param coverage: How pixels are assigned to hexes, either "centroid"
+                     or "fractional", defaults to "centroid"
+    :type coverage: str, optional
+    :param n_sub: Number of sample points per pixel side for fractional
+                  coverage, defaults to None (automatic)
+    :type n_sub: Optional[int], optional
     :param verbose: Verbose, defaults to False
     :type verbose: bool, optional
+    :raises ValueError: If stats given but bands lack unique descriptions
     :return: Dataframe of aggregated data
     :rtype: pd.DataFrame
     """
-    with rasterio.open(tiff_file) as raster:
+    if coverage == "fractional":
+        if weight_file is not None:
+            raise ValueError(
+                "Weighted statistics not supported with fractional coverage"
+            )
+        with rasterio.open(tiff_file) as raster:
+            band_names = list(raster.descriptions)
+            if stats is not None:
+                zs.check_band_names(band_names)
+            return _agg_raster_via_coverage(
+                raster,
+                band_names,
+                agg_fn,
+                resolution=resolution,
+                cache_dir=cache_dir,
+                strip_height=strip_height,
+                stats=stats,
+                n_sub=n_sub,
+                all_bands_valid=False,
+                verbose=verbose,
+            )
+    elif coverage != "centroid":
+        raise ValueError(f"Unknown coverage {coverage}")
+    stat = zs.get_stat_name(agg_fn)
+    if weight_file is not None and stats is None:
+        stats = ["wmean"]
+    if stats is not None:
+        stats = zs.check_stats(stats, weighted=weight_file is not None)
+        stream = True
+    elif stream and stat is None:
+        warnings.warn(
+            f"Cannot stream aggregation with {agg_fn}, processing full raster instead"
+        )
+        stream = False
+    with rasterio.open(tiff_file) as raster, (
+        rasterio.open(weight_file) if weight_file is not None else nullcontext()
+    ) as weight_rast:
+        if weight_rast is not None:
+            hl.check_same_grid(raster, weight_rast)
         band_names = np.array(raster.descriptions)
+        if stats is not None:
+            # named <band>_<stat>, so check before streaming the raster
+            zs.check_band_names(band_names)
         nbands = len(band_names)
         ctr = 0
 
+        if stream:
+            acc_stats = [stat] if stats is None else stats
+            if cache_dir is not None:
+                label_rast = hl.get_hex_labels(
+                    raster, resolution, cache_dir, strip_height, verbose
+                )
+                accumulator = zs.HexAccumulator(
+                    band_names.tolist(), stats=acc_stats, hex_codes=label_rast.hex_codes
+                )
+            else:
+                transformer = geo.get_transformer(raster.crs)
+                accumulator = zs.HexAccumulator(band_names.tolist(), stats=acc_stats)
+            for window in tqdm(
+                list(hl.iter_row_strips(raster, strip_height)),
+                desc="Strip progress:",
+                disable=not verbose,
+            ):
+                array = raster.read(window=window)
+                weights = _read_weights(weight_rast, window)
+                if cache_dir is not None:
+                    accumulator.update_labels(label_rast.window(window), array, weights)
+                else:
+                    hex_codes = hl.window_hex_codes(
+                        raster, window, resolution, transformer
+                    )
+                    accumulator.update(hex_codes, array, weights)
+            if stats is not None:
+                return accumulator.results(stats)
+            return accumulator.result(stat)
+
         if verbose:
             print("Finding pixel coords...")
-        # get pixel coords
-        T0 = raster.transform  # upper-left pixel corner affine transform
-        # Get affine transform for pixel centres
-        T1 = T0 * Affine.translation(0.5, 0.5)
-        # Function to convert pixel row/column index (from 0) to easting/northing at centre
-        rc2en = lambda r, c: T1 * (c, r)
-
-        tmp = raster.read(1)
-        # All rows and columns
-        cols, rows = np.meshgrid(np.arange(tmp.shape[1]), np.arange(tmp.shape[0]))
-        del tmp
-        # All eastings and northings (there is probably a faster way to do this)
-        eastings, northings = np.vectorize(rc2en, otypes=[float, float])(rows, cols)
-        transformer = Transformer.from_crs(raster.crs, "EPSG:4326")
+        # eastings and northings of all pixel centres, as one array operation
+        rows = np.arange(raster.height)[:, np.newaxis]
+        cols = np.arange(raster.width)[np.newaxis, :]
+        eastings, northings = hl.pixel_coords(raster.transform, rows, cols)
+        transformer = geo.get_transformer(raster.crs)
         longs, lats = transformer.transform(eastings, northings)
         del eastings, northings
         latlongs = np.dstack((lats, longs))
         if verbose:
             print("Calculating hex codes...")
-        hex_codes = np.apply_along_axis(
-            lambda x: h3.geo_to_h3(*x, resolution),
-            axis=-1,
-            arr=latlongs,
-        )
+        hex_codes = geo.geo_to_h3_array(
+            latlongs[..., 0], latlongs[..., 1], resolution
+        ).astype(np.int64)
         del latlongs
-        # if verbose:
-        #     print(f"Found {len(np.unique(hex_codes))} hex codes")
-        res_df = None
+        # dense label per pixel, so each band group can be reduced
+        # with bincounts rather than a dataframe groupby
+        uniq_codes, labels = np.unique(hex_codes, return_inverse=True)
+        labels = labels.reshape(-1)
+        del hex_codes
+        if verbose:
+            print(f"Found {len(uniq_codes)} hex codes")
+        agg_vals = np.full((nbands, len(uniq_codes)), np.nan)
         while ctr < nbands:
             band_idxs = np.array(
                 list(set(range(ctr, ctr + max_bands)) & set(range(nbands))), dtype=int
             )
             if verbose:
                 print(f"Done, now processing bands {band_names[band_idxs]}")
-            if len(band_idxs) == 1:
-                band_cols = band_names[band_idxs].tolist()
-            else:
-                band_cols = band_names[band_idxs].tolist()
             array = raster.read(list(band_idxs + 1))  # need + 1 as not zero-indexed
-            # array = np.vstack((array, hex_codes[np.newaxis, ...]))
-            df = pd.DataFrame(
-                array.reshape([len(band_idxs), -1]).T,
-                columns=band_cols,
-            )
-            df["hex_code"] = hex_codes.reshape(-1)
-            df.dropna(how="all", inplace=True)
-            del array
+            array = array.reshape([len(band_idxs), -1]).astype(np.float64)
             if verbose:
                 print("Aggregating...")
-            df = df.groupby(by="hex_code").agg({band: agg_fn for band in band_cols})
-            if res_df is None:
-                res_df = df
-            else:
-                if verbose:
-                    print("Joining to previous aggregations...")
-                res_df = res_df.join(df, how="outer")
-                del df
+            vals, counts = zs.zonal_aggregate(labels, array, len(uniq_codes), agg_fn)
+            del array, counts
+            agg_vals[band_idxs] = vals
             ctr += max_bands
+    res_df = pd.DataFrame(
+        agg_vals.T,
+        columns=band_names.tolist(),
+        index=pd.Index(uniq_codes, name="hex_code"),
+    )
     res_df.dropna(how="all", inplace=True)  # type: ignore
     return res_df
 
 
+def _hex_codes_for_df(df: pd.DataFrame, resolution: int) -> pd.Series:
+    """Assign h3 hex codes to each row of a dataframe with
+    latitude and longitude columns in one batched call
+
+    :param df: Dataframe with latitude and longitude columns
+    :type df: pd.DataFrame
+    :param resolution: Resolution level of h3 grid to use
+    :type resolution: int
+    :return: Series of hex codes (numpy_int form) with same index as df
+    :rtype: pd.Series
+    """
+    hex_codes = geo.geo_to_h3_array(
+        df["latitude"].values, df["longitude"].values, resolution
+    )
+    return pd.Series(hex_codes.astype(np.int64), index=df.index)
+
+
+def _agg_tif_via_df(
+    fname: Union[str, PathLike],
+    agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
+    rm_prefix: Union[str, Pattern[str]] = "cpi",
+    resolution: int = 7,
+    stats: Optional[List[str]] = None,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Aggregate pixels of a tiff within hexagons by converting
+    to a dataframe of pixel coordinates and values, then grouping
+    by hex code - handles arbitrary aggregation functions.
+
+    :param fname: Path to tiff file
+    :type fname: Union[str, PathLike]
+    :param agg_fn: Function to use when aggregating tiff pixels within cells,
+                   defaults to np.mean
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
+    :param rm_prefix: Prefix or regex pattern to remove from file string when naming variables,
+                      defaults to "cpi"
+    :type rm_prefix: Union[str, Pattern[str]], optional
+    :param resolution: Resolution level of h3 grid to use, defaults to 7
+    :type resolution: int, optional
+    :param stats: Statistics to compute instead of agg_fn, giving columns
+                  named <band>_<stat>, defaults to None
+    :type stats: Optional[List[str]], optional
+    :param verbose: Verbose output, defaults to False
+    :type verbose: bool, optional
+    :return: Aggregated values, indexed by hex_code
+    :rtype: pd.DataFrame
+    """
+    agg_spec = agg_fn if stats is None else zs.check_stats(stats)
+    # Convert to dataframe
+    try:
+        tmp = geotiff_to_df(fname, rm_prefix=rm_prefix, verbose=verbose)
+    except:
+        tmp = geotiff_to_df(
+            fname,
+            spec_band_names=["GDP_PPP_1990", "GDP_PPP_2000", "GDP_PPP_2015"],
+            rm_prefix=rm_prefix,
+            verbose=verbose,
+        )
+    print("Converted to dataframe!")
+    if verbose:
+        print("Dataframe info:")
+        print(tmp.info())
+    print("Adding hex info...")
+    tmp["hex_code"] = _hex_codes_for_df(tmp, resolution)
+    tmp.drop(columns=["latitude", "longitude"], inplace=True)
+    print("Done!")
+    print("Aggregating within cells...")
+    tmp = tmp.groupby(by=["hex_code"]).agg(
+        {col: agg_spec for col in tmp.columns if col != "hex_code"}
+    )
+    if stats is not None:
+        tmp.columns = [f"{band}_{stat}" for band, stat in tmp.columns]
+    return tmp
+
+
+def get_band_names(
+    tiff_file: Union[str, PathLike],
+    spec_band_names: Optional[List[str]] = None,
+    rm_prefix: Union[str, Pattern[str]] = "",
+) -> List[str]:
+    """Get names of bands of a tiff file, as used for columns
+    by geotiff_to_df: single band files are named from the file
+    name, multi-band files from band descriptions (or long_name
+    tag), or else the specified band names.
+
+    :param tiff_file: Path to tiff file
+    :type tiff_file: Union[str, PathLike]
+    :param spec_band_names: Specified band names - only used
+                            if these are not specified in
+                            the GeoTIFF itself, at which
+                            point they are mandatory, defaults to None
+    :type spec_band_names: Optional[List[str]], optional
+    :param rm_prefix: Prefix (or regex pattern) to replace in file name, defaults to ""
+    :type rm_prefix: Union[str, Pattern[str]], optional
+    :raises ValueError: No band names provided but none found either
+    :raises ValueError: Number of band names provided when none found does not match number of bands
+    :return: List of band names
+    :rtype: List[str]
+    """
+    name = Path(tiff_file).name
+    with rasterio.open(tiff_file) as rast_file:
+        if rast_file.count == 1:
+            title = re.sub(rm_prefix, "", name).replace(".tif", "", 1)
+            return [title.replace("Data", "")]
+        if any(rast_file.descriptions):
+            return list(rast_file.descriptions)
+        long_name = rast_file.tags().get("long_name")
+        if long_name is not None:
+            try:
+                band_names = ast.literal_eval(long_name)
+            except (ValueError, SyntaxError):
+                band_names = long_name
+            if type(band_names) == str:
+                band_names = [band_names]
+            return list(band_names)
+        try:
+            assert spec_band_names is not None
+        except AssertionError:
+            raise ValueError("Must specify band names")
+        try:
+            assert len(spec_band_names) == rast_file.count
+        except AssertionError:
+            raise ValueError("Band names specified do not match number of bands")
+        return list(spec_band_names)
+
+
+def _agg_tif_via_labels(
+    fname: Union[str, PathLike],
+    agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
+    rm_prefix: Union[str, Pattern[str]] = "cpi",
+    resolution: int = 7,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    strip_height: int = 512,
+    stats: Optional[List[str]] = None,
+    weight_file: Optional[Union[str, PathLike]] = None,
+    coverage: str = "centroid",
+    n_sub: Optional[int] = None,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Aggregate pixels of a tiff within hexagons using the
+    (cached) hex label raster for the grid of the tiff. Where
+    agg_fn can be accumulated, streams strips of the raster into
+    per-hex accumulators, else reads the full raster and applies
+    agg_fn to the pixels of each hex in turn.
+
+    With fractional coverage, instead uses the (cached) sparse
+    pixel-hex coverage matrix for the grid of the tiff.
+
+    :param fname: Path to tiff file
+    :type fname: Union[str, PathLike]
+    :param agg_fn: Function to use when aggregating tiff pixels within cells,
+                   defaults to np.mean
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
+    :param rm_prefix: Prefix or regex pattern to remove from file string when naming variables,
+                      defaults to "cpi"
+    :type rm_prefix: Union[str, Pattern[str]], optional
+    :param resolution: Resolution level of h3 grid to use, defaults to 7
+    :type resolution: int, optional
+    :param cache_dir: Directory of cached hex label rasters, defaults to
+                      None (only cache in memory)
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param strip_height: Approximate number of rows per strip, defaults to 512
+    :type strip_height: int, optional
+    :param stats: Statistics to compute in a single pass instead of agg_fn,
+                  giving columns named <band>_<stat>, defaults to None
+    :type stats: Optional[List[str]], optional
+    :param weight_file: Tiff of pixel weights on same grid, read alongside
+                        the tiff to compute weighted statistics, defaults to None
+    :type weight_file: Optional[Union[str, PathLike]], optional
+    :param coverage: How pixels are assigned to hexes, either "centroid"
+                     or "fractional", defaults to "centroid"
+    :type coverage: str, optional
+    :param n_sub: Number of sample points per pixel side for fractional
+                  coverage, defaults to None (automatic)
+    :type n_sub: Optional[int], optional
+    :param verbose: Verbose output, defaults to False
+    :type verbose: bool, optional
+    :return: Aggregated values, indexed by hex_code
+    :rtype: pd.DataFrame
+    """
+    try:
+        band_names = get_band_names(fname, rm_prefix=rm_prefix)
+    except ValueError:
+        band_names = get_band_names(
+            fname,
+            spec_band_names=["GDP_PPP_1990", "GDP_PPP_2000", "GDP_PPP_2015"],
+            rm_prefix=rm_prefix,
+        )
+    if coverage == "fractional":
+        if weight_file is not None:
+            raise ValueError(
+                "Weighted statistics not supported with fractional coverage"
+            )
+        with rasterio.open(fname) as raster:
+            return _agg_raster_via_coverage(
+                raster,
+                band_names,
+                agg_fn,
+                resolution=resolution,
+                cache_dir=cache_dir,
+                strip_height=strip_height,
+                stats=stats,
+                n_sub=n_sub,
+                all_bands_valid=True,
+                verbose=verbose,
+            )
+    if weight_file is not None and stats is None:
+        stats = ["wmean"]
+    if stats is not None:
+        stats = zs.check_stats(stats, weighted=weight_file is not None)
+    stat = zs.get_stat_name(agg_fn)
+    with rasterio.open(fname) as raster, (
+        rasterio.open(weight_file) if weight_file is not None else nullcontext()
+    ) as weight_rast:
+        if weight_rast is not None:
+            hl.check_same_grid(raster, weight_rast)
+        label_rast = hl.get_hex_labels(
+            raster, resolution, cache_dir, strip_height, verbose
+        )
+        if stats is None and stat is None:
+            array = _read_valid_pixels(raster)
+            vals, counts = zs.zonal_aggregate(
+                np.asarray(label_rast.labels).reshape(-1),
+                array.reshape(len(band_names), -1),
+                label_rast.n_hexes,
+                agg_fn,
+            )
+            return zs.stats_to_frame(vals, counts, band_names, label_rast.hex_codes)
+        accumulator = zs.HexAccumulator(
+            band_names,
+            stats=[stat] if stats is None else stats,
+            hex_codes=label_rast.hex_codes,
+        )
+        for window in hl.iter_row_strips(raster, strip_height):
+            array = _read_valid_pixels(raster, window)
+            weights = _read_weights(weight_rast, window)
+            accumulator.update_labels(label_rast.window(window), array, weights)
+    if stats is not None:
+        return accumulator.results(stats)
+    return accumulator.result(stat)
+
+
+def _agg_raster_via_coverage(
+    raster: rasterio.io.DatasetReader,
+    band_names: List[str],
+    agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
+    resolution: int = 7,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    strip_height: int = 512,
+    stats: Optional[List[str]] = None,
+    n_sub: Optional[int] = None,
+    all_bands_valid: bool = True,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Aggregate pixels of a raster within hexagons weighting each
+    pixel by the fraction of it covered by each hex, using the
+    (cached) sparse coverage matrix for the grid of the raster, with
+    strips of the raster folded in by sparse matrix products.
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param band_names: Names of bands, for columns
+    :type band_names: List[str]
+    :param agg_fn: Aggregation function, either mean or sum, defaults to np.mean
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
+    :param resolution: Resolution level of h3 grid to use, defaults to 7
+    :type resolution: int, optional
+    :param cache_dir: Directory of cached coverage matrices, defaults to
+                      None (only cache in memory)
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param strip_height: Approximate number of rows per strip, defaults to 512
+    :type strip_height: int, optional
+    :param stats: Statistics to compute instead of agg_fn, from "mean" and
+                  "sum", giving columns named <band>_<stat>, defaults to None
+    :type stats: Optional[List[str]], optional
+    :param n_sub: Number of sample points per pixel side, defaults to None
+                  (automatic)
+    :type n_sub: Optional[int], optional
+    :param all_bands_valid: Only use pixels with values for all bands, as
+                            for geotiff_to_df, defaults to True
+    :type all_bands_valid: bool, optional
+    :param verbose: Verbose output, defaults to False
+    :type verbose: bool, optional
+    :raises ValueError: If statistics not supported with fractional coverage
+    :return: Aggregated values, indexed by hex_code
+    :rtype: pd.DataFrame
+    """
+    stat = zs.get_stat_name(agg_fn)
+    if stats is None and stat not in zs.COVERAGE_STATS:
+        raise ValueError(
+            f"Cannot aggregate with {agg_fn} using fractional coverage, "
+            f"must be one of {zs.COVERAGE_STATS}"
+        )
+    hex_cov = hl.get_hex_coverage(
+        raster, resolution, cache_dir, n_sub, strip_height, verbose
+    )
+    accumulator = zs.CoverageAccumulator(
+        band_names, hex_cov.hex_codes, stats=[stat] if stats is None else stats
+    )
+    for window in hl.iter_row_strips(raster, strip_height):
+        if all_bands_valid:
+            array = _read_valid_pixels(raster, window)
+        else:
+            array = raster.read(window=window, masked=True)
+            array = array.astype(np.float64).filled(np.nan)
+        accumulator.update(hex_cov.window(window), array.reshape(len(band_names), -1))
+    if stats is not None:
+        return accumulator.results(stats)
+    return accumulator.result(stat)
+
+
+def _read_weights(
+    weight_rast: Optional[rasterio.io.DatasetReader], window: Window
+) -> Optional[npt.NDArray]:
+    """Read window of (first band of) weight raster as float64,
+    with NaN where missing data
+
+    :param weight_rast: Open rasterio dataset of weights, or None
+    :type weight_rast: Optional[rasterio.io.DatasetReader]
+    :param window: Window to read
+    :type window: Window
+    :return: Weights, shape (height, width), or None if no weight raster
+    :rtype: Optional[npt.NDArray]
+    """
+    if weight_rast is None:
+        return None
+    weights = weight_rast.read(1, window=window, masked=True)
+    return weights.astype(np.float64).filled(np.nan)
+
+
+def _read_valid_pixels(
+    raster: rasterio.io.DatasetReader, window: Optional[Window] = None
+) -> npt.NDArray:
+    """Read (window of) raster as float64, with NaN for every band
+    at pixels missing data in any band, as for geotiff_to_df. For a
+    raster stack (see raster_stack), bands are only masked by other
+    bands from the same source file, so aggregating the stack gives
+    the same values as aggregating each file in turn.
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :param window: Window to read, defaults to None (full raster)
+    :type window: Optional[Window], optional
+    :return: Pixel values, shape (n_bands, height, width)
+    :rtype: npt.NDArray
+    """
+    array = raster.read(window=window, masked=True)
+    array = array.astype(np.float64).filled(np.nan)
+    for bands in _mask_groups(raster):
+        missing = np.isnan(array[bands]).any(axis=0)
+        for band in bands:
+            array[band, missing] = np.nan
+    return array
+
+
+def _mask_groups(raster: rasterio.io.DatasetReader) -> List[npt.NDArray]:
+    """Groups of band indices (0-based) of raster masked jointly, from
+    the STACK_GROUP tag of bands of a raster stack, else all bands
+
+    :param raster: Open rasterio dataset
+    :type raster: rasterio.io.DatasetReader
+    :return: Band indices of each group
+    :rtype: List[npt.NDArray]
+    """
+    groups = [raster.tags(band_idx).get("STACK_GROUP") for band_idx in raster.indexes]
+    if any(group is None for group in groups):
+        return [np.arange(raster.count)]
+    groups = np.asarray(groups)
+    return [np.flatnonzero(groups == group) for group in np.unique(groups)]
+
+
 def agg_tif_to_df(
     df: pd.DataFrame,
     tiff_dir: Union[str, PathLike, List[str], List[PathLike]],
@@ -439,17 +1080,57 @@ def agg_tif_to_df(
     max_records: int = int(1e5),
     replace_old: bool = True,
     resolution: int = 7,
+    use_label_cache: bool = True,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    strip_height: int = 512,
+    stats: Optional[List[str]] = None,
+    weight_file: Optional[Union[str, PathLike]] = None,
+    coverage: str = "centroid",
+    n_sub: Optional[int] = None,
+    n_workers: Optional[int] = 1,
+    worker_memory: Optional[Union[str, int]] = None,
+    backend: Optional[ExecutionBackend] = None,
     verbose: bool = False,
 ) -> pd.DataFrame:
     """Pass df with hex_code column of numpy_int type h3 codes,
     and a directory with tiff files, then aggregate pixels from tiffs
     within each hexagon according to given function.
 
-    Note that rather than using shapefiles, this uses pixel centroid
-    values, hence different quantities of pixels may be aggregated
-    in each hexagon, and it will not work sensibly at all if the
-    resolution of the tiff file is lower than the resolution of
-    the specified hexagons.
+    Note that by default (coverage="centroid"), rather than using
+    shapefiles, this uses pixel centroid values, hence different
+    quantities of pixels may be aggregated in each hexagon, and it
+    will not work sensibly at all if the resolution of the tiff file
+    is lower than the resolution of the specified hexagons. In that
+    case, use coverage="fractional", which weights pixels by the
+    fraction of their area within each hex, via a sparse pixel-hex
+    coverage matrix computed once per grid (and cached in cache_dir)
+    - only mean and sum may be computed this way.
+
+    By default, hex codes for each pixel are taken from a label
+    raster, computed once per grid (CRS, transform, shape) and
+    resolution and then reused for every tiff on the same grid,
+    with pixels streamed in strips into per-hex accumulators.
+    Aggregation functions which cannot be accumulated are instead
+    applied to the pixels of each hex of the full raster.
+
+    Several statistics (from "count", "sum", "mean", "var", "std",
+    "min", "max") may instead be requested via stats, which are
+    then all computed in the same single pass over each tiff,
+    giving columns named <band>_<stat>.
+
+    Given a weight_file (e.g. the population raster all others are
+    reprojected to), weighted means ("wmean") may also be requested,
+    for which weights are read block by block alongside each tiff -
+    this always uses the hex label raster.
+
+    Tiffs may be aggregated in parallel on an execution backend (see
+    utils.backends), else a pool of n_workers processes, with results
+    joined to df once, in the order of the tiff files, so output is
+    the same whatever order workers finish in. Note agg_fn must then
+    be picklable (e.g. not a lambda). If worker_memory is given (or
+    set for the backend), the number of workers is limited to those
+    fitting in the memory of the machine, and tiffs are read in
+    strips small enough to fit in worker_memory.
 
     :param df: 'ground truth' dataframe to aggregate tiffs to,
                with hex_code column at specified resolution
@@ -464,17 +1145,50 @@ def agg_tif_to_df(
     :param agg_fn: Function to use when aggregating tiff pixels within cells,
                    defaults to np.mean
     :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
-    :param max_records: Max number of pixels in clipped tiff before using dask,
-                        defaults to int(1e5)
+    :param max_records: Deprecated and unused, as large tiffs are no longer
+                        handed to dask - use backend instead to parallelise
+                        over tiffs, defaults to int(1e5)
     :type max_records: int, optional
     :param replace_old: Overwrite old columns if match new data,
                         defaults to True
     :type replace_old: bool, optional
     :param resolution: Resolution level of h3 grid to use, defaults to 7
     :type resolution: int, optional
+    :param use_label_cache: Use hex label rasters to aggregate, defaults to True
+    :type use_label_cache: bool, optional
+    :param cache_dir: Directory to persist hex label rasters in as memory-mapped
+                      files, defaults to None (only cache in memory)
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param strip_height: Approximate number of rows per strip read, defaults to 512
+    :type strip_height: int, optional
+    :param stats: List of statistics to compute instead of agg_fn, defaults to None
+    :type stats: Optional[List[str]], optional
+    :param weight_file: Tiff of pixel weights on same grid as all tiffs,
+                        defaults to None. If given without stats, stats
+                        defaults to ["wmean"]
+    :type weight_file: Optional[Union[str, PathLike]], optional
+    :param coverage: How pixels are assigned to hexes, either "centroid"
+                     (pixel centres) or "fractional" (area-weighted),
+                     defaults to "centroid"
+    :type coverage: str, optional
+    :param n_sub: Number of sample points per pixel side used to estimate
+                  fractional coverage, defaults to None (automatic)
+    :type n_sub: Optional[int], optional
+    :param n_workers: Number of processes to aggregate tiffs with if no
+                      backend given, defaults to 1 (sequential). If None,
+                      use all CPUs
+    :type n_workers: Optional[int], optional
+    :param worker_memory: Approximate memory cap per worker, either in bytes
+                          or as a human readable size (e.g. "4GB"),
+                          defaults to None (no cap)
+    :type worker_memory: Optional[Union[str, int]], optional
+    :param backend: Execution backend to aggregate tiffs on, shared with other
+                    stages of a pipeline, defaults to None (create one from
+                    n_workers and worker_memory, just for this call)
+    :type backend: Optional[ExecutionBackend], optional
     :param verbose: Verbose output, defaults to False
     :type verbose: bool, optional
-    :raises ValueError: hex_code column not in df
+    :raises ValueError: hex_code column not in df, or unknown coverage
     :return: Original dataframe with new columns added from aggregated values of tiffs in hexes
     :rtype: pd.DataFrame
     """
@@ -482,12 +1196,19 @@ def agg_tif_to_df(
         assert "hex_code" in df.columns
     except AttributeError:
         raise ValueError("hex_code not in df.columns")
+    if coverage not in ("centroid", "fractional"):
+        raise ValueError(f"Unknown coverage {coverage}")
+    if max_records != int(1e5):
+        warnings.warn(
+            "max_records is deprecated and unused, pass backend to parallelise",
+            DeprecationWarning,
+        )
 
     try:
         if os.path.isdir(tiff_dir):  # type: ignore
             # absolute path to search for all tiff files inside a specified folder
             path = Path(tiff_dir) / "*.tif"  # type: ignore
-            tif_files = glob.glob(str(path))
+            tif_files = sorted(glob.glob(str(path)))
         elif os.path.isfile(tiff_dir):  # type: ignore
             tif_files = [tiff_dir]  # type: ignore
     except TypeError:
@@ -495,142 +1216,185 @@ def agg_tif_to_df(
         assert type(tiff_dir) == list
         tif_files = tiff_dir  # type: ignore
 
-    for i, fname in enumerate(tif_files):
-        title = re.sub(rm_prefix, "", Path(fname).name).replace(".tif", "", 1)
-        print(f"Working with {title}: {i+1}/{len(tif_files)}...")
-        # Convert to dataframe
-        try:
-            tmp = geotiff_to_df(fname, rm_prefix=rm_prefix, verbose=verbose)
-        except:
-            tmp = geotiff_to_df(
-                fname,
-                spec_band_names=["GDP_PPP_1990", "GDP_PPP_2000", "GDP_PPP_2015"],
-                rm_prefix=rm_prefix,
-                verbose=verbose,
-            )
-        print("Converted to dataframe!")
-        if verbose:
-            print("Dataframe info:")
-            print(tmp.info())
-        print("Adding hex info...")
-        # need to split df into manageable chunks for memory
-        if len(tmp.index) > max_records:
-            print("Large dataframe, using dask instead...")
-            try:
-                with Client(
-                    "dask-scheduler:8786", timeout="2s"
-                ) as client:  # add options (?) e.g. n_workers=4, memory_limit="4GB"
-                    # NB ideal to have partitions around 100MB in size
-                    # client.restart()
-                    ddf = dd.from_pandas(
-                        tmp,
-                        npartitions=max(
-                            [4, int(tmp.memory_usage(deep=True).sum() // int(1e8))]
-                        ),
-                    )  # chunksize = max_records(?)
-                    print(f"Using {ddf.npartitions} partitions")
-                    ddf["hex_code"] = ddf[["latitude", "longitude"]].apply(
-                        lambda row: h3.geo_to_h3(
-                            row["latitude"], row["longitude"], resolution
-                        ),
-                        axis=1,
-                        meta=(None, int),
-                    )
-                    ddf = ddf.drop(columns=["latitude", "longitude"])
-                    print("Done!")
-                    print("Aggregating within cells...")
-                    ddf = ddf.groupby("hex_code").agg(
-                        {col: agg_fn for col in ddf.columns if col != "hex_code"}
-                    )
-                    tmp = ddf.compute()
-            except OSError:
-                try:
-                    cluster = LocalCluster(
-                        scheduler_port=8786,
-                        n_workers=2,
-                        threads_per_worker=1,
-                        memory_limit="2GB",
-                    )
-                    with Client(
-                        cluster,
-                        timeout="2s",
-                    ) as client:  # add options (?) e.g. n_workers=4, memory_limit="4GB"
-                        # client.restart()
-                        # NB ideal to have partitions around 100MB in size
-                        ddf = dd.from_pandas(
-                            tmp,
-                            npartitions=max(
-                                [4, int(tmp.memory_usage(deep=True).sum() // int(1e8))]
-                            ),
-                        )  # chunksize = max_records(?)
-                        print(f"Using {ddf.npartitions} partitions")
-                        ddf["hex_code"] = ddf[["latitude", "longitude"]].apply(
-                            lambda row: h3.geo_to_h3(
-                                row["latitude"], row["longitude"], resolution
-                            ),
-                            axis=1,
-                            meta=(None, int),
-                        )
-                        ddf = ddf.drop(columns=["latitude", "longitude"])
-                        print("Done!")
-                        print("Aggregating within cells...")
-                        ddf = ddf.groupby("hex_code").agg(
-                            {col: agg_fn for col in ddf.columns if col != "hex_code"}
-                        )
-                        tmp = ddf.compute()
-                except RuntimeError:
-                    # scheduler for dask failed to start, just use numpy + pandas
-                    print("dask failed, switching back to numpy + pandas")
-                    tmp["hex_code"] = np.apply_along_axis(
-                        lambda row: h3.geo_to_h3(*row, 7),
-                        arr=tmp[["latitude", "longitude"]].values,
-                        axis=1,
-                    )
-                    tmp["hex_code"] = tmp.hex_code.astype(
-                        int
-                    )  # ensure converted to int
-                    tmp.drop(columns=["latitude", "longitude"], inplace=True)
-                    print("Done!")
-                    print("Aggregating within cells...")
-                    tmp = tmp.groupby(by=["hex_code"]).agg(
-                        {col: agg_fn for col in tmp.columns if col != "hex_code"}
-                    )
-
+    use_labels = use_label_cache or weight_file is not None or coverage == "fractional"
+    own_backend = backend is None
+    if own_backend:
+        if n_workers is None or min(n_workers, len(tif_files)) > 1:
+            n_workers = None if n_workers is None else min(n_workers, len(tif_files))
+            backend = get_backend("processes", n_workers, worker_memory)
         else:
-            tmp["hex_code"] = tmp[["latitude", "longitude"]].swifter.apply(
-                lambda row: h3.geo_to_h3(row["latitude"], row["longitude"], resolution),
-                axis=1,
-            )
-            tmp.drop(columns=["latitude", "longitude"], inplace=True)
-            print("Done!")
-            print("Aggregating within cells...")
-            tmp = tmp.groupby(by=["hex_code"]).agg(
-                {col: agg_fn for col in tmp.columns if col != "hex_code"}
-            )
-        print("Joining to already aggregated data...")
-        # Aggregate ground truth to hexagonal cells with mean
-        # NB automatically excludes missing data for households,
-        # so differing quantities of data for different values
-        if replace_old:
-            override_cols = [col for col in tmp.columns if col in df.columns]
-            if len(override_cols) > 0:
-                print("Overwriting old columns:", override_cols)
-            df.drop(columns=override_cols, inplace=True)
-        df = df.join(
-            tmp,
-            how="left",
-            on="hex_code",
+            backend = get_backend("serial", memory_limit=worker_memory)
+    if worker_memory is None:
+        worker_memory = backend.memory_limit
+    worker_memory = parse_memory(worker_memory)
+    agg_file = partial(
+        _agg_tif_file,
+        n_files=len(tif_files),
+        use_labels=use_labels,
+        worker_memory=worker_memory,
+        agg_fn=agg_fn,
+        rm_prefix=rm_prefix,
+        resolution=resolution,
+        cache_dir=cache_dir,
+        strip_height=strip_height,
+        stats=stats,
+        weight_file=weight_file,
+        coverage=coverage,
+        n_sub=n_sub,
+        verbose=verbose,
+    )
+    try:
+        if backend.parallel and use_labels:
+            # compute shared hex labels (or coverage) for each grid up
+            # front, rather than in several workers at once
+            _prepare_grids(tif_files, resolution, cache_dir, coverage, n_sub, verbose)
+        if backend.parallel:
+            print(f"Aggregating {len(tif_files)} tiffs on {backend}...")
+        # results in order of tif_files, whatever order they complete in
+        results = backend.map(agg_file, tif_files, range(len(tif_files)))
+    finally:
+        if own_backend:
+            backend.close()
+    if len(results) == 0:
+        return df
+
+    print("Joining to already aggregated data...")
+    tmp = pd.concat(results, axis=1)
+    # later files take precedence where column names coincide
+    tmp = tmp.loc[:, ~tmp.columns.duplicated(keep="last")]
+    # Aggregate ground truth to hexagonal cells with mean
+    # NB automatically excludes missing data for households,
+    # so differing quantities of data for different values
+    if replace_old:
+        override_cols = [col for col in tmp.columns if col in df.columns]
+        if len(override_cols) > 0:
+            print("Overwriting old columns:", override_cols)
+        df.drop(columns=override_cols, inplace=True)
+    df = df.join(
+        tmp,
+        how="left",
+        on="hex_code",
+    )
+    if verbose:
+        print(
+            "Non-nans in block after join:",
+            len(df.dropna(subset=tmp.columns, how="all")),
         )
-        if verbose:
-            print(
-                "Non-nans in block after join:",
-                len(df.dropna(subset=tmp.columns, how="all")),
-            )
-            # print(df.dropna(subset=tmp.columns).head())
-        print("Done!")
+    print("Done!")
     return df
 
 
+def _agg_tif_file(
+    fname: Union[str, PathLike],
+    file_idx: int,
+    n_files: int,
+    use_labels: bool = True,
+    worker_memory: Optional[int] = None,
+    agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
+    rm_prefix: Union[str, Pattern[str]] = "cpi",
+    resolution: int = 7,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    strip_height: int = 512,
+    stats: Optional[List[str]] = None,
+    weight_file: Optional[Union[str, PathLike]] = None,
+    coverage: str = "centroid",
+    n_sub: Optional[int] = None,
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """Aggregate pixels of a single tiff within hexagons, as for
+    each file in agg_tif_to_df - module level so can be run in
+    worker processes (or on dask workers). Parameters not listed are as for agg_tif_to_df.
+
+    :param fname: Path to tiff file
+    :type fname: Union[str, PathLike]
+    :param file_idx: Index of file in list of files, for progress
+    :type file_idx: int
+    :param n_files: Total number of files, for progress
+    :type n_files: int
+    :param use_labels: Use hex label raster (or coverage), else convert
+                       to dataframe, defaults to True
+    :type use_labels: bool, optional
+    :param worker_memory: Approximate memory cap in bytes, used to limit
+                          strip height, defaults to None
+    :type worker_memory: Optional[int], optional
+    :return: Aggregated values, indexed by hex_code
+    :rtype: pd.DataFrame
+    """
+    title = re.sub(rm_prefix, "", Path(fname).name).replace(".tif", "", 1)
+    print(f"Working with {title}: {file_idx+1}/{n_files}...")
+    if not use_labels:
+        return _agg_tif_via_df(
+            fname,
+            agg_fn=agg_fn,
+            rm_prefix=rm_prefix,
+            resolution=resolution,
+            stats=stats,
+            verbose=verbose,
+        )
+    if worker_memory is not None:
+        with rasterio.open(fname) as raster:
+            # leave half of memory for labels and accumulators
+            strip_height = min(
+                strip_height, hl.strip_height_for_memory(raster, worker_memory // 2)
+            )
+    print("Aggregating within cells using hex label raster...")
+    return _agg_tif_via_labels(
+        fname,
+        agg_fn=agg_fn,
+        rm_prefix=rm_prefix,
+        resolution=resolution,
+        cache_dir=cache_dir,
+        strip_height=strip_height,
+        stats=stats,
+        weight_file=weight_file,
+        coverage=coverage,
+        n_sub=n_sub,
+        verbose=verbose,
+    )
+
+
+def _prepare_grids(
+    tif_files: List[Union[str, PathLike]],
+    resolution: int = 7,
+    cache_dir: Optional[Union[str, PathLike]] = None,
+    coverage: str = "centroid",
+    n_sub: Optional[int] = None,
+    verbose: bool = False,
+) -> None:
+    """Compute hex labels (or coverage) once for each distinct grid
+    among tiff files, so they are cached (on disk if cache_dir given,
+    else in memory inherited by forked workers) before aggregating
+    files in parallel
+
+    :param tif_files: Paths to tiff files
+    :type tif_files: List[Union[str, PathLike]]
+    :param resolution: Resolution level of h3 grid to use, defaults to 7
+    :type resolution: int, optional
+    :param cache_dir: Directory of cached hex label rasters, defaults to None
+    :type cache_dir: Optional[Union[str, PathLike]], optional
+    :param coverage: Either "centroid" or "fractional", defaults to "centroid"
+    :type coverage: str, optional
+    :param n_sub: Number of sample points per pixel side for fractional
+                  coverage, defaults to None (automatic)
+    :type n_sub: Optional[int], optional
+    :param verbose: Verbose output, defaults to False
+    :type verbose: bool, optional
+    """
+    seen = set()
+    for fname in tif_files:
+        with rasterio.open(fname) as raster:
+            key = hl.grid_key(raster, resolution)
+            if key in seen:
+                continue
+            seen.add(key)
+            if coverage == "fractional":
+                hl.get_hex_coverage(
+                    raster, resolution, cache_dir, n_sub, verbose=verbose
+                )
+            else:
+                hl.get_hex_labels(raster, resolution, cache_dir, verbose=verbose)
+
+
 # Example
 # geotiff_to_df("/Users/johnf/Downloads/cpiCopLandData.tiff")
 # with rxr.open_rasterio(
@@ -698,7 +1462,7 @@ def extract_image_at_coords(
         if verbose:
             print("WARNING, tiff not in lat/long")
         # reproject lat/lon given to tiff crs
-        transformer = Transformer.from_crs("EPSG:4326", og_proj)
+        transformer = geo.get_transformer("EPSG:4326", og_proj)
         try:
             if not dataset.crs.epsg_treats_as_latlong():  # type: ignore
                 print("Warning")
@@ -711,7 +1475,7 @@ def extract_image_at_coords(
             # Important! Some bands suggest this is not the case,
             # but luckily not a huge problem as only transforming
             # one tiff currently.
-        lat, long = transformer.transform(lat, long)
+        long, lat = transformer.transform(long, lat)
     # TODO: Add try, except block for when out of bounds error thrown
     row, col = dataset.index(long, lat)  # type: ignore
     max_i, max_j = dataset.height, dataset.width  # type: ignore
@@ -738,20 +1502,123 @@ def extract_image_at_coords(
 #         all_ims = np.vstack((all_ims, windowed_im))
 
 
+def extract_patches_at_coords(
+    dataset: rasterio.io.DatasetReader,
+    lats: npt.ArrayLike,
+    longs: npt.ArrayLike,
+    dim_x: int = 256,
+    dim_y: int = 256,
+    out: Optional[npt.NDArray] = None,
+    dtype: npt.DTypeLike = np.float32,
+    verbose: bool = False,
+) -> npt.NDArray:
+    """Batched version of extract_image_at_coords: extract arrays of
+    specified dimensions (num pixels) centred about each of a set of
+    lat/longs, giving identical results.
+
+    Pixel indices of all points are found at once, then points are
+    grouped by raster block, so that each region of the raster is
+    read once and all patches within it sliced out in memory, rather
+    than a small windowed read per point. Parts of patches outside
+    the raster are left as zero, with the part inside centred in the
+    patch as for extract_ims_from_hex_codes.
+
+    :param dataset: Open rasterio dataset
+    :type dataset: rasterio.io.DatasetReader
+    :param lats: Latitudes of centre points
+    :type lats: npt.ArrayLike
+    :param longs: Longitudes of centre points
+    :type longs: npt.ArrayLike
+    :param dim_x: x dimension (pixel width) of extracted images, defaults to 256
+    :type dim_x: int, optional
+    :param dim_y: y dimension (pixel height) of extracted images, defaults to 256
+    :type dim_y: int, optional
+    :param out: Array of shape (n points, bands, dim_y, dim_x), initialised to
+                zero, to write images to, defaults to None (new array)
+    :type out: Optional[npt.NDArray], optional
+    :param dtype: Data type of new array, if out not given, defaults to np.float32
+    :type dtype: npt.DTypeLike, optional
+    :param verbose: Verbose, defaults to False
+    :type verbose: bool, optional
+    :return: Images at each point, in shape (point_idx, band, i, j)
+    :rtype: npt.NDArray
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    longs = np.asarray(longs, dtype=np.float64)
+    if out is None:
+        out = np.zeros((len(lats), dataset.count, dim_y, dim_x), dtype=dtype)
+    og_proj = dataset.crs
+    if og_proj is not None and og_proj != "EPSG:4326":
+        if verbose:
+            print("WARNING, tiff not in lat/long")
+        # reproject lat/lon given to tiff crs, as in extract_image_at_coords
+        longs, lats = geo.get_transformer("EPSG:4326", og_proj).transform(longs, lats)
+    rows, cols = rowcol(dataset.transform, longs, lats)
+    tops = np.asarray(rows, dtype=np.int64).reshape(-1) - dim_y // 2
+    lefts = np.asarray(cols, dtype=np.int64).reshape(-1) - dim_x // 2
+    # clip windows to raster, as for a (non-boundless) windowed read
+    r0 = np.clip(tops, 0, dataset.height)
+    r1 = np.clip(tops + dim_y, 0, dataset.height)
+    c0 = np.clip(lefts, 0, dataset.width)
+    c1 = np.clip(lefts + dim_x, 0, dataset.width)
+    inside = np.flatnonzero((r1 > r0) & (c1 > c0))
+    if len(inside) == 0:
+        return out
+
+    # group patches by the tile containing their (clipped) upper left
+    # corner - tiles are at least as large as both raster blocks and
+    # patches, so each read covers at most twice a tile per dimension
+    block_h, block_w = dataset.block_shapes[0]
+    tile_h, tile_w = max(block_h, dim_y), max(block_w, dim_x)
+    n_tile_cols = dataset.width // tile_w + 1
+    tile_ids = (r0[inside] // tile_h) * n_tile_cols + c0[inside] // tile_w
+    order = np.argsort(tile_ids, kind="stable")
+    inside = inside[order]
+    splits = np.flatnonzero(np.diff(tile_ids[order])) + 1
+    for group in tqdm(
+        np.split(inside, splits),
+        position=1,
+        desc="Block progress:",
+        disable=not verbose,
+    ):
+        R0, R1 = r0[group].min(), r1[group].max()
+        C0, C1 = c0[group].min(), c1[group].max()
+        block = dataset.read(window=Window(C0, R0, C1 - C0, R1 - R0))
+        for idx in group:
+            n_rows, n_cols = r1[idx] - r0[idx], c1[idx] - c0[idx]
+            top = (dim_y - n_rows) // 2
+            left = (dim_x - n_cols) // 2
+            out[idx, :, top : top + n_rows, left : left + n_cols] = block[
+                :, r0[idx] - R0 : r1[idx] - R0, c0[idx] - C0 : c1[idx] - C0
+            ]
+    return out
+
+
 def extract_ims_from_hex_codes(
-    datasets: Union[List[str], List[PathLike]],
+    datasets: Union[List[str], List[PathLike], List[rasterio.io.DatasetReader]],
     hex_codes: Union[List[int], npt.NDArray[Union[np.int32, np.int64]]],
     width: int = 256,
     height: int = 256,
     verbose: bool = False,
+    dtype: npt.DTypeLike = np.float32,
+    out: Optional[Union[npt.NDArray, str, PathLike]] = None,
+    channels_last: bool = False,
 ) -> npt.NDArray:
     """For a set of datasets, specified by file path, and
     a set of h3 hex codes, extract centered
     images of specified size and return a 4D array
     in shape (image_idx,band,i,j).
 
-    :param datasets: List of paths to tiff files for which you want to extract (and stack) 'image' bands
-    :type datasets: Union[List[str], List[PathLike]]
+    Images for all hexes are extracted from each dataset in a single
+    batch, see extract_patches_at_coords. To limit memory use, images
+    may be stored at lower precision (dtype), written to an existing
+    array or a memory mapped .npy file (out), and written directly
+    in channels last order (channels_last) rather than transposing
+    (copying) afterwards.
+
+    :param datasets: List of paths to tiff files for which you want to extract (and stack) 'image' bands,
+                     or of open rasterio datasets (e.g. from get_open_dataset), which are left open
+    :type datasets: Union[List[str], List[PathLike], List[rasterio.io.DatasetReader]]
     :param hex_codes: Set of H3 hex codes in numpy_int format for which you wish to extract images
     :type hex_codes: Union[List[int], npt.NDArray[Union[np.int32,np.int64]]]
     :param width: Width of extracted images in pixels, defaults to 256
@@ -760,48 +1627,70 @@ def extract_ims_from_hex_codes(
     :type height: int, optional
     :param verbose: Verbose, defaults to False
     :type verbose: bool, optional
-    :return: Extracted images in shape (image_idx,band,i,j)
+    :param dtype: Data type of images, e.g. np.float16 to halve memory again -
+                  NB values beyond +-65504 overflow float16, defaults to np.float32
+    :type dtype: npt.DTypeLike, optional
+    :param out: Array of the output shape to write images to (e.g. a np.memmap),
+                or path of .npy file to create as a memmap, defaults to None
+                (new in memory array)
+    :type out: Optional[Union[npt.NDArray, str, PathLike]], optional
+    :param channels_last: Return images in shape (image_idx,i,j,band),
+                          defaults to False
+    :type channels_last: bool, optional
+    :raises ValueError: If out array given is not of the output shape
+    :return: Extracted images in shape (image_idx,band,i,j), or
+             (image_idx,i,j,band) if channels_last
     :rtype: npt.NDArray
     """
     nbands = 0
     for dataset in datasets:
-        with rasterio.open(dataset) as open_file:
-            nbands += len(open_file.indexes)
+        if isinstance(dataset, rasterio.io.DatasetReader):
+            nbands += dataset.count
+        else:
+            with rasterio.open(dataset) as open_file:
+                nbands += len(open_file.indexes)
     if verbose:
         print(f"Overall, {nbands} bands found in datasets")
-    ims = np.zeros((len(hex_codes), nbands, height, width))
-    latlongs = [h3.h3_to_geo(hex_code) for hex_code in hex_codes]
+    if channels_last:
+        shape = (len(hex_codes), height, width, nbands)
+    else:
+        shape = (len(hex_codes), nbands, height, width)
+    if out is None:
+        ims = np.zeros(shape, dtype=dtype)
+    elif isinstance(out, (str, PathLike)):
+        # new .npy files are zero filled
+        ims = np.lib.format.open_memmap(out, mode="w+", dtype=dtype, shape=shape)
+    else:
+        if out.shape != shape:
+            raise ValueError(f"out must have shape {shape}, not {out.shape}")
+        ims = out
+        ims.fill(0)
+    # (image_idx,band,i,j) view of output, to write to
+    bands_first = ims.transpose((0, 3, 1, 2)) if channels_last else ims
+    latlongs = np.array(
+        [h3.h3_to_geo(hex_code) for hex_code in hex_codes], dtype=np.float64
+    ).reshape(-1, 2)
     running_nband = 0
-    for ds_idx, dataset in tqdm(
-        enumerate(datasets), position=0, total=len(datasets), desc="Dataset progress:"
-    ):
-        with rasterio.open(dataset, masked=True) as open_file:
+    for dataset in tqdm(datasets, position=0, desc="Dataset progress:"):
+        if isinstance(dataset, rasterio.io.DatasetReader):
+            # already open, so leave open
+            open_ctx = nullcontext(dataset)
+        else:
+            open_ctx = rasterio.open(dataset)
+        with open_ctx as open_file:
             ds_nbands = len(open_file.indexes)
-            for idx, latlong in tqdm(
-                enumerate(latlongs),
-                position=1,
-                total=len(latlongs),
-                desc="Location progress:",
-            ):
-                im = extract_image_at_coords(
-                    open_file, *latlong, dim_x=width, dim_y=height
-                )  # type: ignore
-                if im.shape[1:] != (height, width):
-                    # NB know that must be less than, as
-                    # trying to read window of specified size
-                    y_diff = height - im.shape[1]
-                    x_diff = width - im.shape[2]
-                    im = np.pad(
-                        im,
-                        (
-                            (0, 0),
-                            (y_diff // 2, y_diff // 2 + y_diff % 2),
-                            (x_diff // 2, x_diff // 2 + x_diff % 2),
-                        ),
-                        "constant",
-                    )
-                ims[idx, running_nband : running_nband + ds_nbands, :, :] = im
+            extract_patches_at_coords(
+                open_file,
+                latlongs[:, 0],
+                latlongs[:, 1],
+                dim_x=width,
+                dim_y=height,
+                out=bands_first[:, running_nband : running_nband + ds_nbands],
+                verbose=verbose,
+            )
             running_nband += ds_nbands
+    if isinstance(ims, np.memmap):
+        ims.flush()
     return ims
 
 
@@ -810,6 +1699,9 @@ def convert_tiffs_to_image_dataset(
     hex_codes: Union[List[int], npt.NDArray[Union[np.int32, np.int64]]],
     dim_x: int = 256,
     dim_y: int = 256,
+    dtype: npt.DTypeLike = np.float32,
+    out: Optional[Union[npt.NDArray, str, PathLike]] = None,
+    channels_last: bool = False,
 ) -> npt.NDArray:
     """Convert set of GeoTIFFs to a 4D numpy array according
     to specified dataset - expect the path to a directory
@@ -830,60 +1722,154 @@ def convert_tiffs_to_image_dataset(
     :type dim_x: int, optional
     :param dim_y: Pixel height of extracted images, defaults to 256
     :type dim_y: int, optional
+    :param dtype: Data type of images, defaults to np.float32
+    :type dtype: npt.DTypeLike, optional
+    :param out: Array or path of .npy file (memmap) to write images to,
+                see extract_ims_from_hex_codes, defaults to None
+    :type out: Optional[Union[npt.NDArray, str, PathLike]], optional
+    :param channels_last: Return images in shape (hex_id, i, j, band),
+                          defaults to False
+    :type channels_last: bool, optional
     :return: Array of images at hex coords, in shape (hex_id, band, i, j)
     :rtype: npt.NDArray
     """
     # absolute path to search for all tiff files inside a specified folder
     path = Path(tiff_dir) / "*.tif"
     # raw_path = path.encode("unicode_escape")
-    tif_files = glob.glob(str(path))
+    tif_files = sorted(glob.glob(str(path)))
 
-    all_ims = extract_ims_from_hex_codes(tif_files, hex_codes, dim_x, dim_y)
+    all_ims = extract_ims_from_hex_codes(
+        tif_files,
+        hex_codes,
+        dim_x,
+        dim_y,
+        dtype=dtype,
+        out=out,
+        channels_last=channels_last,
+    )
     return all_ims
 
 
+def _resample_window(
+    dataset: rasterio.io.DatasetReader,
+    out_shape: Tuple[int, int],
+    window: Window,
+    halo: int,
+) -> npt.NDArray:
+    """Bilinear resample of dataset to out_shape, for one window of the
+    output only - reading the matching (fractional) source window,
+    padded by halo output pixels each side so bilinear support at
+    the window edges matches that of a full read, then cropping
+    """
+    scale_y = dataset.height / out_shape[0]
+    scale_x = dataset.width / out_shape[1]
+    row_start = max(window.row_off - halo, 0)
+    row_stop = min(window.row_off + window.height + halo, out_shape[0])
+    col_start = max(window.col_off - halo, 0)
+    col_stop = min(window.col_off + window.width + halo, out_shape[1])
+    src_window = Window(
+        col_start * scale_x,
+        row_start * scale_y,
+        (col_stop - col_start) * scale_x,
+        (row_stop - row_start) * scale_y,
+    )
+    data = dataset.read(
+        window=src_window,
+        out_shape=(dataset.count, row_stop - row_start, col_stop - col_start),
+        resampling=Resampling.bilinear,
+    )
+    row_off = window.row_off - row_start
+    col_off = window.col_off - col_start
+    return data[:, row_off : row_off + window.height, col_off : col_off + window.width]
+
+
 def resample_tif(
     tif_file_path: Union[str, PathLike],
     dest_dir: Union[str, PathLike],
     rescale_factor: Optional[float] = 2.0,
+    block_size: int = 512,
+    halo: int = 4,
+    n_threads: int = 1,
 ) -> None:
     """Resample a tiff file by a given factor, using bilinear resampling
     - greater than 1 corresponds to increased resolution,
     less than 1 decreased.
 
+    The output is produced one block at a time, each from a windowed
+    read of the source (with a halo for bilinear support), and written
+    to a tiled, compressed GeoTIFF, so memory use is bounded for any
+    raster size. Blocks may be resampled in parallel threads. Output
+    is identical to resampling the full raster at once where block
+    edges fall on whole source pixels (e.g. for factors of 2), else
+    equal up to float rounding of source offsets.
+
     :param tif_file_path: Path to tiff file to resample
     :type tif_file_path: Union[str, PathLike]
     :param dest_dir: Destination directory for resampled tiff file to be written to
     :type dest_dir: Union[str, PathLike]
     :param rescale_factor: Rescale factor, defaults to 2
     :type rescale_factor: Optional[int], optional
+    :param block_size: Height and width of output blocks (tiles) in pixels,
+                       a multiple of 16, defaults to 512
+    :type block_size: int, optional
+    :param halo: Output pixels read beyond each block edge, defaults to 4
+    :type halo: int, optional
+    :param n_threads: Number of threads to resample blocks on, defaults to 1
+    :type n_threads: int, optional
+    :raises ValueError: If output would overwrite tif_file_path
     """
     with rasterio.open(tif_file_path) as dataset:
-        # resample data to target shape
-        data = dataset.read(
-            out_shape=(
-                dataset.count,
-                int(dataset.height * rescale_factor),
-                int(dataset.width * rescale_factor),
-            ),
-            resampling=Resampling.bilinear,
+        out_shape = (
+            int(dataset.height * rescale_factor),
+            int(dataset.width * rescale_factor),
         )
-
         # scale image transform
         transform = dataset.transform * dataset.transform.scale(
-            (dataset.width / data.shape[-1]), (dataset.height / data.shape[-2])
+            (dataset.width / out_shape[1]), (dataset.height / out_shape[0])
         )
-        dest_dir = Path(dest_dir)
-        name = Path(tif_file_path).name
-        with rasterio.open(
-            dest_dir / name,
-            "w",
-            driver="GTiff",
-            height=data.shape[-2],
-            width=data.shape[-1],
-            count=dataset.count,
-            dtype=data.dtype,
-            crs=dataset.crs,
-            transform=transform,
-        ) as dest:
-            dest.write(data)
+        profile = {
+            "driver": "GTiff",
+            "height": out_shape[0],
+            "width": out_shape[1],
+            "count": dataset.count,
+            "dtype": dataset.dtypes[0],
+            "crs": dataset.crs,
+            "transform": transform,
+            "tiled": True,
+            "blockxsize": block_size,
+            "blockysize": block_size,
+            "compress": "deflate",
+        }
+    dest_file = Path(dest_dir) / Path(tif_file_path).name
+    if dest_file.resolve() == Path(tif_file_path).resolve():
+        raise ValueError("Cannot resample tiff in place, dest_dir must differ")
+    # each thread reads through its own handle on the source, all
+    # closed once the resample is done
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def resample(window):
+        dataset = getattr(local, "dataset", None)
+        if dataset is None:
+            dataset = local.dataset = rasterio.open(tif_file_path)
+            with opened_lock:
+                opened.append(dataset)
+        return _resample_window(dataset, out_shape, window, halo)
+
+    try:
+        with rasterio.open(dest_file, "w", **profile) as dest:
+            windows = [window for _, window in dest.block_windows(1)]
+            if n_threads <= 1:
+                for window in windows:
+                    dest.write(resample(window), window=window)
+                return
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                # submit a few blocks ahead per thread only, to bound memory
+                for start in range(0, len(windows), 2 * n_threads):
+                    batch = windows[start : start + 2 * n_threads]
+                    for window, data in zip(batch, executor.map(resample, batch)):
+                        dest.write(data, window=window)
+    finally:
+        for dataset in opened:
+            dataset.close()
@@ -1,14 +1,127 @@
+import math
 from os import PathLike
 from pathlib import Path
-from typing import Optional, Union
+from typing import Dict, List, Optional, Union
 
-import cartopy.io.shapereader as shpreader
 import geopandas as gpd
 import matplotlib.pyplot as plt
 import numpy as np
 import numpy.typing as npt
 import rasterio
-import rasterio.mask
+from rasterio.errors import WindowError
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+
+import stc_unicef_cpi.utils.geospatial as geo
+
+
+def _ctry_window(dataset: rasterio.io.DatasetReader, bounds: npt.NDArray) -> Window:
+    """Window of dataset covering a country bounding box (in the
+    dataset CRS), rounded outwards to whole pixels and clipped to the
+    dataset, as used by rasterio.mask.mask(crop=True)
+
+    :param dataset: Open dataset
+    :type dataset: rasterio.io.DatasetReader
+    :param bounds: Country bounding box minx, miny, maxx, maxy
+    :type bounds: npt.NDArray
+    :raises ValueError: If country does not overlap dataset
+    :return: Window
+    :rtype: Window
+    """
+    inv_transform = ~dataset.transform
+    cols, rows = zip(
+        inv_transform * (bounds[0], bounds[1]), inv_transform * (bounds[2], bounds[3])
+    )
+    row_start, row_stop = math.floor(min(rows)), math.ceil(max(rows))
+    col_start, col_stop = math.floor(min(cols)), math.ceil(max(cols))
+    window = Window(
+        col_start, row_start, max(col_stop - col_start, 0), max(row_stop - row_start, 0)
+    )
+    try:
+        return window.intersection(Window(0, 0, dataset.width, dataset.height))
+    except WindowError:
+        raise ValueError("Country does not overlap raster")
+
+
+def netcdf_to_clipped_arrays(
+    file_path: Union[str, PathLike],
+    ctry_names: List[str],
+    save_dir: Optional[Union[str, PathLike]] = None,
+    plot: bool = False,
+) -> Optional[Dict[str, npt.NDArray]]:
+    """Clip netCDF file to each of several countries, in a single pass
+    over the file, returning the clipped arrays or saving each as a
+    GeoTIFF in the specified directory (with the country name
+    prepended to that of the file).
+
+    For each country, only the window covering its bounding box (from
+    the shared country index) is read, for all bands at once, and
+    pixels outside the country then masked on that small array - so
+    the global grid is never read in full.
+
+    :param file_path: Path to netCDF file to clip
+    :type file_path: Union[str, PathLike]
+    :param ctry_names: Countries to clip to
+    :type ctry_names: List[str]
+    :param save_dir: Directory to save to, defaults to None (just return clipped arrays)
+    :type save_dir: Optional[Union[str, PathLike]], optional
+    :param plot: Visualise clipped arrays, defaults to False
+    :type plot: bool, optional
+    :return: Either None if save_dir is not None, or clipped array per country
+    :rtype: Optional[Dict[str, npt.NDArray]]
+    """
+    fname = Path(file_path).name
+    ctry_index = geo.get_country_index()
+    out_images = {}
+    # use high res version to avoid clipping
+    with rasterio.open(f"netcdf:{file_path}", "r") as netf:
+        # shows pixel scale in crs units
+        print(f"Pixel scale in crs {netf.crs}: {netf.res}")
+        out_meta = netf.meta
+        nodata = netf.nodata if netf.nodata is not None else 0
+        for ctry_name in ctry_names:
+            ctry_shp = ctry_index.geometry(ctry_name)
+            bounds = ctry_index.bounds(ctry_name)
+            if netf.crs is not None and netf.crs != "EPSG:4326":
+                # NB assumes that no CRS corresponds to EPSG:4326 (as standard)
+                ctry_shp = (
+                    gpd.GeoSeries([ctry_shp], crs="EPSG:4326").to_crs(netf.crs).iloc[0]
+                )
+                bounds = ctry_shp.bounds
+            window = _ctry_window(netf, bounds)
+            out_image = netf.read(window=window, masked=True)
+            outside = geometry_mask(
+                [ctry_shp],
+                out_shape=out_image.shape[1:],
+                transform=netf.window_transform(window),
+            )
+            out_image.mask = out_image.mask | outside
+            out_image = out_image.filled(nodata)
+            if plot:
+                plt.imshow(
+                    np.log(out_image[-1, :, :] - out_image[-1].min() + 1), cmap="PiYG"
+                )
+                plt.show()
+            if save_dir is None:
+                out_images[ctry_name] = out_image
+                continue
+            ctry_meta = dict(
+                out_meta,
+                driver="GTiff",
+                height=out_image.shape[1],
+                width=out_image.shape[2],
+                transform=netf.window_transform(window),
+            )
+            with rasterio.open(
+                Path(save_dir)
+                / (ctry_name.lower() + "_" + fname.rstrip(".nc") + ".tif"),
+                "w",
+                **ctry_meta,
+            ) as dest:
+                dest.write(out_image)
+    if save_dir is not None:
+        return None
+    return out_images
 
 
 def netcdf_to_clipped_array(
@@ -21,7 +134,8 @@ def netcdf_to_clipped_array(
     """Read netCDF file and return either array clipped to
     specified country, or a GeoTIFF clipped to this country
     and saved in the specified directory with same name as
-    before
+    before - reading only the window about the country, see
+    netcdf_to_clipped_arrays
 
     :param file_path: Path to netCDF file to reproject and clip
     :type file_path: Union[str, PathLike]
@@ -34,61 +148,9 @@ def netcdf_to_clipped_array(
     :return: Either None if save_dir is not None, or clipped array
     :rtype: Union[None, npt.NDArray]
     """
-
-    fname = Path(file_path).name
-    # world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
-    # use high res version to avoid clipping
-    shpfilename = shpreader.natural_earth(
-        resolution="10m", category="cultural", name="admin_0_countries"
+    out_images = netcdf_to_clipped_arrays(
+        file_path, [ctry_name], save_dir=save_dir, plot=plot
     )
-    reader = shpreader.Reader(shpfilename)
-    world = reader.records()
-    with rasterio.open(f"netcdf:{file_path}", "r", masked=True) as netf:
-        ctry_shp = next(
-            filter(lambda x: x.attributes["NAME"] == ctry_name, world)
-        ).geometry
-        if netf.crs is not None and netf.crs != "EPSG:4326":
-            # NB assumes that no CRS corresponds to EPSG:4326 (as standard)
-            ctry_shp = gpd.GeoSeries(ctry_shp)
-            ctry_shp.crs = "EPSG:4326"
-            ctry_shp = ctry_shp.to_crs(netf.crs).geometry
-        print(
-            f"Pixel scale in crs {netf.crs}: {netf.res}"
-        )  # shows pixel scale in crs units
-        # print(netf.window(*nga_bbox))
-        # nga_subset = netf.read(window=netf.window(*nga_bbox))
-        # print(nga_subset[-1].min(),nga_subset[-1].max())
-        # plt.imshow(np.log(nga_subset[-1,:,:]+10),cmap='PiYG')
-        # plt.show()
-        try:
-            out_image, out_transform = rasterio.mask.mask(netf, ctry_shp, crop=True)
-        except TypeError:
-            # polygon not iterable
-            out_image, out_transform = rasterio.mask.mask(netf, [ctry_shp], crop=True)
-        if plot:
-            plt.imshow(
-                np.log(out_image[-1, :, :] - out_image[-1].min() + 1), cmap="PiYG"
-            )
-            plt.show()
-        out_meta = netf.meta
-
-    if save_dir is not None:
-        save_dir = Path(save_dir)
-        out_meta.update(
-            {
-                "driver": "GTiff",
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform,
-            }
-        )
-
-        with rasterio.open(
-            save_dir / (ctry_name.lower() + "_" + fname.rstrip(".nc") + ".tif"),
-            "w",
-            **out_meta,
-        ) as dest:
-            dest.write(out_image)
+    if out_images is None:
         return None
-    else:
-        return out_image
+    return out_images[ctry_name]
@@ -3,13 +3,25 @@ import os
 import warnings
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from .process_geotiff import extract_ims_from_hex_codes
+from .process_geotiff import (
+    close_open_datasets,
+    extract_ims_from_hex_codes,
+    get_open_dataset,
+)
 
 try:
     import torch
-    from torch.utils.data import Dataset, TensorDataset
+    from torch.utils.data import (
+        BatchSampler,
+        Dataset,
+        RandomSampler,
+        SequentialSampler,
+        TensorDataset,
+        default_collate,
+    )
 except ImportError:
     warnings.warn(
         "Necessary imports for torch dataloader not found - assumed not desired"
@@ -45,7 +57,9 @@ def make_torch_dataloader_from_numpy(images, labels, bs=64, shuffle=False):
 
 class HexDataset(Dataset):
     """Make a torch dataset that constructs images from
-    tiff files according to hex codes
+    tiff files according to hex codes, or reads them from
+    a (memory-mapped) patch store if given, see data.patch_store.
+    Use with get_hex_dataloader to read a batch at a time.
 
     :param Dataset: _description_
     :type Dataset: _type_
@@ -60,10 +74,11 @@ class HexDataset(Dataset):
         height=33,
         transform=None,
         target_transform=None,
+        patch_store=None,
     ):
         # absolute path to search for all tiff files inside a specified folder
         path = str(Path(tiff_dir) / "*.tif")
-        self.tif_files = glob.glob(path)
+        self.tif_files = sorted(glob.glob(path))
         try:
             assert len(hex_codes) == len(labels)
         except AssertionError:
@@ -74,18 +89,80 @@ class HexDataset(Dataset):
         self.target_transform = target_transform
         self.width = width
         self.height = height
+        # if given, read images from (memory-mapped) patch store rather
+        # than extracting from tiffs
+        self.patch_store = patch_store
+        if patch_store is not None:
+            patch_store.indices(hex_codes)
 
     def __len__(self):
         return len(self.labels)
 
-    def __getitem__(self, idx):
-        hex_code = self.hex_codes[idx]
-        image = extract_ims_from_hex_codes(
-            self.tif_files, [hex_code], width=self.width, height=self.height
+    def _get_images(self, idxs):
+        hex_codes = [self.hex_codes[idx] for idx in idxs]
+        if self.patch_store is not None:
+            return self.patch_store.get(hex_codes, channels_last=False)
+        # reuse datasets already open in this worker, rather than
+        # reopening every tiff per sample
+        return extract_ims_from_hex_codes(
+            [get_open_dataset(tif_file) for tif_file in self.tif_files],
+            hex_codes,
+            width=self.width,
+            height=self.height,
         )
-        label = self.img_labels.iloc[idx, 1]
+
+    def _get_sample(self, idx, image):
+        label = self.labels[idx]
         if self.transform:
             image = self.transform(image)
         if self.target_transform:
             label = self.target_transform(label)
         return image, label
+
+    def __getitem__(self, idx):
+        """Get a sample, or a (collated) batch of samples if given a list
+        of indices, as from the BatchSampler of get_hex_dataloader, in
+        which case all images of the batch are extracted at once"""
+        if np.ndim(idx) == 0:
+            return self._get_sample(idx, self._get_images([idx]))
+        images = self._get_images(idx)
+        return default_collate(
+            [self._get_sample(i, images[j : j + 1]) for j, i in enumerate(idx)]
+        )
+
+    def close(self):
+        """Close datasets opened to read images in this process - those
+        opened by DataLoader workers are closed as the workers exit"""
+        close_open_datasets(all_threads=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_hex_dataloader(dataset, batch_size=64, shuffle=False, **kwargs):
+    """Make a torch dataloader for a HexDataset that reads each batch
+    with a single call, by sampling batches of indices (with a
+    BatchSampler) rather than single indices - so images of a batch
+    are extracted together, rather than per sample
+
+    :param dataset: dataset of hexes
+    :type dataset: HexDataset
+    :param batch_size: batch size, defaults to 64
+    :type batch_size: int, optional
+    :param shuffle: shuffle samples each epoch, defaults to False
+    :type shuffle: bool, optional
+    :return: dataloader, with any further kwargs (e.g. num_workers) passed on
+    :rtype: torch.utils.data.DataLoader
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    # batches are already collated by the dataset, so disable automatic
+    # batching (batch_size=None)
+    return torch.utils.data.DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        **kwargs,
+    )
@@ -0,0 +1,244 @@
+"""Per-country raster stack: every feature layer of a country aligned
+to one grid (that of the population raster), as a single multi-band
+virtual raster (VRT) with a JSON manifest of band names and sources,
+so that consumers open one dataset and read all bands for a window in
+a single call, rather than opening and reading each file in turn.
+
+Layers already on the grid are referenced in place, others are
+reprojected onto it once (see process_geotiff.clip_reproject_to_target)
+and the aligned copy referenced instead. Bands take the names given
+to them by process_geotiff.get_band_names for their source file, so
+aggregating the stack gives the same columns as aggregating each file."""
+import json
+import os
+import xml.etree.ElementTree as ET
+from os import PathLike
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Pattern, Union
+
+import numpy as np
+import rasterio
+
+import stc_unicef_cpi.data.process_geotiff as pg
+
+
+def stack_path(save_dir: Union[str, PathLike], country: str) -> Path:
+    """Path of raster stack for a country
+
+    :param save_dir: Directory stack is saved in
+    :type save_dir: Union[str, PathLike]
+    :param country: Country of interest
+    :type country: str
+    :return: Path of .vrt file (with manifest alongside, as .json)
+    :rtype: Path
+    """
+    return Path(save_dir) / f"{country.lower()}_stack.vrt"
+
+
+def manifest_path(stack_file: Union[str, PathLike]) -> Path:
+    """Path of manifest of a raster stack
+
+    :param stack_file: Path of stack .vrt file
+    :type stack_file: Union[str, PathLike]
+    :return: Path of .json manifest
+    :rtype: Path
+    """
+    return Path(stack_file).with_suffix(".json")
+
+
+def _file_key(file_path: Union[str, PathLike]) -> List[Any]:
+    stat = os.stat(file_path)
+    return [str(Path(file_path).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+def is_aligned(
+    dataset: rasterio.io.DatasetReader, target: rasterio.io.DatasetReader
+) -> bool:
+    """Whether dataset is on the same grid (CRS, transform and shape)
+    as target
+
+    :param dataset: Open dataset
+    :type dataset: rasterio.io.DatasetReader
+    :param target: Open dataset of target grid
+    :type target: rasterio.io.DatasetReader
+    :return: Whether aligned
+    :rtype: bool
+    """
+    return (
+        dataset.crs == target.crs
+        and dataset.shape == target.shape
+        and dataset.transform.almost_equals(target.transform)
+    )
+
+
+def _stack_vrt(
+    target: rasterio.io.DatasetReader, bands: List[Dict[str, Any]], dtype: str
+) -> str:
+    """VRT XML stacking given source bands, all on the target grid"""
+    vrt = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(target.width),
+        rasterYSize=str(target.height),
+    )
+    if target.crs is not None:
+        ET.SubElement(vrt, "SRS").text = target.crs.to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(
+        repr(float(coef)) for coef in target.transform.to_gdal()
+    )
+    gdal_dtype = {"float32": "Float32", "float64": "Float64"}[dtype]
+    for band_idx, band in enumerate(bands, start=1):
+        vrt_band = ET.SubElement(
+            vrt, "VRTRasterBand", dataType=gdal_dtype, band=str(band_idx)
+        )
+        ET.SubElement(vrt_band, "Description").text = band["name"]
+        # bands from the same file are masked jointly when aggregating,
+        # see process_geotiff._read_valid_pixels
+        metadata = ET.SubElement(vrt_band, "Metadata")
+        ET.SubElement(metadata, "MDI", key="STACK_GROUP").text = str(band["group"])
+        if band["nodata"] is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(float(band["nodata"]))
+        source = ET.SubElement(vrt_band, "SimpleSource")
+        ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = band["source"]
+        ET.SubElement(source, "SourceBand").text = str(band["source_band"])
+        rect = {
+            "xOff": "0",
+            "yOff": "0",
+            "xSize": str(target.width),
+            "ySize": str(target.height),
+        }
+        ET.SubElement(source, "SrcRect", **rect)
+        ET.SubElement(source, "DstRect", **rect)
+    return ET.tostring(vrt, encoding="unicode")
+
+
+def build_stack(
+    tif_files: Union[List[str], List[PathLike]],
+    target_file: Union[str, PathLike],
+    stack_file: Union[str, PathLike],
+    rm_prefix: Union[str, Pattern[str]] = "",
+    align_dir: Optional[Union[str, PathLike]] = None,
+    force: bool = False,
+    verbose: bool = False,
+) -> Path:
+    """Build a stack of all bands of the given tiff files, on the grid
+    of target_file, as a single multi-band VRT, with a manifest of band
+    names and sources alongside - unless already built from the same
+    (unmodified) files.
+
+    :param tif_files: Tiff files to stack, in order
+    :type tif_files: Union[List[str], List[PathLike]]
+    :param target_file: Tiff file on grid to align to, e.g. population raster
+    :type target_file: Union[str, PathLike]
+    :param stack_file: Path of .vrt file to write, see stack_path
+    :type stack_file: Union[str, PathLike]
+    :param rm_prefix: Prefix (or regex pattern) to replace in file names when
+                      naming bands, as for geotiff_to_df, defaults to ""
+    :type rm_prefix: Union[str, Pattern[str]], optional
+    :param align_dir: Directory for reprojected copies of files not on the
+                      target grid, defaults to None (directory "aligned"
+                      alongside stack_file)
+    :type align_dir: Optional[Union[str, PathLike]], optional
+    :param force: Rebuild even if up to date, defaults to False
+    :type force: bool, optional
+    :param verbose: Verbose, defaults to False
+    :type verbose: bool, optional
+    :raises ValueError: If band names are not unique across files
+    :return: Path of stack
+    :rtype: Path
+    """
+    stack_file = Path(stack_file)
+    manifest_file = manifest_path(stack_file)
+    sources = [_file_key(tif_file) for tif_file in tif_files]
+    key = {"sources": sources, "target": _file_key(target_file)}
+    if not force and stack_file.exists():
+        manifest = load_manifest(stack_file)
+        if manifest is not None and manifest.get("key") == key:
+            if verbose:
+                print(f"Stack {stack_file.name} up to date.")
+            return stack_file
+
+    if align_dir is None:
+        align_dir = stack_file.parent / "aligned"
+    align_dir = Path(align_dir)
+    bands = []
+    dtype = "float32"
+    with rasterio.open(target_file) as target:
+        for group, tif_file in enumerate(tif_files):
+            band_names = pg.get_band_names(tif_file, rm_prefix=rm_prefix)
+            with rasterio.open(tif_file) as dataset:
+                aligned = is_aligned(dataset, target)
+            source = Path(tif_file).resolve()
+            if not aligned:
+                align_dir.mkdir(parents=True, exist_ok=True)
+                source = (align_dir / Path(tif_file).name).resolve()
+                if (
+                    not source.exists()
+                    or os.stat(source).st_mtime_ns < os.stat(tif_file).st_mtime_ns
+                ):
+                    if verbose:
+                        print(f"Aligning {Path(tif_file).name} to target grid...")
+                    pg.clip_reproject_to_target(
+                        tif_file, target_file, source, band_names=band_names
+                    )
+            with rasterio.open(source) as dataset:
+                if np.dtype(dataset.dtypes[0]) == np.float64:
+                    dtype = "float64"
+                for band_idx, band_name in zip(dataset.indexes, band_names):
+                    bands.append(
+                        {
+                            "name": band_name,
+                            "file": str(Path(tif_file).resolve()),
+                            "source": str(source),
+                            "source_band": band_idx,
+                            "nodata": dataset.nodatavals[band_idx - 1],
+                            "group": group,
+                        }
+                    )
+        names = [band["name"] for band in bands]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Band names not unique across files: {names}")
+        vrt = _stack_vrt(target, bands, dtype)
+
+    # write manifest last, so only up to date once both written
+    manifest_file.unlink(missing_ok=True)
+    tmp_file = stack_file.with_name(f"{stack_file.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(vrt)
+    os.replace(tmp_file, stack_file)
+    manifest = {"key": key, "bands": bands}
+    tmp_file = manifest_file.with_name(f"{manifest_file.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp_file, manifest_file)
+    if verbose:
+        print(f"Stacked {len(bands)} bands from {len(tif_files)} files.")
+    return stack_file
+
+
+def load_manifest(stack_file: Union[str, PathLike]) -> Optional[Dict[str, Any]]:
+    """Load manifest of raster stack
+
+    :param stack_file: Path of stack .vrt file
+    :type stack_file: Union[str, PathLike]
+    :return: Manifest, with "bands" list of dicts of name, file (original),
+             source (file referenced), source_band, nodata and group (index
+             of file) of each band, or None if no manifest
+    :rtype: Optional[Dict[str, Any]]
+    """
+    try:
+        return json.loads(manifest_path(stack_file).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def stack_band_names(stack_file: Union[str, PathLike]) -> List[str]:
+    """Names of bands of raster stack, in order
+
+    :param stack_file: Path of stack .vrt file
+    :type stack_file: Union[str, PathLike]
+    :raises FileNotFoundError: If stack has no manifest
+    :return: Band names
+    :rtype: List[str]
+    """
+    manifest = load_manifest(stack_file)
+    if manifest is None:
+        raise FileNotFoundError(f"No manifest for stack {stack_file}")
+    return [band["name"] for band in manifest["bands"]]
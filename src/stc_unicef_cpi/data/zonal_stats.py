@@ -0,0 +1,668 @@
+"""Per-hex (zonal) statistics of raster pixel values, computed
+with NumPy reductions over dense hex labels rather than pandas
+groupby, along with running accumulators allowing rasters to be
+aggregated to h3 cells a chunk (e.g. a strip of rows) at a time."""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from scipy import sparse
+
+# Statistics computed by zonal_stats
+ZONAL_STATS = ("count", "sum", "mean", "var", "std", "min", "max")
+# Statistics computed by zonal_stats only if pixel weights are given
+WEIGHTED_STATS = ("wmean",)
+# Statistics available with fractional (area-weighted) pixel coverage
+COVERAGE_STATS = ("mean", "sum")
+
+# Aggregation functions that can be computed from running accumulators,
+# mapped to name of the corresponding statistic. NB all NaN-aware, as
+# is the case for the pandas groupby equivalents.
+STREAMABLE_AGG_FNS = {
+    np.mean: "mean",
+    np.nanmean: "mean",
+    np.sum: "sum",
+    np.nansum: "sum",
+    np.min: "min",
+    np.nanmin: "min",
+    np.max: "max",
+    np.nanmax: "max",
+    "mean": "mean",
+    "sum": "sum",
+    "min": "min",
+    "max": "max",
+    "count": "count",
+    "var": "var",
+    "std": "std",
+}
+
+
+def check_stats(stats: Sequence[str], weighted: bool = False) -> List[str]:
+    """Check requested statistics are all supported, i.e. can
+    be computed in a single pass over the pixels of a raster
+
+    :param stats: Names of statistics
+    :type stats: Sequence[str]
+    :param weighted: Pixel weights are available, so weighted
+                     statistics are allowed, defaults to False
+    :type weighted: bool, optional
+    :raises ValueError: If any statistic is not supported
+    :return: List of statistics
+    :rtype: List[str]
+    """
+    if isinstance(stats, str):
+        stats = [stats]
+    allowed = ZONAL_STATS + WEIGHTED_STATS if weighted else ZONAL_STATS
+    unknown = set(stats) - set(allowed)
+    if len(unknown) > 0:
+        if not weighted and len(unknown - set(WEIGHTED_STATS)) == 0:
+            raise ValueError(f"Statistics {unknown} require pixel weights")
+        raise ValueError(f"Unsupported statistics: {unknown}, must be from {allowed}")
+    return list(stats)
+
+
+def check_band_names(band_names: Sequence[Optional[str]]) -> List[str]:
+    """Check band names are unique (and given), as needed to name
+    columns <band>_<stat> when returning several statistics
+
+    :param band_names: Names of bands
+    :type band_names: Sequence[Optional[str]]
+    :raises ValueError: If any band name is missing or repeated
+    :return: List of band names
+    :rtype: List[str]
+    """
+    band_names = list(band_names)
+    if None in band_names or len(set(band_names)) < len(band_names):
+        raise ValueError(
+            "Bands must have unique names to return several statistics, "
+            f"found {band_names}"
+        )
+    return band_names
+
+
+def get_stat_name(agg_fn: Callable[[npt.NDArray], npt.NDArray]) -> Optional[str]:
+    """Get name of statistic corresponding to aggregation function,
+    if it can be computed from running accumulators
+
+    :param agg_fn: Aggregation function
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray]
+    :return: Name of statistic, or None if not streamable
+    :rtype: Optional[str]
+    """
+    try:
+        return STREAMABLE_AGG_FNS.get(agg_fn)  # type: ignore
+    except TypeError:
+        # unhashable
+        return None
+
+
+def zonal_stats(
+    labels: npt.NDArray,
+    values: npt.NDArray,
+    n_labels: int,
+    stats: Sequence[str] = ZONAL_STATS,
+    weights: Optional[npt.NDArray] = None,
+) -> Dict[str, npt.NDArray]:
+    """Compute NaN-aware statistics of pixel values within each
+    label (hex), for all bands at once, using bincount reductions
+    over a combined (band, label) index.
+
+    Variance (and standard deviation) use ddof=1, as for pandas,
+    and are computed from deviations about the label mean for
+    numerical stability.
+
+    If pixel weights are given (e.g. population), the weighted mean
+    "wmean" may also be computed, using only pixels with both a valid
+    value and a valid weight. The underlying weighted sum of values
+    and total weight are available as "wsum" and "wtotal".
+    The sum of squared deviations is also available as "m2".
+
+    :param labels: Dense label of each pixel in [0, n_labels), with
+                   negative labels ignored, shape (n_pixels,)
+    :type labels: npt.NDArray
+    :param values: Pixel values, shape (n_bands, n_pixels)
+    :type values: npt.NDArray
+    :param n_labels: Number of labels
+    :type n_labels: int
+    :param stats: Statistics to compute, from "count", "sum", "mean",
+                  "var", "std", "m2", "min", "max", and if weights are given
+                  "wmean", "wsum", "wtotal", defaults to ZONAL_STATS
+    :type stats: Sequence[str], optional
+    :param weights: Weight of each pixel, shape (n_pixels,), defaults to None
+    :type weights: Optional[npt.NDArray], optional
+    :return: Dict of statistic name to array of shape (n_bands, n_labels),
+             with NaN where a label has no valid pixels (or fewer than two
+             for variance), except count and sum which are zero
+    :rtype: Dict[str, npt.NDArray]
+    """
+    weighted_stats = {"wmean", "wsum", "wtotal"} & set(stats)
+    if len(weighted_stats) > 0 and weights is None:
+        raise ValueError(f"Statistics {weighted_stats} require pixel weights")
+    unknown = set(stats) - set(ZONAL_STATS) - {"m2"} - weighted_stats
+    if len(unknown) > 0:
+        raise ValueError(f"Unsupported statistics: {unknown}")
+    labels = np.asarray(labels).reshape(-1)
+    values = np.asarray(values).reshape(-1, len(labels))
+    nbands = values.shape[0]
+    size = nbands * n_labels
+    valid = ~np.isnan(values)
+    valid &= (labels >= 0)[np.newaxis, :]
+    band_idx = np.arange(nbands)[:, np.newaxis] * n_labels + labels
+    flat_idx = band_idx[valid]
+    vals = values[valid].astype(np.float64)
+
+    res = {}
+    if len(weighted_stats) > 0:
+        weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+        w_valid = valid & ~np.isnan(weights)[np.newaxis, :]
+        w_idx = band_idx[w_valid]
+        band_weights = np.broadcast_to(weights, values.shape)[w_valid]
+        res["wsum"] = np.bincount(
+            w_idx, weights=band_weights * values[w_valid], minlength=size
+        )
+        res["wtotal"] = np.bincount(w_idx, weights=band_weights, minlength=size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            res["wmean"] = res["wsum"] / res["wtotal"]
+        res["wmean"][res["wtotal"] == 0] = np.nan
+        del w_valid, w_idx, band_weights
+    del valid, band_idx
+    count = np.bincount(flat_idx, minlength=size)
+    res["count"] = count
+    empty = count == 0
+    if {"sum", "mean", "var", "std", "m2"} & set(stats):
+        total = np.bincount(flat_idx, weights=vals, minlength=size)
+        res["sum"] = total
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = total / count
+        res["mean"] = mean
+        if {"var", "std", "m2"} & set(stats):
+            dev = vals - mean[flat_idx]
+            m2 = np.bincount(flat_idx, weights=dev * dev, minlength=size)
+            res["m2"] = m2
+            with np.errstate(invalid="ignore", divide="ignore"):
+                var = m2 / (count - 1)
+            var[count < 2] = np.nan
+            res["var"] = var
+            res["std"] = np.sqrt(var)
+    if "min" in stats:
+        minima = np.full(size, np.inf)
+        np.minimum.at(minima, flat_idx, vals)
+        minima[empty] = np.nan
+        res["min"] = minima
+    if "max" in stats:
+        maxima = np.full(size, -np.inf)
+        np.maximum.at(maxima, flat_idx, vals)
+        maxima[empty] = np.nan
+        res["max"] = maxima
+    return {stat: res[stat].reshape(nbands, n_labels) for stat in stats}
+
+
+def zonal_apply(
+    labels: npt.NDArray,
+    values: npt.NDArray,
+    n_labels: int,
+    agg_fn: Callable[[npt.NDArray], npt.NDArray],
+) -> npt.NDArray:
+    """Apply an arbitrary aggregation function to the valid (non-NaN)
+    pixel values within each label, for each band. Slower than
+    zonal_stats as requires a python call per label and band, but
+    avoids any dataframe copies by sorting pixels by label once.
+
+    :param labels: Dense label of each pixel in [0, n_labels), with
+                   negative labels ignored, shape (n_pixels,)
+    :type labels: npt.NDArray
+    :param values: Pixel values, shape (n_bands, n_pixels)
+    :type values: npt.NDArray
+    :param n_labels: Number of labels
+    :type n_labels: int
+    :param agg_fn: Aggregation function, taking 1D array of values
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray]
+    :return: Aggregated values, shape (n_bands, n_labels), NaN where
+             a label has no valid pixels
+    :rtype: npt.NDArray
+    """
+    labels = np.asarray(labels).reshape(-1)
+    values = np.asarray(values).reshape(-1, len(labels))
+    res = np.full((values.shape[0], n_labels), np.nan)
+    in_label = labels >= 0
+    order = np.argsort(labels[in_label], kind="stable")
+    sorted_labels = labels[in_label][order]
+    for band_idx, band_vals in enumerate(values):
+        band_vals = band_vals[in_label][order]
+        valid = ~np.isnan(band_vals)
+        band_labels = sorted_labels[valid]
+        band_vals = band_vals[valid]
+        uniq, starts = np.unique(band_labels, return_index=True)
+        for label, group in zip(uniq, np.split(band_vals, starts[1:])):
+            res[band_idx, label] = agg_fn(group)
+    return res
+
+
+def zonal_aggregate(
+    labels: npt.NDArray,
+    values: npt.NDArray,
+    n_labels: int,
+    agg_fn: Callable[[npt.NDArray], npt.NDArray] = np.mean,
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """Aggregate valid pixel values within each label for each band,
+    using bincount reductions where agg_fn is a supported statistic,
+    else applying agg_fn to each label in turn
+
+    :param labels: Dense label of each pixel in [0, n_labels), with
+                   negative labels ignored, shape (n_pixels,)
+    :type labels: npt.NDArray
+    :param values: Pixel values, shape (n_bands, n_pixels)
+    :type values: npt.NDArray
+    :param n_labels: Number of labels
+    :type n_labels: int
+    :param agg_fn: Aggregation function, defaults to np.mean
+    :type agg_fn: Callable[[npt.NDArray], npt.NDArray], optional
+    :return: Aggregated values and number of valid pixels, both of
+             shape (n_bands, n_labels)
+    :rtype: Tuple[npt.NDArray, npt.NDArray]
+    """
+    stat = get_stat_name(agg_fn)
+    if stat is None:
+        counts = zonal_stats(labels, values, n_labels, stats=["count"])["count"]
+        return zonal_apply(labels, values, n_labels, agg_fn), counts
+    res = zonal_stats(labels, values, n_labels, stats=list({"count", stat}))
+    return res[stat].astype(np.float64), res["count"]
+
+
+def coverage_sums(
+    coverage: sparse.spmatrix, values: npt.NDArray
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """Sum valid (non-NaN) pixel values within each hex, weighted by
+    the fraction of each pixel covered by the hex, along with the
+    total covered area of valid pixels - one sparse matrix product
+    for all bands
+
+    :param coverage: Sparse pixel-hex coverage fractions, shape
+                     (n_pixels, n_hexes)
+    :type coverage: sparse.spmatrix
+    :param values: Pixel values, shape (n_bands, n_pixels)
+    :type values: npt.NDArray
+    :return: Coverage-weighted sums of values and total valid coverage,
+             both of shape (n_bands, n_hexes)
+    :rtype: Tuple[npt.NDArray, npt.NDArray]
+    """
+    values = np.asarray(values).reshape(-1, coverage.shape[0])
+    valid = ~np.isnan(values)
+    cov_t = coverage.T.tocsr()
+    wsum = cov_t @ np.where(valid, values, 0.0).T
+    wtotal = cov_t @ valid.T.astype(np.float64)
+    return np.asarray(wsum).T, np.asarray(wtotal).T
+
+
+def stats_to_frame(
+    stat_vals: npt.NDArray,
+    counts: Optional[npt.NDArray],
+    band_names: Sequence[str],
+    hex_codes: npt.NDArray,
+) -> pd.DataFrame:
+    """Convert per-hex statistics to a dataframe indexed by hex code,
+    keeping only hexes with at least one valid pixel in any band
+    (or all hexes if counts not given)
+
+    :param stat_vals: Statistic values, shape (n_bands, n_hexes)
+    :type stat_vals: npt.NDArray
+    :param counts: Number of valid pixels, shape (n_bands, n_hexes),
+                   or None to keep all hexes
+    :type counts: Optional[npt.NDArray]
+    :param band_names: Column names for bands
+    :type band_names: Sequence[str]
+    :param hex_codes: Hex code for each label
+    :type hex_codes: npt.NDArray
+    :return: Dataframe indexed by hex_code, with column per band
+    :rtype: pd.DataFrame
+    """
+    if counts is None:
+        keep = np.ones(stat_vals.shape[1], dtype=bool)
+    else:
+        keep = (counts > 0).any(axis=0)
+    return pd.DataFrame(
+        stat_vals[:, keep].T,
+        columns=list(band_names),
+        index=pd.Index(np.asarray(hex_codes)[keep], name="hex_code"),
+    )
+
+
+class HexAccumulator:
+    """Accumulate per-hex statistics of pixel values over
+    successive chunks of a raster, so that memory use depends
+    only on chunk size and number of hexes, not raster size.
+
+    Hexes are added as they are first seen, and NaN values are
+    ignored, so final results match those of pandas groupby
+    aggregation. Variance is accumulated as running (count, mean,
+    sum of squared deviations) per hex, merging each chunk with
+    the parallel form of Welford's algorithm (Chan et al.), which
+    avoids the cancellation of sum-of-squares approaches. Weighted
+    means are accumulated as weighted sums and total weights, so
+    require weights to be passed with each chunk.
+
+    :param band_names: Names of bands to accumulate
+    :type band_names: Sequence[str]
+    :param stats: Statistics to accumulate, from "count", "sum", "mean",
+                  "var", "std", "min", "max", "wmean", defaults to ("mean",)
+    :type stats: Sequence[str], optional
+    :param hex_codes: Sorted unique hex codes, if known in advance
+                      (e.g. from a label raster), defaults to None
+    :type hex_codes: Optional[npt.NDArray], optional
+    """
+
+    def __init__(
+        self,
+        band_names: Sequence[str],
+        stats: Sequence[str] = ("mean",),
+        hex_codes: Optional[npt.NDArray] = None,
+    ):
+        self.band_names = list(band_names)
+        self.stats = check_stats(stats, weighted=True)
+        self.weighted = "wmean" in self.stats
+        self._track_m2 = "var" in self.stats or "std" in self.stats
+        self._kernel_stats = ["count"]
+        if {"mean", "sum"} & set(self.stats) or self._track_m2:
+            self._kernel_stats.append("sum")
+        if self._track_m2:
+            self._kernel_stats += ["mean", "m2"]
+        self._kernel_stats += [stat for stat in ("min", "max") if stat in stats]
+        if self.weighted:
+            self._kernel_stats += ["wsum", "wtotal"]
+        if hex_codes is None:
+            hex_codes = np.empty(0, dtype=np.int64)
+        self.hex_codes = np.asarray(hex_codes, dtype=np.int64)
+        shape = (len(self.band_names), len(self.hex_codes))
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.wsum = np.zeros(shape)
+        self.wtotal = np.zeros(shape)
+
+    def _add_hexes(self, hex_codes: npt.NDArray) -> None:
+        """Add accumulators for any hexes not yet seen
+
+        :param hex_codes: Sorted, unique hex codes from latest chunk
+        :type hex_codes: npt.NDArray
+        """
+        new_codes = np.setdiff1d(hex_codes, self.hex_codes, assume_unique=True)
+        if len(new_codes) == 0:
+            return
+        all_codes = np.union1d(self.hex_codes, new_codes)
+        old_pos = np.searchsorted(all_codes, self.hex_codes)
+        nbands = len(self.band_names)
+        for name, fill in (
+            ("count", 0),
+            ("sum", 0.0),
+            ("min", np.inf),
+            ("max", -np.inf),
+            ("mean", 0.0),
+            ("m2", 0.0),
+            ("wsum", 0.0),
+            ("wtotal", 0.0),
+        ):
+            old = getattr(self, name)
+            new = np.full((nbands, len(all_codes)), fill, dtype=old.dtype)
+            new[:, old_pos] = old
+            setattr(self, name, new)
+        self.hex_codes = all_codes
+
+    def update(
+        self,
+        hex_codes: npt.NDArray,
+        values: npt.NDArray,
+        weights: Optional[npt.NDArray] = None,
+    ) -> None:
+        """Fold a chunk of pixels into the running accumulators
+
+        :param hex_codes: Hex code of each pixel, shape (n_pixels,)
+        :type hex_codes: npt.NDArray
+        :param values: Pixel values, shape (n_bands, n_pixels)
+        :type values: npt.NDArray
+        :param weights: Weight of each pixel, shape (n_pixels,), required
+                        if accumulating weighted statistics, defaults to None
+        :type weights: Optional[npt.NDArray], optional
+        """
+        hex_codes = np.asarray(hex_codes).reshape(-1)
+        values = np.asarray(values).reshape(len(self.band_names), -1)
+        # aggregate within chunk first using chunk-local labels,
+        # then fold into global accumulators at matching positions
+        chunk_codes, labels = np.unique(hex_codes, return_inverse=True)
+        labels = labels.reshape(-1)
+        self._add_hexes(chunk_codes)
+        glob_pos = np.searchsorted(self.hex_codes, chunk_codes)
+        self._fold(labels, glob_pos, len(chunk_codes), values, weights)
+
+    def update_labels(
+        self,
+        labels: npt.NDArray,
+        values: npt.NDArray,
+        weights: Optional[npt.NDArray] = None,
+    ) -> None:
+        """Fold a chunk of pixels into the running accumulators, where
+        pixels are already labelled by index into hex_codes (with
+        negative labels for pixels to ignore)
+
+        :param labels: Label of each pixel, shape (n_pixels,)
+        :type labels: npt.NDArray
+        :param values: Pixel values, shape (n_bands, n_pixels)
+        :type values: npt.NDArray
+        :param weights: Weight of each pixel, shape (n_pixels,), required
+                        if accumulating weighted statistics, defaults to None
+        :type weights: Optional[npt.NDArray], optional
+        """
+        labels = np.asarray(labels).reshape(-1)
+        values = np.asarray(values).reshape(len(self.band_names), -1)
+        in_hex = labels >= 0
+        if not in_hex.all():
+            labels = labels[in_hex]
+            values = values[:, in_hex]
+            if weights is not None:
+                weights = np.asarray(weights).reshape(-1)[in_hex]
+        self._fold(labels, slice(None), len(self.hex_codes), values, weights)
+
+    def _fold(
+        self,
+        labels: npt.NDArray,
+        glob_pos: Union[npt.NDArray, slice],
+        n_chunk: int,
+        values: npt.NDArray,
+        weights: Optional[npt.NDArray] = None,
+    ) -> None:
+        """Aggregate values by label, and add to accumulators at glob_pos
+
+        :param labels: Chunk label of each pixel, shape (n_pixels,)
+        :type labels: npt.NDArray
+        :param glob_pos: Position in accumulators of each chunk label
+        :type glob_pos: Union[npt.NDArray, slice]
+        :param n_chunk: Number of distinct chunk labels
+        :type n_chunk: int
+        :param values: Pixel values, shape (n_bands, n_pixels)
+        :type values: npt.NDArray
+        :param weights: Weight of each pixel, shape (n_pixels,), defaults to None
+        :type weights: Optional[npt.NDArray], optional
+        """
+        chunk = zonal_stats(
+            labels, values, n_chunk, stats=self._kernel_stats, weights=weights
+        )
+        if self._track_m2:
+            # merge (count, mean, m2) of chunk into running values
+            n_a = self.count[:, glob_pos]
+            n_b = chunk["count"]
+            n_ab = n_a + n_b
+            with np.errstate(invalid="ignore", divide="ignore"):
+                delta = np.where(n_b > 0, chunk["mean"] - self.mean[:, glob_pos], 0.0)
+                frac_b = np.where(n_ab > 0, n_b / n_ab, 0.0)
+            self.mean[:, glob_pos] += delta * frac_b
+            self.m2[:, glob_pos] += chunk["m2"] + delta * delta * n_a * frac_b
+        self.count[:, glob_pos] += chunk["count"]
+        if "sum" in chunk:
+            self.sum[:, glob_pos] += chunk["sum"]
+        if "min" in chunk:
+            # fmin/fmax ignore NaN for hexes without valid pixels in chunk
+            self.min[:, glob_pos] = np.fmin(self.min[:, glob_pos], chunk["min"])
+        if "max" in chunk:
+            self.max[:, glob_pos] = np.fmax(self.max[:, glob_pos], chunk["max"])
+        if self.weighted:
+            self.wsum[:, glob_pos] += chunk["wsum"]
+            self.wtotal[:, glob_pos] += chunk["wtotal"]
+
+    def result(self, stat: Optional[str] = None) -> pd.DataFrame:
+        """Return accumulated statistic per hex, for hexes with
+        at least one valid pixel value in any band, with NaN for
+        bands without. As for a pandas groupby, count and sum are
+        instead zero without valid pixels, so returned for all hexes.
+
+        :param stat: Statistic to return, defaults to None (first of stats)
+        :type stat: Optional[str], optional
+        :return: Dataframe indexed by hex_code, with column per band
+        :rtype: pd.DataFrame
+        """
+        if stat is None:
+            stat = self.stats[0]
+        has_vals = self.count > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if stat == "count":
+                vals = self.count.astype(np.float64)
+            elif stat == "mean":
+                vals = self.sum / self.count
+            elif stat == "sum":
+                vals = self.sum.copy()
+            elif stat == "min":
+                vals = self.min.copy()
+            elif stat == "max":
+                vals = self.max.copy()
+            elif stat == "wmean" and self.weighted:
+                vals = self.wsum / self.wtotal
+                vals[self.wtotal == 0] = np.nan
+            elif stat in ("var", "std") and self._track_m2:
+                vals = self.m2 / (self.count - 1)
+                vals[self.count < 2] = np.nan
+                if stat == "std":
+                    vals = np.sqrt(vals)
+            else:
+                raise ValueError(f"Statistic {stat} not accumulated")
+        if stat in ("count", "sum"):
+            return stats_to_frame(vals, None, self.band_names, self.hex_codes)
+        vals[~has_vals] = np.nan
+        return stats_to_frame(vals, self.count, self.band_names, self.hex_codes)
+
+    def results(self, stats: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Return several accumulated statistics per hex, in columns
+        named <band>_<stat>, for hexes with at least one valid pixel
+        value in any band (or all hexes, if count or sum is returned)
+
+        :param stats: Statistics to return, defaults to None (all accumulated)
+        :type stats: Optional[Sequence[str]], optional
+        :raises ValueError: If band names are not unique
+        :return: Dataframe indexed by hex_code, with column per band and stat
+        :rtype: pd.DataFrame
+        """
+        if stats is None:
+            stats = self.stats
+        check_band_names(self.band_names)
+        res = pd.concat(
+            [self.result(stat).add_suffix(f"_{stat}") for stat in stats], axis=1
+        )
+        # order columns by band, then stat
+        return res[[f"{band}_{stat}" for band in self.band_names for stat in stats]]
+
+
+class CoverageAccumulator:
+    """Accumulate per-hex area-weighted statistics of pixel values
+    over successive chunks of a raster, where each pixel contributes
+    to every hex it overlaps in proportion to the overlap.
+
+    "mean" is then the coverage-weighted mean of valid pixel values
+    in each hex, while "sum" apportions pixel values between hexes
+    by area (appropriate for counts, e.g. population).
+
+    :param band_names: Names of bands to accumulate
+    :type band_names: Sequence[str]
+    :param hex_codes: Sorted unique hex codes, matching columns of
+                      coverage matrices
+    :type hex_codes: npt.NDArray
+    :param stats: Statistics to accumulate, from "mean", "sum",
+                  defaults to ("mean",)
+    :type stats: Sequence[str], optional
+    """
+
+    def __init__(
+        self,
+        band_names: Sequence[str],
+        hex_codes: npt.NDArray,
+        stats: Sequence[str] = ("mean",),
+    ):
+        if isinstance(stats, str):
+            stats = [stats]
+        unknown = set(stats) - set(COVERAGE_STATS)
+        if len(unknown) > 0:
+            raise ValueError(
+                f"Statistics {unknown} not supported with fractional coverage, "
+                f"must be from {COVERAGE_STATS}"
+            )
+        self.band_names = list(band_names)
+        self.stats = list(stats)
+        self.hex_codes = np.asarray(hex_codes, dtype=np.int64)
+        shape = (len(self.band_names), len(self.hex_codes))
+        self.wsum = np.zeros(shape)
+        self.wtotal = np.zeros(shape)
+
+    def update(self, coverage: sparse.spmatrix, values: npt.NDArray) -> None:
+        """Fold a chunk of pixels into the running accumulators
+
+        :param coverage: Sparse coverage of chunk pixels by hexes, shape
+                         (n_pixels, n_hexes)
+        :type coverage: sparse.spmatrix
+        :param values: Pixel values, shape (n_bands, n_pixels)
+        :type values: npt.NDArray
+        """
+        wsum, wtotal = coverage_sums(coverage, values)
+        self.wsum += wsum
+        self.wtotal += wtotal
+
+    def result(self, stat: Optional[str] = None) -> pd.DataFrame:
+        """Return accumulated statistic per hex, for hexes overlapping
+        at least one valid pixel in any band. Means are NaN for bands
+        with no valid pixels in a hex, while sums are zero.
+
+        :param stat: Statistic to return, defaults to None (first of stats)
+        :type stat: Optional[str], optional
+        :return: Dataframe indexed by hex_code, with column per band
+        :rtype: pd.DataFrame
+        """
+        if stat is None:
+            stat = self.stats[0]
+        if stat == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                vals = self.wsum / self.wtotal
+        elif stat == "sum":
+            vals = self.wsum.copy()
+        else:
+            raise ValueError(f"Statistic {stat} not accumulated")
+        has_vals = self.wtotal > 0
+        if stat != "sum":
+            vals[~has_vals] = np.nan
+        return stats_to_frame(vals, has_vals, self.band_names, self.hex_codes)
+
+    def results(self, stats: Optional[Sequence[str]] = None) -> pd.DataFrame:
+        """Return several accumulated statistics per hex, in columns
+        named <band>_<stat>
+
+        :param stats: Statistics to return, defaults to None (all accumulated)
+        :type stats: Optional[Sequence[str]], optional
+        :raises ValueError: If band names are not unique
+        :return: Dataframe indexed by hex_code, with column per band and stat
+        :rtype: pd.DataFrame
+        """
+        if stats is None:
+            stats = self.stats
+        check_band_names(self.band_names)
+        res = pd.concat(
+            [self.result(stat).add_suffix(f"_{stat}") for stat in stats], axis=1
+        )
+        return res[[f"{band}_{stat}" for band in self.band_names for stat in stats]]
@@ -1,12 +1,16 @@
 import glob
+import hashlib
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
-from sklearn.preprocessing import StandardScaler
 
+from stc_unicef_cpi.data import band_stats as bs
 from stc_unicef_cpi.data import cv_loaders as cvl
+from stc_unicef_cpi.data import patch_store as ps
 from stc_unicef_cpi.data import process_geotiff as pg
 
 try:
@@ -22,44 +26,321 @@ except ImportError:
         "Necessary modules for autoencoder features not found - assumed not desired"
     )
 
+try:
+    import onnxruntime as ort
+    import tf2onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    ort = None
+    warnings.warn(
+        "onnxruntime / tf2onnx not found - ONNX export of autoencoder encoder unavailable"
+    )
+
+
+def _check_onnx():
+    """Raise ImportError unless ONNX export and inference available"""
+    if ort is None:
+        raise ImportError(
+            "onnxruntime and tf2onnx are required for ONNX export and inference, "
+            "install with: pip install stc_unicef_cpi[onnx]"
+        )
+
 
 def set_seed(random_state=0):
     """Set seed"""
     np.random.seed(random_state)
 
 
-def get_train_data(tiff_dir, hex_codes, dim=16):
+def band_stats_path(model_dir, model_name):
+    """Path of band stats saved alongside autoencoder model
+
+    :param model_dir: directory of saved keras model
+    :type model_dir: str
+    :param model_name: name of saved model inside model_dir
+    :type model_name: str
+    :return: path of .npz file of band stats
+    :rtype: Path
+    """
+    return Path(model_dir) / (model_name + "_band_stats.npz")
+
+
+def get_train_data(
+    tiff_dir,
+    hex_codes,
+    dim=16,
+    dtype=np.float32,
+    out=None,
+    store_dir=None,
+    band_stats=None,
+    return_stats=False,
+    batch_size=4096,
+):
     """Get training data for the autoencoder
 
+    Images are extracted directly in channels last order, then each
+    band standardised (by its mean and std over all images, found in a
+    single streaming pass unless band_stats given) and NaNs filled in
+    place, so peak memory is that of the returned array - use
+    dtype=np.float16 and/or out to reduce this further. If store_dir
+    is given, images are instead read from a patch store there (built
+    on first use), so rasters are only read once.
+
     :param tiff_dir: directory containing all country tiffs
     :type tiff_dir: str
     :param hex_codes: H3 hexagons for training set
     :type hex_codes: _type_
     :param dim: dimension for images extracted from rasters, defaults to 16
     :type dim: int, optional
-    :return: numpy array of size (len(hex_codes), 16, 16, total channels from tiff_dir)
+    :param dtype: data type of images, defaults to np.float32
+    :type dtype: numpy dtype, optional
+    :param out: array of shape (len(hex_codes), dim, dim, total channels), or
+                path of .npy file to create as a memmap, to write images to,
+                defaults to None (new array)
+    :type out: numpy array or str, optional
+    :param store_dir: directory of patch stores to read images from,
+                      defaults to None (extract from tiffs)
+    :type store_dir: str, optional
+    :param band_stats: per-band stats to standardise with, defaults to None
+                       (compute from images)
+    :type band_stats: BandStats, optional
+    :param return_stats: also return band stats used, to save alongside the
+                         trained model, defaults to False
+    :type return_stats: bool, optional
+    :param batch_size: number of images per batch when computing band stats
+                       and standardising, defaults to 4096
+    :type batch_size: int, optional
+    :raises ValueError: if both out and store_dir given
+    :return: numpy array of size (len(hex_codes), 16, 16, total channels from tiff_dir),
+             and band stats if return_stats
     :rtype: numpy array
     """
     set_seed()
-    data = pg.convert_tiffs_to_image_dataset(tiff_dir, hex_codes, dim, dim)
-    shape = data.shape
+    if store_dir is None:
+        data = pg.convert_tiffs_to_image_dataset(
+            tiff_dir, hex_codes, dim, dim, dtype=dtype, out=out, channels_last=True
+        )
+    else:
+        if out is not None:
+            raise ValueError("out cannot be used with store_dir")
+        tif_files = sorted(glob.glob(str(Path(tiff_dir) / "*.tif")))
+        store = ps.get_patch_store(tif_files, hex_codes, store_dir, dim, dim, dtype)
+        # copy, as scaled in place
+        data = store.get(hex_codes)
+
+    batch_starts = range(0, len(data), batch_size)
+    if band_stats is None:
+        band_stats = bs.compute_band_stats(
+            data[start : start + batch_size] for start in batch_starts
+        )
+    # scale data and fill nans, in place
+    for start in batch_starts:
+        band_stats.transform(data[start : start + batch_size], copy=False)
+
+    if isinstance(data, np.memmap):
+        data.flush()
+    if return_stats:
+        return data, band_stats
+    return data
+
+
+def split_hex_codes(hex_codes, validation_split=0.1, random_state=0):
+    """Randomly split hex codes into training and validation sets
 
-    # scale data
-    data = StandardScaler().fit_transform(data.reshape(data.shape[0], -1))
-    data = data.reshape(shape)
+    :param hex_codes: H3 hexagons to split
+    :type hex_codes: array-like
+    :param validation_split: fraction of hexes for validation, defaults to 0.1
+    :type validation_split: float, optional
+    :param random_state: random state, defaults to 0
+    :type random_state: int, optional
+    :return: training and validation hex codes
+    :rtype: tuple of numpy arrays
+    """
+    hex_codes = np.asarray(hex_codes, dtype=np.int64)
+    idxs = np.random.default_rng(random_state).permutation(len(hex_codes))
+    n_val = int(round(validation_split * len(hex_codes)))
+    return hex_codes[idxs[n_val:]], hex_codes[idxs[:n_val]]
 
-    # channels last
-    data = np.transpose(data, (0, 2, 3, 1))
 
-    # fill nans
-    if np.isnan(np.sum(data)):
-        lower_bound = np.min(data[~np.isnan(data)])
-        if lower_bound < 0:
-            data = np.nan_to_num(data, nan=2 * lower_bound)
+def get_train_dataset(
+    hex_codes,
+    band_stats,
+    tif_files=None,
+    patch_store=None,
+    dim=16,
+    batch_size=None,
+    chunk_size=256,
+    cache_file=None,
+    shuffle=True,
+    shuffle_buffer=8192,
+    random_state=0,
+):
+    """Get a tf.data pipeline of standardised images about hexes for the
+    autoencoder, as (image, image) pairs, so that training data need not
+    fit in memory and extraction overlaps with training.
+
+    Hexes are split into chunks, whose images are extracted from tiffs
+    (or read from a patch store) in parallel, standardised with
+    band_stats, then optionally cached to file (so later epochs skip
+    extraction), shuffled, batched and prefetched.
+
+    :param hex_codes: H3 hexagons to get images about
+    :type hex_codes: array-like
+    :param band_stats: band stats to standardise images with, as saved
+                       alongside the model
+    :type band_stats: BandStats
+    :param tif_files: tiff files to extract (and stack) bands from,
+                      defaults to None
+    :type tif_files: list, optional
+    :param patch_store: patch store containing all hexes to read from
+                        instead of tif_files, defaults to None
+    :type patch_store: PatchStore, optional
+    :param dim: dimension for images extracted from rasters, defaults to 16
+    :type dim: int, optional
+    :param batch_size: batch size, defaults to None (unbatched, e.g. so
+                       batch size may be tuned)
+    :type batch_size: int, optional
+    :param chunk_size: number of hexes extracted per parallel task,
+                       defaults to 256
+    :type chunk_size: int, optional
+    :param cache_file: file to cache standardised images to, "" to cache in
+                       memory, defaults to None (no caching)
+    :type cache_file: str, optional
+    :param shuffle: shuffle images each epoch, defaults to True
+    :type shuffle: bool, optional
+    :param shuffle_buffer: number of images in shuffle buffer, defaults to 8192
+    :type shuffle_buffer: int, optional
+    :param random_state: random state for shuffling, defaults to 0
+    :type random_state: int, optional
+    :raises ValueError: unless exactly one of tif_files and patch_store given
+    :return: dataset of (image, image) pairs, each image of shape (dim, dim, bands)
+    :rtype: tf.data.Dataset
+    """
+    if (tif_files is None) == (patch_store is None):
+        raise ValueError("Exactly one of tif_files and patch_store must be given")
+    hex_codes = np.asarray(hex_codes, dtype=np.int64)
+    n_bands = band_stats.n_bands
+
+    def load_chunk(start):
+        chunk = hex_codes[start : start + chunk_size]
+        if patch_store is not None:
+            images = patch_store.get(chunk)
         else:
-            data = np.nan_to_num(data, nan=-2 * lower_bound)
+            # tf.data runs this in a pool of threads, each with own datasets
+            images = pg.extract_ims_from_hex_codes(
+                [pg.get_open_dataset(tif_file) for tif_file in tif_files],
+                chunk,
+                width=dim,
+                height=dim,
+                channels_last=True,
+            )
+        return band_stats.transform(images, copy=False).astype(np.float32, copy=False)
 
-    return data
+    def load(start):
+        images = tensorflow.numpy_function(load_chunk, [start], tensorflow.float32)
+        images.set_shape((None, dim, dim, n_bands))
+        return images
+
+    dataset = tensorflow.data.Dataset.from_tensor_slices(
+        np.arange(0, len(hex_codes), chunk_size)
+    )
+    if shuffle and cache_file is None:
+        # if cached, order fixed after first epoch, so only shuffle images
+        dataset = dataset.shuffle(len(dataset), seed=random_state)
+    dataset = dataset.map(
+        load, num_parallel_calls=tensorflow.data.AUTOTUNE, deterministic=not shuffle
+    ).unbatch()
+    if cache_file is not None:
+        dataset = dataset.cache(cache_file)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=random_state)
+    dataset = dataset.map(lambda image: (image, image))
+    if batch_size is not None:
+        dataset = dataset.batch(batch_size)
+    return dataset.prefetch(tensorflow.data.AUTOTUNE)
+
+
+def get_train_datasets(
+    tiff_dir,
+    hex_codes,
+    dim=16,
+    validation_split=0.1,
+    store_dir=None,
+    cache_dir=None,
+    random_state=0,
+):
+    """Streamed counterpart of get_train_data: compute band stats over
+    all hexes in a single pass, then get (unbatched) tf.data pipelines
+    for a random split of hexes into training and validation sets,
+    for use with get_best_hyperparameters and get_trained_autoencoder.
+
+    :param tiff_dir: directory containing all country tiffs
+    :type tiff_dir: str
+    :param hex_codes: H3 hexagons for training set
+    :type hex_codes: array-like
+    :param dim: dimension for images extracted from rasters, defaults to 16
+    :type dim: int, optional
+    :param validation_split: fraction of hexes for validation, defaults to 0.1
+    :type validation_split: float, optional
+    :param store_dir: directory of patch stores to read images from, built on
+                      first use, defaults to None (extract from tiffs)
+    :type store_dir: str, optional
+    :param cache_dir: directory to cache standardised images in, defaults to
+                      None (no caching)
+    :type cache_dir: str, optional
+    :param random_state: random state, defaults to 0
+    :type random_state: int, optional
+    :return: training and validation datasets, and band stats to save
+             alongside the trained model
+    :rtype: tuple
+    """
+    set_seed(random_state)
+    tif_files = sorted(glob.glob(str(Path(tiff_dir) / "*.tif")))
+    if store_dir is not None:
+        store = ps.get_patch_store(tif_files, hex_codes, store_dir, dim, dim)
+        band_stats = bs.band_stats_from_store(store)
+        sources = {"patch_store": store}
+    else:
+        band_stats = bs.band_stats_from_tiffs(tif_files, hex_codes, dim, dim)
+        sources = {"tif_files": tif_files}
+    train_hexes, val_hexes = split_hex_codes(hex_codes, validation_split, random_state)
+    datasets = []
+    for name, hexes in [("train", train_hexes), ("val", val_hexes)]:
+        cache_file = None
+        if cache_dir is not None:
+            Path(cache_dir).mkdir(parents=True, exist_ok=True)
+            # key cache by hexes, so never reused for a different split
+            key = hashlib.sha1(np.ascontiguousarray(hexes).tobytes()).hexdigest()
+            cache_file = str(Path(cache_dir) / f"autoencoder_{name}_{key[:16]}_cache")
+        datasets.append(
+            get_train_dataset(
+                hexes,
+                band_stats,
+                dim=dim,
+                cache_file=cache_file,
+                shuffle=name == "train",
+                random_state=random_state,
+                **sources,
+            )
+        )
+    return datasets[0], datasets[1], band_stats
+
+
+def _is_dataset(input_data):
+    return isinstance(input_data, tensorflow.data.Dataset)
+
+
+def _sample_shape(input_data):
+    """Shape of a single image of input data, array or dataset"""
+    if _is_dataset(input_data):
+        return tuple(input_data.element_spec[0].shape[-3:])
+    return input_data.shape[1:]
+
+
+def _batched(dataset, batch_size):
+    """Batch dataset of single (image, image) pairs, if not already batched"""
+    if dataset.element_spec[0].shape.rank == 3:
+        dataset = dataset.batch(batch_size).prefetch(tensorflow.data.AUTOTUNE)
+    return dataset
 
 
 def get_best_hyperparameters(
@@ -72,10 +353,13 @@ def get_best_hyperparameters(
     logdir="autoencoder",
     project_name="tune_model",
     es_patience=5,
+    validation_data=None,
 ):
     """Get the tuned hyperparameters for the model
 
-    :param input_data: image input of size (num of samples, width, height, bands)
+    :param input_data: image input of size (num of samples, width, height, bands),
+                       or tf.data.Dataset of (image, image) pairs, e.g. from
+                       get_train_datasets
     :type input_data: _type_
     :param random_state: random state, defaults to 0
     :type random_state: int, optional
@@ -93,10 +377,18 @@ def get_best_hyperparameters(
     :type project_name: str, optional
     :param es_patience:  patience for early stopping, defaults to 5
     :type es_patience: int, optional
-    :return: dictionary with best learning rate, batch size & epoch
-    :rtype: _type_
+    :param validation_data: tf.data.Dataset of (image, image) pairs for
+                            validation, required (in place of validation_split)
+                            if input_data is a dataset, defaults to None
+    :type validation_data: tf.data.Dataset, optional
+    :raises ValueError: if input_data is a dataset but validation_data not given
+    :return: dictionary with best learning_rate, batch_size & epochs, as
+             for get_trained_autoencoder
+    :rtype: dict
     """
-    input_dims = input_data.shape
+    if _is_dataset(input_data) and validation_data is None:
+        raise ValueError("validation_data must be given if input_data is a dataset")
+    input_dims = (None, *_sample_shape(input_data))
 
     class HyperModel(kt.HyperModel):
         def build(self, hp):
@@ -155,11 +447,19 @@ def get_best_hyperparameters(
             return model
 
         def fit(self, hp, model, *args, **kwargs):
+            hp_batch_size = hp.Choice("batch_size", batch_size)
+            callbacks = [EarlyStopping(monitor="val_loss", patience=es_patience)]
+            if validation_data is not None:
+                return model.fit(
+                    _batched(args[0], hp_batch_size),
+                    validation_data=_batched(validation_data, hp_batch_size),
+                    callbacks=callbacks,
+                )
             fitted = model.fit(
                 *args,
-                batch_size=hp.Choice("batch_size", batch_size),
+                batch_size=hp_batch_size,
                 validation_split=validation_split,
-                callbacks=[EarlyStopping(monitor="val_loss", patience=es_patience)],
+                callbacks=callbacks,
             )
             return fitted
 
@@ -173,25 +473,38 @@ def get_best_hyperparameters(
         seed=random_state,
     )
 
-    tuner.search(input_data, input_data)
+    if _is_dataset(input_data):
+        # close datasets opened by tf.data threads once done reading
+        with pg.reusing_open_datasets():
+            tuner.search(input_data)
+    else:
+        tuner.search(input_data, input_data)
     best_hps = tuner.get_best_hyperparameters()[0]
     print(
         f"""best LR: {best_hps.get('learning_rate')}, best batch size: {best_hps.get('batch_size')}."""
     )
     model = tuner.hypermodel.build(best_hps)
-    history = model.fit(
-        input_data,
-        input_data,
-        epochs=epochs,
-        validation_split=validation_split,
-    )
+    if _is_dataset(input_data):
+        with pg.reusing_open_datasets():
+            history = model.fit(
+                _batched(input_data, best_hps.get("batch_size")),
+                epochs=epochs,
+                validation_data=_batched(validation_data, best_hps.get("batch_size")),
+            )
+    else:
+        history = model.fit(
+            input_data,
+            input_data,
+            epochs=epochs,
+            validation_split=validation_split,
+        )
     val_loss_per_epoch = history.history["val_loss"]
     best_epoch = val_loss_per_epoch.index(min(val_loss_per_epoch)) + 1
     print("Best epoch: ", str(best_epoch))
 
     hps = {
-        "learning rate": best_hps.get("learning_rate"),
-        "batch size": best_hps.get("batch_size"),
+        "learning_rate": best_hps.get("learning_rate"),
+        "batch_size": best_hps.get("batch_size"),
         "epochs": best_epoch,
     }
 
@@ -205,12 +518,14 @@ def get_trained_autoencoder(
     learning_rate=0.001,
     save_dir=None,
     model_name=None,
+    band_stats=None,
 ):
     """
     Get the trained model using tuned hyperparameters
 
     :param input_data: image input of size (num of samples, width, height, bands) - reshaped & imputed
-                       input of convert_tiffs_to_image_dataset
+                       input of convert_tiffs_to_image_dataset, or tf.data.Dataset
+                       of (image, image) pairs, e.g. from get_train_datasets
     :type input_data: _type_
     :param batch_size: batch size for training, defaults to 128
     :type batch_size: int, optional
@@ -222,11 +537,15 @@ def get_trained_autoencoder(
     :type savedir: str, optional
     :param model_name: name of saved h5 model file, defaults to "autoencoder"
     :type model_name: str, optional
+    :param band_stats: band stats input_data was standardised with, saved
+                       alongside model so the same are used for encoding,
+                       defaults to None
+    :type band_stats: BandStats, optional
     :return: If save_dir=None, Keras sequential model else None
     :rtype: _type_
     """
 
-    input_dims = input_data.shape
+    input_dims = (None, *_sample_shape(input_data))
     model = tensorflow.keras.Sequential()
     model.add(keras.Input(shape=input_dims[1:]))
     model.add(Conv2D(32, (3, 3), activation="relu", padding="same", name="conv1"))
@@ -259,12 +578,19 @@ def get_trained_autoencoder(
         optimizer=Adam(learning_rate=learning_rate),
         loss=keras.losses.MeanSquaredError(),
     )
-    model.fit(input_data, input_data, batch_size=batch_size, epochs=epochs)
+    if _is_dataset(input_data):
+        # close datasets opened by tf.data threads once done reading
+        with pg.reusing_open_datasets():
+            model.fit(_batched(input_data, batch_size), epochs=epochs)
+    else:
+        model.fit(input_data, input_data, batch_size=batch_size, epochs=epochs)
     if save_dir is not None:
         if model_name is None:
             print("Warning: No model_name given, saving as autoencoder.h5")
             model_name = "autoencoder"
         model.save(Path(save_dir) / (model_name + ".h5"))
+        if band_stats is not None:
+            band_stats.save(band_stats_path(save_dir, model_name))
     else:
         return model
 
@@ -277,6 +603,8 @@ def get_encoded_features(
     gpu,
     dim=16,
     batch_size=4096,
+    store_dir=None,
+    encoder=None,
 ):
     """Get encoded features in batches
 
@@ -292,17 +620,72 @@ def get_encoded_features(
     :type dim: int, optional
     :param batch_size: batch size for getting predictions, defaults to 4096
     :type batch_size: int, optional
+    :param store_dir: directory of patch stores to read images from, built on
+                      first use, defaults to None (extract from tiffs per batch)
+    :type store_dir: str, optional
+    :param encoder: encoder from get_encoder, to reuse across calls,
+                    defaults to None (load from trained_autoencoder_dir)
+    :type encoder: keras.Model, optional
     :return: numpy array of size (len(hex_codes), 32)
     :rtype: numpy array
+
+    Images are standardised with the band stats saved alongside the model
+    in training, if present, else (for older models) per batch.
+    """
+    intermediate_model = encoder
+    if intermediate_model is None:
+        intermediate_model = get_encoder(trained_autoencoder_dir, model_name)
+    pred_generator = _get_pred_generator(
+        trained_autoencoder_dir,
+        model_name,
+        hex_codes,
+        tiff_files_dir,
+        dim,
+        batch_size,
+        store_dir,
+    )
+    if gpu:
+        encodings = intermediate_model.predict(
+            pred_generator, use_multiprocessing=True, workers=6
+        )
+    else:
+        encodings = intermediate_model.predict(
+            pred_generator, use_multiprocessing=False
+        )
+    r_encode = encodings.reshape(encodings.shape[0], -1)
+    return r_encode
+
+
+def get_encoder(trained_autoencoder_dir, model_name):
+    """Load encoder part of saved autoencoder, up to Encoder_Output
+
+    :param trained_autoencoder_dir: directory for saved keras model
+    :type trained_autoencoder_dir: str
+    :param model_name: name of saved model inside trained_autoencoder_dir
+    :type model_name: str
+    :return: encoder model
+    :rtype: keras.Model
     """
     trained_autoencoder = tensorflow.keras.models.load_model(
         Path(trained_autoencoder_dir) / (model_name + ".h5")
     )
-    intermediate_model = tensorflow.keras.models.Model(
+    return tensorflow.keras.models.Model(
         inputs=trained_autoencoder.input,
         outputs=trained_autoencoder.get_layer("Encoder_Output").output,
     )
-    files = glob.glob(str(Path(tiff_files_dir) / "*.tif"))
+
+
+def _get_pred_generator(
+    trained_autoencoder_dir,
+    model_name,
+    hex_codes,
+    tiff_files_dir,
+    dim,
+    batch_size,
+    store_dir,
+):
+    """Generator of standardised images about hexes, in order, for prediction"""
+    files = sorted(glob.glob(str(Path(tiff_files_dir) / "*.tif")))
     params = {
         "dim": (dim, dim),
         "hex_idxs": hex_codes,
@@ -310,17 +693,197 @@ def get_encoded_features(
         "data_files": files,
         "shuffle": False,
     }
-    pred_generator = cvl.KerasDataGenerator(**params)
-    if gpu:
-        encodings = intermediate_model.predict(
-            pred_generator, use_multiprocessing=True, workers=6
+    if store_dir is not None:
+        params["patch_store"] = ps.get_patch_store(
+            files, hex_codes, store_dir, dim, dim
         )
-    else:
-        encodings = intermediate_model.predict(
-            pred_generator, use_multiprocessing=False
+    band_stats = bs.load_band_stats(
+        band_stats_path(trained_autoencoder_dir, model_name)
+    )
+    if band_stats is None:
+        warnings.warn(
+            f"No band stats saved with {model_name}, standardising images per batch"
         )
-    r_encode = encodings.reshape(encodings.shape[0], -1)
-    return r_encode
+    params["band_stats"] = band_stats
+    return cvl.KerasDataGenerator(**params)
+
+
+def encoder_onnx_path(model_dir, model_name, quantize=None):
+    """Path of ONNX encoder exported alongside autoencoder model
+
+    :param model_dir: directory of saved keras model
+    :type model_dir: str
+    :param model_name: name of saved model inside model_dir
+    :type model_name: str
+    :param quantize: quantization of exported encoder, "int8", "fp16" or
+                     None (float32), defaults to None
+    :type quantize: str, optional
+    :return: path of .onnx file
+    :rtype: Path
+    """
+    suffix = "_encoder" if quantize is None else f"_encoder_{quantize}"
+    return Path(model_dir) / (model_name + suffix + ".onnx")
+
+
+def export_encoder_onnx(
+    trained_autoencoder_dir, model_name, quantize=None, opset=13, overwrite=False
+):
+    """Export encoder part of saved autoencoder to ONNX, alongside the
+    keras model, for fast CPU inference with get_encoded_features_onnx
+
+    :param trained_autoencoder_dir: directory for saved keras model
+    :type trained_autoencoder_dir: str
+    :param model_name: name of saved model inside trained_autoencoder_dir
+    :type model_name: str
+    :param quantize: also quantize encoder, "int8" (dynamic quantization of
+                     weights) or "fp16", defaults to None (float32 only)
+    :type quantize: str, optional
+    :param opset: ONNX opset to export to, defaults to 13
+    :type opset: int, optional
+    :param overwrite: re-export if already exported, defaults to False
+    :type overwrite: bool, optional
+    :raises ValueError: if quantize not one of None, "int8", "fp16"
+    :raises ImportError: if onnxruntime, tf2onnx (or for fp16, onnx and
+                         onnxconverter_common) not installed
+    :return: path of exported encoder
+    :rtype: Path
+    """
+    if quantize not in (None, "int8", "fp16"):
+        raise ValueError(f"Unknown quantization {quantize}, use 'int8' or 'fp16'")
+    _check_onnx()
+    fp32_path = encoder_onnx_path(trained_autoencoder_dir, model_name)
+    if overwrite or not fp32_path.exists():
+        encoder = get_encoder(trained_autoencoder_dir, model_name)
+        input_signature = [
+            tensorflow.TensorSpec(
+                (None, *encoder.input_shape[1:]), tensorflow.float32, name="input"
+            )
+        ]
+        tf2onnx.convert.from_keras(
+            encoder,
+            input_signature=input_signature,
+            opset=opset,
+            output_path=str(fp32_path),
+        )
+    if quantize is None:
+        return fp32_path
+
+    out_path = encoder_onnx_path(trained_autoencoder_dir, model_name, quantize)
+    if overwrite or not out_path.exists():
+        if quantize == "int8":
+            quantize_dynamic(
+                str(fp32_path), str(out_path), weight_type=QuantType.QUInt8
+            )
+        else:
+            try:
+                import onnx
+                from onnxconverter_common import float16
+            except ImportError as err:
+                raise ImportError(
+                    "onnx and onnxconverter_common are required for fp16 "
+                    "quantization, install with: pip install stc_unicef_cpi[onnx]"
+                ) from err
+
+            onnx.save(
+                float16.convert_float_to_float16(
+                    onnx.load(str(fp32_path)), keep_io_types=True
+                ),
+                str(out_path),
+            )
+    return out_path
+
+
+def get_onnx_session(onnx_path, n_threads=None):
+    """Get onnxruntime CPU session for exported encoder, using all
+    cores by default
+
+    :param onnx_path: path of exported encoder
+    :type onnx_path: str
+    :param n_threads: number of threads to run inference on, defaults to
+                      None (number of cores)
+    :type n_threads: int, optional
+    :raises ImportError: if onnxruntime not installed
+    :return: inference session
+    :rtype: onnxruntime.InferenceSession
+    """
+    _check_onnx()
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = n_threads or os.cpu_count()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(
+        str(onnx_path), options, providers=["CPUExecutionProvider"]
+    )
+
+
+def get_encoded_features_onnx(
+    trained_autoencoder_dir,
+    model_name,
+    hex_codes,
+    tiff_files_dir,
+    dim=16,
+    batch_size=4096,
+    store_dir=None,
+    quantize=None,
+    n_threads=None,
+):
+    """Get encoded features in batches on CPU, with the encoder exported
+    to ONNX (exported on first use) - the next batch of images is
+    extracted while the current batch is encoded across all cores
+
+    :param trained_autoencoder_dir: directory for saved keras model
+    :type trained_autoencoder_dir: str
+    :param model_name: name of saved model inside trained_autoencoder_dir
+    :type model_name: str
+    :param hex_codes: numpy array containing H3 hexagons for which to generate predictions
+    :type hex_codes: numpy array
+    :param tiff_files_dir: file path for geotiffs
+    :type tiff_files_dir: str
+    :param dim: dimension for images extracted from rasters, defaults to 16
+    :type dim: int, optional
+    :param batch_size: batch size for getting predictions, defaults to 4096
+    :type batch_size: int, optional
+    :param store_dir: directory of patch stores to read images from, built on
+                      first use, defaults to None (extract from tiffs per batch)
+    :type store_dir: str, optional
+    :param quantize: quantization of encoder, "int8", "fp16" or None
+                     (float32), defaults to None
+    :type quantize: str, optional
+    :param n_threads: number of threads to run inference on, defaults to
+                      None (number of cores)
+    :type n_threads: int, optional
+    :raises ImportError: if onnxruntime, tf2onnx not installed
+    :return: numpy array of size (len(hex_codes), 32)
+    :rtype: numpy array
+    """
+    _check_onnx()
+    onnx_path = encoder_onnx_path(trained_autoencoder_dir, model_name, quantize)
+    if not onnx_path.exists():
+        onnx_path = export_encoder_onnx(trained_autoencoder_dir, model_name, quantize)
+    session = get_onnx_session(onnx_path, n_threads)
+    input_name = session.get_inputs()[0].name
+    pred_generator = _get_pred_generator(
+        trained_autoencoder_dir,
+        model_name,
+        hex_codes,
+        tiff_files_dir,
+        dim,
+        batch_size,
+        store_dir,
+    )
+
+    def load_batch(index):
+        return np.asarray(pred_generator[index], dtype=np.float32)
+
+    encodings = []
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_batch = executor.submit(load_batch, 0)
+        for index in range(len(pred_generator)):
+            batch = next_batch.result()
+            if index + 1 < len(pred_generator):
+                next_batch = executor.submit(load_batch, index + 1)
+            encoding = session.run(None, {input_name: batch})[0]
+            encodings.append(encoding.reshape(encoding.shape[0], -1))
+    return np.concatenate(encodings)
 
 
 def check_autoencoder_reconstruction(trained_autoencoder, input_data):
@@ -2,6 +2,7 @@ import pandas as pd
 import shutil
 import os
 import numpy as np
+from pathlib import Path
 
 from stc_unicef_cpi.features import autoencoder_features as af
 
@@ -9,12 +10,21 @@ from stc_unicef_cpi.features import autoencoder_features as af
 def copy_files(src, trg, word):
     files = os.listdir(src)
     files = [x for x in files if word.lower() in x]
-    files = [x for x in files if '.tif' in x]
+    files = [x for x in files if ".tif" in x]
     for file in files:
         shutil.copy2(os.path.join(src, file), trg)
 
 
-def train_auto_encoder(hex_codes, read_dir, hyper_tunning, save_dir, country, res):
+def train_auto_encoder(
+    hex_codes,
+    read_dir,
+    hyper_tunning,
+    save_dir,
+    country,
+    res,
+    stream=False,
+    cache_dir=None,
+):
     """Train autoencoder model
     :param hex_codes: _description_
     :type hex_codes: _type_
@@ -28,28 +38,46 @@ def train_auto_encoder(hex_codes, read_dir, hyper_tunning, save_dir, country, re
     :type country: _type_
     :param res: _description_
     :type res: _type_
+    :param stream: stream images through a tf.data pipeline rather than
+                   loading all into memory, defaults to False
+    :type stream: bool, optional
+    :param cache_dir: directory to cache streamed images in, defaults to None
+    :type cache_dir: str, optional
     """
-    train_img_arr = af.get_train_data(read_dir, hex_codes)
+    val_data = None
+    if stream:
+        train_data, val_data, band_stats = af.get_train_datasets(
+            read_dir, hex_codes, cache_dir=cache_dir
+        )
+    else:
+        train_data, band_stats = af.get_train_data(
+            read_dir, hex_codes, return_stats=True
+        )
     model_name = f"autoencoder_{country.lower()}_res{res}"
+    hps = {}
     if hyper_tunning:
-        best_hps = af.get_best_hyperparameters(train_img_arr)
-        af.get_trained_autoencoder(
-            input_data=traifn_img_arr,
-            batch_size=best_hps['batch size'],
-            epochs=best_hps['epochs'],
-            learning_rate=best_hps['learning rate'],
-            save_dir=save_dir,
-            model_name=model_name
-            )
-    else:
-        af.get_trained_autoencoder(
-            input_data=train_img_arr,
-            save_dir=save_dir,
-            model_name=model_name
-            )
+        best_hps = af.get_best_hyperparameters(
+            train_data,
+            validation_data=val_data,
+        )
+        # any not tuned are left at defaults of get_trained_autoencoder
+        hps = {
+            key: best_hps[key]
+            for key in ("batch_size", "epochs", "learning_rate")
+            if best_hps.get(key) is not None
+        }
+    af.get_trained_autoencoder(
+        input_data=train_data,
+        save_dir=save_dir,
+        model_name=model_name,
+        band_stats=band_stats,
+        **hps,
+    )
 
 
-def retrieve_autoencoder_features(hex_codes, trained_autoencoder_dir, country, res, tiff_files_dir, gpu):
+def retrieve_autoencoder_features(
+    hex_codes, trained_autoencoder_dir, country, res, tiff_files_dir, gpu
+):
     """Predict autoencoder features
     :param hex_codes: _description_
     :type hex_codes: _type_
@@ -70,9 +98,117 @@ def retrieve_autoencoder_features(hex_codes, trained_autoencoder_dir, country, r
         model_name=model_name,
         hex_codes=np.array(hex_codes),
         tiff_files_dir=tiff_files_dir,
-        gpu=gpu
-        )
+        gpu=gpu,
+    )
 
     return features
 
 
+def encodings_path(save_dir, country, res):
+    """Path of (parquet) dataset of autoencoder features for a country
+    :param save_dir: directory encodings are saved in
+    :type save_dir: str
+    :param country: country of interest
+    :type country: str
+    :param res: grid resolution
+    :type res: int
+    :return: path of encodings directory
+    :rtype: Path
+    """
+    return Path(save_dir) / f"encodings_{country.lower()}_res{res}.parquet"
+
+
+def save_autoencoder_features(
+    hex_codes,
+    trained_autoencoder_dir,
+    country,
+    res,
+    tiff_files_dir,
+    gpu,
+    save_path,
+    chunk_size=50000,
+):
+    """Predict autoencoder features in chunks of hexes, writing each chunk
+    as a part file of a parquet dataset as it is produced (hex_code as
+    uint64, features as float32), so encodings are never all held in
+    memory, and an interrupted run resumes from the chunks already saved
+    :param hex_codes: hexagons to encode
+    :type hex_codes: array-like
+    :param trained_autoencoder_dir: directory of trained autoencoder
+    :type trained_autoencoder_dir: str
+    :param country: country of interest
+    :type country: str
+    :param res: grid resolution
+    :type res: int
+    :param tiff_files_dir: directory of country tiffs
+    :type tiff_files_dir: str
+    :param gpu: whether to use gpus or not
+    :type gpu: bool
+    :param save_path: directory of parquet dataset, see encodings_path
+    :type save_path: str
+    :param chunk_size: number of hexes per chunk (and part file),
+                       defaults to 50000
+    :type chunk_size: int, optional
+    :return: save_path
+    :rtype: Path
+    """
+    save_path = Path(save_path)
+    # written last, so only present once all chunks saved
+    success = save_path / "_SUCCESS"
+    if success.exists():
+        return save_path
+    save_path.mkdir(parents=True, exist_ok=True)
+    model_name = f"autoencoder_{country.lower()}_res{res}"
+    hex_codes = np.asarray(hex_codes, dtype=np.int64)
+    encoder = None
+    parts = []
+    for start in range(0, len(hex_codes), chunk_size):
+        chunk = hex_codes[start : start + chunk_size].astype(np.uint64)
+        part = save_path / f"part-{len(parts):05d}.parquet"
+        parts.append(part)
+        if part.exists():
+            saved = pd.read_parquet(part, columns=["hex_code"]).hex_code
+            if np.array_equal(saved.to_numpy(), chunk):
+                print(f"--- Chunk {len(parts)} of encodings already saved.")
+                continue
+        if encoder is None:
+            encoder = af.get_encoder(trained_autoencoder_dir, model_name)
+        encodings = af.get_encoded_features(
+            trained_autoencoder_dir=trained_autoencoder_dir,
+            model_name=model_name,
+            hex_codes=chunk.astype(np.int64),
+            tiff_files_dir=tiff_files_dir,
+            gpu=gpu,
+            encoder=encoder,
+        )
+        encodings = pd.DataFrame(
+            encodings.astype(np.float32),
+            columns=["f_" + str(i) for i in range(encodings.shape[1])],
+        )
+        encodings.insert(0, "hex_code", chunk)
+        # files starting with _ are ignored when reading dataset
+        tmp_part = save_path / f"_{part.name}.tmp"
+        encodings.to_parquet(tmp_part, index=False)
+        os.replace(tmp_part, part)
+    # remove parts left from an earlier run over more hexes
+    for part in save_path.glob("part-*.parquet"):
+        if part not in parts:
+            part.unlink()
+    success.touch()
+    return save_path
+
+
+def read_autoencoder_features(save_path, columns=None):
+    """Read saved autoencoder features, only reading columns needed
+    :param save_path: directory of parquet dataset, see encodings_path
+    :type save_path: str
+    :param columns: feature columns to read, defaults to None (all)
+    :type columns: list, optional
+    :return: hex_code (as int64, as elsewhere) and feature columns
+    :rtype: dataframe
+    """
+    if columns is not None:
+        columns = ["hex_code"] + [col for col in columns if col != "hex_code"]
+    encodings = pd.read_parquet(save_path, columns=columns)
+    encodings["hex_code"] = encodings.hex_code.astype(np.int64)
+    return encodings
@@ -6,11 +6,15 @@ import tensorflow as tf
 import keras
 from keras.applications import ResNet50
 from tensorflow.keras.applications.resnet50 import preprocess_input
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
 from sklearn.impute import KNNImputer
 import itertools
+import tempfile
+from pathlib import Path
 from sklearn.preprocessing import StandardScaler
 
+from stc_unicef_cpi.data.patch_store import PatchStore
+
 def numbands_from_tiffs(dir):
     """
     Get the name and number of bands for each tiff
@@ -28,92 +32,128 @@ def numbands_from_tiffs(dir):
             num_bands.append(len(open_file.indexes))
     return num_bands, band_names
 
-def get_features(img_arr, num_bands, pca_components, dim=32):
+def band_groups(num_bands):
+    """
+    Split the bands of each tiff into groups of (up to) 3, as inputs
+    to ResNet50 - so a tiff with 1-3 bands gives one group, 4-6 two, ...
+
+    Inputs:
+        num_bands: first output of numbands_from_tiffs
+    Outputs:
+        list of (start, stop) band indices of each group, across all
+        tiffs stacked in order
+    """
+    groups = []
+    start = 0
+    for n_bands in num_bands:
+        for j in range(0, n_bands, 3):
+            groups.append((start + j, start + min(j + 3, n_bands)))
+        start += n_bands
+    return groups
+
+_RESNETS = {}
+
+def get_resnet(dim=32):
+    """
+    Get pretrained ResNet50 backbone for (dim, dim, 3) inputs, built
+    once per dim and reused thereafter
+
+    Inputs:
+        dim: dimensions for ResNet50 input
+    Outputs:
+        keras model giving 2048 (average pooled) features per image
+    """
+    if dim not in _RESNETS:
+        _RESNETS[dim] = ResNet50(include_top=False, weights='imagenet', input_shape=(dim, dim, 3), pooling='avg')
+    return _RESNETS[dim]
+
+def get_resnet_features(model, patches, groups):
+    """
+    Get ResNet50 features of every band group of a batch of patches,
+    in a single inference pass
+
+    Inputs:
+        model: output of get_resnet
+        patches: array of size (number of samples, dim, dim, bands)
+        groups: output of band_groups
+    Outputs:
+        array of size (number of samples, number of groups, 2048)
+    """
+    n, dim_y, dim_x = patches.shape[:3]
+    # groups of 1 or 2 bands are zero padded to 3
+    data = np.zeros((n, len(groups), dim_y, dim_x, 3), dtype=np.float32)
+    for g, (start, stop) in enumerate(groups):
+        data[:, g, :, :, :stop-start] = patches[..., start:stop]
+    data = preprocess_input(data.reshape(n * len(groups), dim_y, dim_x, 3))
+    resnet_features = np.asarray(model.predict_on_batch(data))
+    return resnet_features.reshape(n, len(groups), -1)
+
+def _chunks(n, size, min_size=1):
+    """Chunk boundaries of range(n), with a short last chunk merged into the previous"""
+    size = max(size, min_size)
+    starts = list(range(0, n, size))
+    if len(starts) > 1 and n - starts[-1] < min_size:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n]))
+
+def get_features(img_arr, num_bands, pca_components, dim=32, batch_size=256, feature_dir=None):
     """
     For each raster, get top PCA features using
     2048 features from pretrained ResNet50
 
+    The backbone is built once, and patches streamed through it in
+    batches, with all band groups in one pass. ResNet50 features are
+    written to a temporary file, then standardised and reduced by an
+    incremental PCA per band group, so are never all held in memory.
+
     Inputs: 
-        img_arr: output of convert_tiffs_to_image_dataset
+        img_arr: output of convert_tiffs_to_image_dataset, or a PatchStore
+                 (read memory-mapped, rather than extracting from tiffs)
         num_bands: first output of numbands_from_tiffs
         pca_components: number of components to reduce features to
         dim: dimensions for ResNet50 input; should match shape[2] and shape[3] of img_arr
+        batch_size: number of samples per inference (and PCA) batch
+        feature_dir: directory for temporary ResNet50 features file,
+                     defaults to system temporary directory
     Outputs:
         array features of size (number of samples: img_arr.shape[0],
                                 num_features: number of 3-groupings obtained from tiffs,
                                 pca_components: specified as funtion arg)
     """
 
-    num_features = sum([j//3 + 1 if j%3 else 0 for j in num_bands])
-    features = np.zeros((img_arr.shape[0], num_features, pca_components))
-    
-    n_feature = 0
-
-    for i in range(len(num_bands)):
-
-        # get bands for each tif
-
-        if i == 0:
-            data = img_arr[:, 0:num_bands[i], :, :]
-        elif i == len(num_bands)-1:
-            data = img_arr[:, -num_bands[i]:, :, :]
-        else:
-            data = img_arr[:, sum(num_bands[:i]):sum(num_bands[:i])+num_bands[i], :, :]
-        
-        data = data.reshape(data.shape[0], data.shape[2], data.shape[3], data.shape[1])
-        
-        # case where tif has 1 or 2 bands
-
-        if data.shape[3] < 3:
-            npad = ((0, 0), (0, 0), (0, 0), (0, 3-data.shape[3]))
-            data_pad = np.pad(data, npad, 'constant')
-
-            model = ResNet50(include_top=False, weights='imagenet', input_shape=(dim, dim, 3))
-            resnet_features = model.predict(preprocess_input(data_pad)).reshape(data.shape[0], 2048)
-            
-            scaler = StandardScaler()
-            pca = PCA(n_components=pca_components)
-            pca_features = pca.fit_transform(scaler.fit_transform(resnet_features))
-            
-            features[:,n_feature,:] = pca_features
-            n_feature += 1
-        
-        #case where tif has more than 3 bands
-        elif data.shape[3] > 3:
-
-            #sub_bands = data.shape[3]//3 + 1 if data.shape[3]%3 else 0
-            for j in range(0, data.shape[3], 3):
-                if j == (data.shape[3]//3)*3:
-                    sub_data = data[:,:,:,j:]
-                else:
-                    sub_data = data[:,:,:,j:j+3]
-                
-                if sub_data.shape[3] < 3: # change to less than
-                    npad = ((0, 0), (0, 0), (0, 0), (0, 3-sub_data.shape[3]))
-                    sub_data = np.pad(sub_data, npad, 'constant')
-                
-                model = ResNet50(include_top=False, weights='imagenet', input_shape=(dim, dim, 3))
-                resnet_features = model.predict(preprocess_input(sub_data)).reshape(data.shape[0], 2048)
-                
-                scaler = StandardScaler()
-                pca = PCA(n_components=pca_components)
-                pca_features = pca.fit_transform(scaler.fit_transform(resnet_features))
-                
-                features[:,n_feature,:] = pca_features
-
-                n_feature += 1
-        
-        #case where tif has exactly 3 bands; not required now but adding in case needed later
-        else:
-
-            model = ResNet50(include_top=False, weights='imagenet', input_shape=(dim, dim, 3))
-            resnet_features = model.predict(preprocess_input(data)).reshape(data.shape[0], 2048)
-            
-            scaler = StandardScaler()
-            pca = PCA(n_components=pca_components)
-            pca_features = pca.fit_transform(scaler.fit_transform(resnet_features))
-            
-            features[:,n_feature,:] = pca_features
-            n_feature += 1
-        
-    return features
\ No newline at end of file
+    if isinstance(img_arr, PatchStore):
+        patches = img_arr.get()
+    else:
+        # channels last view, rather than copy
+        patches = img_arr.transpose(0, 2, 3, 1)
+
+    groups = band_groups(num_bands)
+    model = get_resnet(dim)
+    n_samples = patches.shape[0]
+    features = np.zeros((n_samples, len(groups), pca_components))
+    scalers = [StandardScaler() for _ in groups]
+    pcas = [IncrementalPCA(n_components=pca_components) for _ in groups]
+    # incremental PCA needs at least pca_components samples per batch
+    chunks = _chunks(n_samples, batch_size, pca_components)
+
+    with tempfile.TemporaryDirectory(dir=feature_dir) as tmp_dir:
+        resnet_features = np.lib.format.open_memmap(
+            Path(tmp_dir) / "resnet_features.npy", mode='w+', dtype=np.float32,
+            shape=(n_samples, len(groups), 2048)
+        )
+        for start, stop in chunks:
+            batch = get_resnet_features(model, np.asarray(patches[start:stop]), groups)
+            resnet_features[start:stop] = batch
+            for g, scaler in enumerate(scalers):
+                scaler.partial_fit(batch[:, g])
+
+        for start, stop in chunks:
+            for g, (scaler, pca) in enumerate(zip(scalers, pcas)):
+                pca.partial_fit(scaler.transform(resnet_features[start:stop, g]))
+
+        for start, stop in chunks:
+            for g, (scaler, pca) in enumerate(zip(scalers, pcas)):
+                features[start:stop, g] = pca.transform(scaler.transform(resnet_features[start:stop, g]))
+        del resnet_features
+
+    return features
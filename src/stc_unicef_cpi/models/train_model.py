@@ -5,7 +5,6 @@ import sys
 import warnings
 from pathlib import Path
 
-import cartopy.io.shapereader as shpreader
 import geopandas as gpd
 import h3.api.numpy_int as h3
 import joblib
@@ -39,6 +38,7 @@ from sklearn.preprocessing import (
 )
 from tqdm.auto import tqdm
 
+import stc_unicef_cpi.utils.geospatial as geo
 from stc_unicef_cpi.data.cv_loaders import HexSpatialKFold, StratifiedIntervalKFold
 from stc_unicef_cpi.features.build_features import boruta_shap_ftr_select
 from stc_unicef_cpi.utils.mlflow_utils import fetch_logged_data
@@ -391,20 +391,14 @@ if __name__ == "__main__":
         # else produce data from scratch
 
         # Also reclip just in case
-        shpfilename = shpreader.natural_earth(
-            resolution="10m", category="cultural", name="admin_0_countries"
-        )
-        reader = shpreader.Reader(shpfilename)
-        world = reader.records()
         country = pycountry.countries.search_fuzzy(args.country)[0]
         ctry_name = country.name
-        ctry_geom = next(
-            filter(lambda x: x.attributes["NAME"] == ctry_name, world)
-        ).geometry
+        # prepared geometry, as tested against every hex centre
+        ctry_geom = geo.get_country_index().prepared(ctry_name)
         XY = XY[
             XY.hex_code.swifter.apply(
                 lambda x: Point(h3.h3_to_geo(x)[::-1])
-            ).swifter.apply(lambda pt: pt.within(ctry_geom))
+            ).swifter.apply(ctry_geom.contains)
         ]
 
     # thr_df = pd.read_csv(thr_data)
@@ -0,0 +1,240 @@
+"""Execution backends for running independent tasks (e.g. aggregating
+each of a set of tiff files) either serially, in a pool of threads or
+processes, or on a dask cluster (local, or an existing scheduler).
+
+A backend is created once per pipeline run, then shared by all stages,
+so that pools and clusters are not repeatedly started and torn down."""
+import os
+import warnings
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Union
+
+import humanfriendly
+
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    warnings.warn("dask.distributed not installed, dask backends unavailable")
+    Client = LocalCluster = None
+
+# names of backends available from get_backend, besides scheduler addresses
+BACKENDS = ("serial", "threads", "processes", "dask")
+
+
+def parse_memory(memory: Optional[Union[str, int]]) -> Optional[int]:
+    """Parse memory size, given either in bytes or as a human
+    readable size (e.g. "4GB")
+
+    :param memory: Memory size
+    :type memory: Optional[Union[str, int]]
+    :return: Memory size in bytes, or None if not given
+    :rtype: Optional[int]
+    """
+    if memory is None:
+        return None
+    if isinstance(memory, str):
+        return humanfriendly.parse_size(memory)
+    return int(memory)
+
+
+def total_memory() -> int:
+    """Total physical memory of this machine, in bytes
+
+    :return: Total memory
+    :rtype: int
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class ExecutionBackend:
+    """Run a function over iterables of arguments, returning results
+    in the order of the arguments whatever order tasks complete in.
+
+    This base class runs tasks serially in the current process.
+
+    :param n_workers: Number of workers, defaults to 1
+    :type n_workers: int, optional
+    :param memory_limit: Approximate memory cap per worker in bytes, or
+                         as a human readable size, defaults to None
+    :type memory_limit: Optional[Union[str, int]], optional
+    """
+
+    name = "serial"
+
+    def __init__(
+        self, n_workers: int = 1, memory_limit: Optional[Union[str, int]] = None
+    ):
+        self.n_workers = n_workers
+        self.memory_limit = parse_memory(memory_limit)
+
+    @property
+    def parallel(self) -> bool:
+        return self.n_workers > 1
+
+    def map(self, fn: Callable[..., Any], *iterables: Iterable) -> List[Any]:
+        """Apply fn to each set of arguments from iterables
+
+        :param fn: Function to apply
+        :type fn: Callable[..., Any]
+        :return: Results, in order of arguments
+        :rtype: List[Any]
+        """
+        return list(map(fn, *iterables))
+
+    def close(self) -> None:
+        """Release any workers held by the backend"""
+        pass
+
+    def __enter__(self) -> "ExecutionBackend":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(n_workers={self.n_workers})"
+
+
+class PoolBackend(ExecutionBackend):
+    """Run tasks in a pool of threads or processes, from
+    concurrent.futures - for process pools, fn and its arguments
+    must be picklable.
+
+    :param n_workers: Number of workers, defaults to None (all CPUs)
+    :type n_workers: Optional[int], optional
+    :param memory_limit: Approximate memory cap per worker - if given,
+                         workers are limited to those fitting in the
+                         memory of the machine, defaults to None
+    :type memory_limit: Optional[Union[str, int]], optional
+    :param processes: Use processes rather than threads, defaults to True
+    :type processes: bool, optional
+    """
+
+    def __init__(
+        self,
+        n_workers: Optional[int] = None,
+        memory_limit: Optional[Union[str, int]] = None,
+        processes: bool = True,
+    ):
+        memory_limit = parse_memory(memory_limit)
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        if memory_limit is not None and processes:
+            n_workers = min(n_workers, max(1, total_memory() // memory_limit))
+        super().__init__(n_workers, memory_limit)
+        self.name = "processes" if processes else "threads"
+        pool_cls = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._executor: Optional[Executor] = pool_cls(max_workers=n_workers)
+
+    def map(self, fn: Callable[..., Any], *iterables: Iterable) -> List[Any]:
+        if self._executor is None:
+            raise RuntimeError("Backend already closed")
+        return list(self._executor.map(fn, *iterables))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+class DaskBackend(ExecutionBackend):
+    """Run tasks on a dask cluster, either connecting to an existing
+    scheduler at address, or starting a LocalCluster.
+
+    :param address: Address of existing dask scheduler, e.g.
+                    "tcp://dask-scheduler:8786", defaults to None
+                    (start a LocalCluster)
+    :type address: Optional[str], optional
+    :param n_workers: Number of workers of LocalCluster, defaults to
+                      None (all CPUs, limited by memory)
+    :type n_workers: Optional[int], optional
+    :param memory_limit: Memory limit per worker of LocalCluster, defaults
+                         to None (dask default)
+    :type memory_limit: Optional[Union[str, int]], optional
+    :param timeout: Timeout connecting to scheduler, defaults to "10s"
+    :type timeout: str, optional
+    """
+
+    name = "dask"
+
+    def __init__(
+        self,
+        address: Optional[str] = None,
+        n_workers: Optional[int] = None,
+        memory_limit: Optional[Union[str, int]] = None,
+        timeout: str = "10s",
+    ):
+        if Client is None:
+            raise ImportError("dask.distributed required for dask backend")
+        memory_limit = parse_memory(memory_limit)
+        self._cluster = None
+        if address is None:
+            if n_workers is None:
+                n_workers = os.cpu_count() or 1
+            if memory_limit is not None:
+                n_workers = min(n_workers, max(1, total_memory() // memory_limit))
+            self._cluster = LocalCluster(
+                n_workers=n_workers,
+                threads_per_worker=1,
+                memory_limit=memory_limit if memory_limit is not None else "auto",
+            )
+            self._client = Client(self._cluster, timeout=timeout)
+        else:
+            self._client = Client(address, timeout=timeout)
+            n_workers = len(self._client.scheduler_info()["workers"])
+        super().__init__(max(1, n_workers), memory_limit)
+
+    @property
+    def client(self) -> "Client":
+        return self._client
+
+    def map(self, fn: Callable[..., Any], *iterables: Iterable) -> List[Any]:
+        # pure=False, as tasks may e.g. read files that have changed
+        futures = self._client.map(fn, *iterables, pure=False)
+        return self._client.gather(futures)
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+        if self._cluster is not None:
+            self._cluster.close()
+            self._cluster = None
+
+
+def get_backend(
+    backend: Union[str, ExecutionBackend, None] = "serial",
+    n_workers: Optional[int] = None,
+    memory_limit: Optional[Union[str, int]] = None,
+) -> ExecutionBackend:
+    """Create execution backend from its name, or the address of
+    an existing dask scheduler
+
+    :param backend: One of "serial", "threads", "processes", "dask"
+                    (LocalCluster), or address of dask scheduler (e.g.
+                    "tcp://dask-scheduler:8786"). If already a backend,
+                    it is returned as is. Defaults to "serial"
+    :type backend: Union[str, ExecutionBackend, None], optional
+    :param n_workers: Number of workers, defaults to None (all CPUs)
+    :type n_workers: Optional[int], optional
+    :param memory_limit: Approximate memory cap per worker, in bytes or
+                         as a human readable size (e.g. "4GB"), defaults
+                         to None
+    :type memory_limit: Optional[Union[str, int]], optional
+    :raises ValueError: If backend not recognised
+    :return: Execution backend
+    :rtype: ExecutionBackend
+    """
+    if isinstance(backend, ExecutionBackend):
+        return backend
+    if backend is None or backend == "serial":
+        return ExecutionBackend(memory_limit=memory_limit)
+    if backend in ("threads", "processes"):
+        return PoolBackend(n_workers, memory_limit, processes=backend == "processes")
+    if backend == "dask":
+        return DaskBackend(n_workers=n_workers, memory_limit=memory_limit)
+    if "://" in backend or ":" in backend:
+        return DaskBackend(address=backend)
+    raise ValueError(
+        f"Unknown backend {backend}, must be one of {BACKENDS} or a scheduler address"
+    )
@@ -28,6 +28,10 @@ end_ee = "2020-01-01"
 res_ee = 500
 folder_ee = "gee"
 
+# execution backend for heavy processing stages (see utils.backends), either
+# serial, threads, processes, dask or the address of an existing dask scheduler
+backend = "serial"
+
 current_dir = Path.cwd()
 if current_dir.name == "data" and current_dir.parent.name == "stc_unicef_cpi":
     # restrict to when calling from make_dataset.py
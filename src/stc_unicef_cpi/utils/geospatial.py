@@ -1,15 +1,34 @@
 import math
+import os
+import pickle
+import threading
+import warnings
+from functools import lru_cache
 from itertools import chain
+from pathlib import Path
 
 import cartopy.io.shapereader as shpreader
 import geopandas as gpd
 import h3.api.numpy_int as h3
 import numpy as np
 import pandas as pd
+import shapely.wkb
 import shapely.wkt
-from pyproj import Geod
+from pyproj import Geod, Transformer
 from shapely import geometry, wkt
 from shapely.geometry.polygon import Polygon
+from shapely.prepared import prep
+
+try:
+    with warnings.catch_warnings():
+        # h3.unstable warns on import that the API may change
+        warnings.simplefilter("ignore")
+        from h3.unstable import vect as h3_vect
+except ImportError:
+    warnings.warn(
+        "Vectorised h3 functions not found (requires h3>=3.7) - falling back to per-point conversion"
+    )
+    h3_vect = None
 
 # resolution and area of hexagon in km2
 res_area = {
@@ -91,9 +110,76 @@ def create_geometry(data, lat, long):
     return data
 
 
+def geo_to_h3_array(lats, longs, res):
+    """Convert arrays of latitudes and longitudes to h3 hex codes
+    in a single batched call, rather than one python call per point.
+    Results are identical to applying h3.geo_to_h3 to each point.
+
+    :param lats: array of latitudes
+    :type lats: array-like
+    :param longs: array of longitudes, same shape as lats
+    :type longs: array-like
+    :param res: resolution of h3 grid
+    :type res: int
+    :return: hex codes in numpy_int form, same shape as lats
+    :rtype: numpy array of type uint64
+    """
+    lats, longs = np.broadcast_arrays(
+        np.asarray(lats, dtype=np.float64), np.asarray(longs, dtype=np.float64)
+    )
+    shape = lats.shape
+    lats = np.ascontiguousarray(lats.reshape(-1))
+    longs = np.ascontiguousarray(longs.reshape(-1))
+    if h3_vect is not None:
+        hex_codes = h3_vect.geo_to_h3(lats, longs, res)
+    else:
+        hex_codes = np.fromiter(
+            (h3.geo_to_h3(lat, long, res) for lat, long in zip(lats, longs)),
+            dtype=np.uint64,
+            count=len(lats),
+        )
+    return hex_codes.reshape(shape)
+
+
+@lru_cache(maxsize=32)
+def _cached_transformer(src_crs, dst_crs, always_xy):
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=always_xy)
+
+
+def _crs_key(crs):
+    """Hashable form of a CRS (rasterio, pyproj or string), with
+    missing CRS taken as EPSG:4326"""
+    if crs is None:
+        return "EPSG:4326"
+    if hasattr(crs, "to_wkt"):
+        return crs.to_wkt()
+    return str(crs)
+
+
+def get_transformer(src_crs, dst_crs="EPSG:4326", always_xy=True):
+    """Get a (shared) pyproj Transformer between two CRSs, so that
+    transformers are built once per pair of CRSs rather than on every
+    call. Transformers should be applied to whole arrays of
+    coordinates at once rather than per point. By default coordinates
+    are in (x, y) order for all CRSs, i.e. (long, lat) for EPSG:4326,
+    and (easting, northing) for projected CRSs.
+
+    :param src_crs: source CRS, e.g. rasterio dataset crs - if None,
+                    assumed to be EPSG:4326
+    :type src_crs: CRS or string
+    :param dst_crs: destination CRS, defaults to "EPSG:4326"
+    :type dst_crs: CRS or string, optional
+    :param always_xy: as for Transformer.from_crs, defaults to True
+    :type always_xy: bool, optional
+    :return: transformer from src_crs to dst_crs
+    :rtype: pyproj.Transformer
+    """
+    return _cached_transformer(_crs_key(src_crs), _crs_key(dst_crs), always_xy)
+
+
 def get_hex_code(df, lat, long, res):
-    df["hex_code"] = df[[lat, long]].apply(
-        lambda row: h3.geo_to_h3(row[lat], row[long], res), axis=1
+    df["hex_code"] = geo_to_h3_array(df[lat].values, df[long].values, res).astype(
+        np.int64
     )
     return df
 
@@ -108,16 +194,208 @@ def aggregate_hexagon(df, col_to_agg, name_agg, type):
     return df
 
 
-def get_shape_for_ctry(ctry_name):
-    # world = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
-    # ctry_shp = world[world.name == ctry_name]
+class CountryIndex:
+    """Geometries and bounding boxes of all countries in the Natural
+    Earth 10m admin 0 shapefile, keyed by name (as NAME attribute, or
+    case-insensitively) and by ISO3 code, with prepared geometries
+    built on first use for fast repeated predicates.
+
+    :param names: Name of each country
+    :type names: List[str]
+    :param iso3s: ISO3 codes (ISO_A3 and ADM0_A3, where valid) of each country
+    :type iso3s: List[List[str]]
+    :param geometries: Geometry of each country, in EPSG:4326
+    :type geometries: List[shapely.geometry.base.BaseGeometry]
+    """
+
+    def __init__(self, names, iso3s, geometries):
+        self.names = list(names)
+        self.iso3s = [list(codes) for codes in iso3s]
+        self.geometries = list(geometries)
+        self.bboxes = np.array([geom.bounds for geom in self.geometries])
+        self._keys = {}
+        for idx, codes in enumerate(self.iso3s):
+            for code in codes:
+                self._keys.setdefault(code.upper(), idx)
+        for idx, name in enumerate(self.names):
+            self._keys.setdefault(name.lower(), idx)
+        # exact names take precedence
+        self._keys.update({name: idx for idx, name in enumerate(self.names)})
+        self._prepared = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def _find(self, key):
+        for k in (key, key.lower(), key.upper()):
+            if k in self._keys:
+                return self._keys[k]
+        return None
+
+    def index(self, key):
+        """Position of country in index
+
+        :param key: Country name or ISO3 code
+        :type key: str
+        :raises KeyError: If no such country
+        :return: Index of country
+        :rtype: int
+        """
+        idx = self._find(key)
+        if idx is None:
+            raise KeyError(f"Country {key} not found in Natural Earth countries")
+        return idx
+
+    def geometry(self, key):
+        """Geometry of country, in EPSG:4326
+
+        :param key: Country name or ISO3 code
+        :type key: str
+        :return: Country geometry
+        :rtype: shapely.geometry.base.BaseGeometry
+        """
+        return self.geometries[self.index(key)]
+
+    def prepared(self, key):
+        """Prepared geometry of country, for fast repeated predicates
+        such as contains
+
+        :param key: Country name or ISO3 code
+        :type key: str
+        :return: Prepared country geometry
+        :rtype: shapely.prepared.PreparedGeometry
+        """
+        idx = self.index(key)
+        if idx not in self._prepared:
+            self._prepared[idx] = prep(self.geometries[idx])
+        return self._prepared[idx]
+
+    def bounds(self, key):
+        """Bounding box of country, in EPSG:4326
+
+        :param key: Country name or ISO3 code
+        :type key: str
+        :return: minx, miny, maxx, maxy
+        :rtype: np.ndarray
+        """
+        return self.bboxes[self.index(key)]
+
+    @classmethod
+    def from_shapefile(cls, shpfilename):
+        """Build index from Natural Earth admin 0 shapefile
+
+        :param shpfilename: Path to shapefile
+        :type shpfilename: str
+        :return: Country index
+        :rtype: CountryIndex
+        """
+        names, iso3s, geometries = [], [], []
+        for record in shpreader.Reader(shpfilename).records():
+            names.append(record.attributes["NAME"])
+            iso3s.append(
+                [
+                    record.attributes[attr]
+                    for attr in ("ISO_A3", "ADM0_A3")
+                    if record.attributes.get(attr, "-99") not in ("-99", "", None)
+                ]
+            )
+            geometries.append(record.geometry)
+        return cls(names, iso3s, geometries)
+
+    def save(self, path, source_key=None):
+        """Save index as binary (pickled WKB) cache
+
+        :param path: Path to save to
+        :type path: str
+        :param source_key: Key of source shapefile, to check on load,
+                           defaults to None
+        :type source_key: tuple, optional
+        """
+        path = Path(path)
+        state = {
+            "source": source_key,
+            "names": self.names,
+            "iso3s": self.iso3s,
+            "geometries": [geom.wkb for geom in self.geometries],
+        }
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, source_key=None):
+        """Load index saved with save
+
+        :param path: Path to load from
+        :type path: str
+        :param source_key: Expected key of source shapefile, defaults to None
+                           (not checked)
+        :type source_key: tuple, optional
+        :return: Country index, or None if missing or stale
+        :rtype: Optional[CountryIndex]
+        """
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        if source_key is not None and state.get("source") != source_key:
+            return None
+        return cls(
+            state["names"],
+            state["iso3s"],
+            [shapely.wkb.loads(geom) for geom in state["geometries"]],
+        )
+
+
+_COUNTRY_INDEX_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_country_index():
     shpfilename = shpreader.natural_earth(
         resolution="10m", category="cultural", name="admin_0_countries"
     )
-    reader = shpreader.Reader(shpfilename)
-    world = reader.records()
-    ctry_shp = next(filter(lambda x: x.attributes["NAME"] == ctry_name, world)).geometry
-    return ctry_shp
+    stat = os.stat(shpfilename)
+    source_key = (str(shpfilename), stat.st_size, stat.st_mtime_ns)
+    # cache alongside shapefile, rebuilt if shapefile changes
+    cache_path = Path(shpfilename).with_suffix(".index.pkl")
+    index = CountryIndex.load(cache_path, source_key)
+    if index is None:
+        index = CountryIndex.from_shapefile(shpfilename)
+        try:
+            index.save(cache_path, source_key)
+        except OSError:
+            warnings.warn(f"Could not write country index cache to {cache_path}")
+    return index
+
+
+def get_country_index():
+    """Get the process-wide index of country geometries, loaded on
+    first use from a binary cache alongside the Natural Earth 10m
+    admin 0 shapefile (built from the shapefile if missing or stale),
+    so country lookups no longer re-read the shapefile.
+
+    :return: Country index
+    :rtype: CountryIndex
+    """
+    with _COUNTRY_INDEX_LOCK:
+        return _load_country_index()
+
+
+def get_shape_for_ctry(ctry_name):
+    """Get geometry of a country, from the shared country index
+
+    :param ctry_name: Country name (as Natural Earth NAME) or ISO3 code
+    :type ctry_name: str
+    :return: Country geometry, in EPSG:4326
+    :rtype: shapely.geometry.base.BaseGeometry
+    """
+    return get_country_index().geometry(ctry_name)
 
 
 def get_hexes_for_ctry(ctry_name="Nigeria", res=7):
@@ -127,12 +405,7 @@ def get_hexes_for_ctry(ctry_name="Nigeria", res=7):
     :param level: _description_, defaults to 7
     :type level: int, optional
     """
-    shpfilename = shpreader.natural_earth(
-        resolution="10m", category="cultural", name="admin_0_countries"
-    )
-    reader = shpreader.Reader(shpfilename)
-    world = reader.records()
-    ctry_shp = next(filter(lambda x: x.attributes["NAME"] == ctry_name, world)).geometry
+    ctry_shp = get_shape_for_ctry(ctry_name)
     try:
         # handle MultiPolygon
         ctry_polys = list(ctry_shp)
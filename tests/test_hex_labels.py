@@ -0,0 +1,71 @@
+import h3.api.numpy_int as h3
+import numpy as np
+import pytest
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+import stc_unicef_cpi.data.hex_labels as hl
+import stc_unicef_cpi.data.process_geotiff as pg
+import stc_unicef_cpi.utils.geospatial as geo
+
+# Lagos, away from lat = long, so swapped axes give a different hex
+LAT, LONG = 6.5244, 3.3792
+ROW, COL = 5, 7
+RES = 7
+
+
+@pytest.fixture
+def projected_tif(tmp_path):
+    """Web Mercator raster of 100m pixels, with pixel (ROW, COL)
+    centred on (LAT, LONG), and values row * width + col"""
+    easting, northing = Transformer.from_crs(
+        "EPSG:4326", "EPSG:3857", always_xy=True
+    ).transform(LONG, LAT)
+    height, width = 20, 20
+    transform = from_origin(
+        easting - (COL + 0.5) * 100, northing + (ROW + 0.5) * 100, 100, 100
+    )
+    path = tmp_path / "projected.tif"
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        height=height,
+        width=width,
+        count=1,
+        dtype="float32",
+        crs="EPSG:3857",
+        transform=transform,
+    ) as dst:
+        dst.write(np.arange(height * width, dtype=np.float32).reshape(1, height, width))
+    return path
+
+
+def test_transformer_is_xy():
+    longs, lats = geo.get_transformer("EPSG:3857").transform(
+        *Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True).transform(
+            LONG, LAT
+        )
+    )
+    assert np.isclose(longs, LONG) and np.isclose(lats, LAT)
+
+
+def test_window_hex_codes_projected(projected_tif):
+    with rasterio.open(projected_tif) as raster:
+        hex_codes = hl.window_hex_codes(raster, Window(0, 0, 20, 20), RES)
+    assert hex_codes[ROW, COL] == h3.geo_to_h3(LAT, LONG, RES)
+
+
+def test_hex_labels_projected(projected_tif):
+    with rasterio.open(projected_tif) as raster:
+        label_rast = hl.get_hex_labels(raster, RES)
+    label = label_rast.labels[ROW, COL]
+    assert label_rast.hex_codes[label] == h3.geo_to_h3(LAT, LONG, RES)
+
+
+def test_extract_patches_projected(projected_tif):
+    with rasterio.open(projected_tif) as raster:
+        patch = pg.extract_patches_at_coords(raster, [LAT], [LONG], 1, 1)
+    assert patch[0, 0, 0, 0] == ROW * 20 + COL